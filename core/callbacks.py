@@ -1,59 +1,382 @@
+import json
+import logging
+import os
+import shutil
+import threading
+import Queue
+
+import keras
+import keras.backend as K
 import keras.callbacks as callbacks
 
 import h5py
 import numpy as np
 import yaml
 
+from utils.registry import CALLBACKS
+
+# Every keras callback can be built from the command line (train.py
+# --lr_schedule NAME --lr_params key value ...)
+for _callback in vars(callbacks).values():
+    if isinstance(_callback, type) and \
+            issubclass(_callback, callbacks.Callback) and \
+            _callback.__module__ == callbacks.__name__:
+        CALLBACKS.register(_callback)
+
+
+def _get_json_type(obj):
+    """ Same as the one of keras.models.save_model
+    """
+    if hasattr(obj, 'get_config'):
+        return {'class_name': obj.__class__.__name__,
+                'config': obj.get_config()}
+    if type(obj).__module__ == np.__name__:
+        return obj.item()
+    if callable(obj):
+        return obj.__name__
+    if type(obj).__name__ == type.__name__:
+        return obj.__name__
+    raise TypeError('Not JSON Serializable:', obj)
+
+
+def _weight_names(weights):
+    return [(str(w.name) if getattr(w, 'name', None) else 'param_%d' % i)
+            for i, w in enumerate(weights)]
+
+
+def snapshot_model(model):
+    """ Copies to memory everything that keras.models.save_model writes, so
+    the model can be written (see write_snapshot) while it keeps training
+    """
+    layers = getattr(model, 'flattened_layers', model.layers)
+    layer_weights = [l.trainable_weights + l.non_trainable_weights
+                     for l in layers]
+    optimizer_weights = getattr(model.optimizer, 'weights', [])
+
+    # Only one session call
+    values = K.batch_get_value(sum(layer_weights, []) + optimizer_weights)
+
+    snapshot = {'layers': [], 'optimizer_weights': None}
+
+    offset = 0
+    for layer, weights in zip(layers, layer_weights):
+        snapshot['layers'].append(
+            (layer.name, list(zip(_weight_names(weights),
+                                  values[offset: offset + len(weights)]))))
+        offset += len(weights)
+
+    if optimizer_weights:
+        snapshot['optimizer_weights'] = list(zip(
+            _weight_names(optimizer_weights), values[offset:]))
+
+    snapshot['attrs'] = {
+        'keras_version': str(keras.__version__).encode('utf8'),
+        'model_config': json.dumps({
+            'class_name': model.__class__.__name__,
+            'config': model.get_config()},
+            default=_get_json_type).encode('utf8'),
+        'training_config': json.dumps({
+            'optimizer_config': {
+                'class_name': model.optimizer.__class__.__name__,
+                'config': model.optimizer.get_config()},
+            'loss': model.loss,
+            'metrics': model.metrics,
+            'sample_weight_mode': model.sample_weight_mode,
+            'loss_weights': model.loss_weights},
+            default=_get_json_type).encode('utf8')}
+
+    return snapshot
+
+
+def _write_weights(group, weights):
+    group.attrs['weight_names'] = [n.encode('utf8') for n, _ in weights]
+    for name, value in weights:
+        dset = group.create_dataset(name, value.shape, dtype=value.dtype)
+        if not value.shape:
+            dset[()] = value
+        else:
+            dset[:] = value
+
+
+def write_snapshot(filepath, snapshot, meta=None, iterator_state=None):
+    """ Writes a snapshot in the keras format, with the meta and iterator
+    state groups, in a single pass. The file is written to a temporary path
+    and renamed, so filepath is never left half written
+    """
+    tmp_filepath = filepath + '.tmp'
+
+    with h5py.File(tmp_filepath, 'w') as f:
+        for k, v in snapshot['attrs'].items():
+            f.attrs[k] = v
+
+        weights_group = f.create_group('model_weights')
+        weights_group.attrs['layer_names'] = [
+            name.encode('utf8') for name, _ in snapshot['layers']]
+        for name, weights in snapshot['layers']:
+            _write_weights(weights_group.create_group(name), weights)
+
+        if snapshot['optimizer_weights']:
+            _write_weights(f.create_group('optimizer_weights'),
+                           snapshot['optimizer_weights'])
+
+        if meta is not None:
+            meta_group = f.create_group('meta')
+            meta_group.attrs['training_args'] = yaml.dump(
+                meta.get('training_args', '{}'))
+            for k, v in meta.items():
+                if k != 'training_args':
+                    meta_group.create_dataset(k, data=np.array(v))
+
+        if iterator_state is not None:
+            group = f.create_group('iterator_state')
+            for k, v in iterator_state.items():
+                if k != 'permutation':
+                    group.attrs[k] = v
+
+            if iterator_state['permutation'] is not None:
+                group.create_dataset(
+                    'permutation', data=np.asarray(
+                        iterator_state['permutation'], dtype='int32'))
+
+    os.rename(tmp_filepath, filepath)
+
+
+def _copy_file(src, dst):
+    shutil.copyfile(src, dst + '.tmp')
+    os.rename(dst + '.tmp', dst)
+
 
 class MetaCheckpoint(callbacks.ModelCheckpoint):
     """
     Checkpoints some training information with the model. This should enable
     resuming training and having training information on every checkpoint.
 
+    The weights and the optimizer state are copied to memory at the end of
+    the epoch and the file is written by a background thread, so the
+    training is not blocked by the serialization. If best_filepath is set,
+    the best model (according to monitor) is saved there too; when the
+    latest model is also the best one, it is serialized only once.
+
+    If iterator is set, the state of the training iterator is saved too and
+    the model is also saved every save_every batches, so the training can
+    resume in the middle of an epoch (see DatasetIterator.restore_state).
+
     Thanks to Roberto Estevao @robertomest - robertomest@poli.ufrj.br
     """
 
     def __init__(self, filepath, monitor='val_loss', verbose=0,
                  save_best_only=False, save_weights_only=False,
-                 mode='auto', period=1, training_args=None, meta=None):
+                 mode='auto', period=1, training_args=None, meta=None,
+                 iterator=None, save_every=None, iterator_state=None,
+                 best_filepath=None, async_save=True):
 
-        super(MetaCheckpoint, self).__init__(filepath, monitor='val_loss',
-                                             verbose=0, save_best_only=False,
+        super(MetaCheckpoint, self).__init__(filepath, monitor=monitor,
+                                             verbose=verbose,
+                                             save_best_only=save_best_only,
                                              save_weights_only=False,
-                                             mode='auto', period=1)
+                                             mode=mode, period=period)
+
+        self._logger = logging.getLogger('%s.%s' % (__name__,
+                                                    self.__class__.__name__))
 
         self.filepath = filepath
-        self.meta = meta or {'epochs': []}
+        self.best_filepath = best_filepath
+        # Each checkpoint keeps its own history (meta may be shared)
+        self.meta = {k: (list(v) if isinstance(v, list) else v)
+                     for k, v in (meta or {'epochs': []}).items()}
 
         if training_args:
             training_args = vars(training_args)
 
             self.meta['training_args'] = training_args
 
+        # Resuming the best value of a loaded model
+        for v in self.meta.get(monitor, []):
+            if self.monitor_op(v, self.best):
+                self.best = v
+
+        self.iterator = iterator
+        self.save_every = save_every
+
+        # Position of a resumed training
+        iterator_state = iterator_state or {}
+        self._initial_batch = iterator_state.get('batch_index', 0)
+        self._total_batches = iterator_state.get('total_batches_seen', 0)
+        self._epoch = self._batch = 0
+
+        self.async_save = async_save
+        self._queue = None
+        self._writer = None
+        self._error = None
+
     def on_train_begin(self, logs={}):
         super(MetaCheckpoint, self).on_train_begin(logs)
 
-    def on_epoch_end(self, epoch, logs={}):
-        super(MetaCheckpoint, self).on_epoch_end(epoch, logs)
+        if self.async_save and self._writer is None:
+            self._queue = Queue.Queue()
+            self._writer = threading.Thread(target=self._write_loop)
+            self._writer.daemon = True
+            self._writer.start()
+
+    def on_train_end(self, logs={}):
+        self.wait()
+
+    def on_epoch_begin(self, epoch, logs={}):
+        self._epoch = epoch
+        self._batch, self._initial_batch = self._initial_batch, 0
+
+    def on_batch_end(self, batch, logs={}):
+        self._batch += 1
+        self._total_batches += 1
 
+        if self.iterator is not None and self.save_every and \
+                self._batch % self.save_every == 0:
+            self._save([self.filepath.format(epoch=self._epoch)],
+                       self._epoch, self._batch)
+
+    def on_epoch_end(self, epoch, logs={}):
         # Get statistics
         self.meta['epochs'].append(epoch)
         for k, v in logs.items():
             # Get default gets the value or sets (and gets) the default value
             self.meta.setdefault(k, []).append(v)
 
-        # Save to file
-        filepath = self.filepath.format(epoch=epoch, **logs)
-
-        if self.epochs_since_last_save == 0:
-            with h5py.File(filepath, 'r+') as f:
-                meta_group = f.create_group('meta')
-                meta_group.attrs['training_args'] = yaml.dump(
-                    self.meta.get('training_args', '{}'))
-                meta_group.create_dataset('epochs',
-                                          data=np.array(self.meta['epochs']))
-                for k in logs:
-                    meta_group.create_dataset(k, data=np.array(self.meta[k]))
+        filepaths = []
+
+        self.epochs_since_last_save += 1
+        if self.epochs_since_last_save >= self.period:
+            self.epochs_since_last_save = 0
+            if not self.save_best_only:
+                filepaths.append(self.filepath.format(epoch=epoch, **logs))
+
+        if self.save_best_only or self.best_filepath:
+            current = logs.get(self.monitor)
+            if current is None:
+                self._logger.warning('Can save best model only with %s '
+                                     'available, skipping.' % self.monitor)
+            elif self.monitor_op(current, self.best):
+                if self.verbose > 0:
+                    print('Epoch %05d: %s improved from %0.5f to %0.5f' % (
+                        epoch, self.monitor, self.best, current))
+                self.best = current
+                filepaths.append(
+                    (self.best_filepath or self.filepath).format(
+                        epoch=epoch, **logs))
+
+        if filepaths:
+            self._save(filepaths, epoch + 1, 0)
+
+    def _save(self, filepaths, epoch, batch_index):
+        """ Snapshots the model and writes it to the first filepath. The
+        others are copies of it
+        """
+        if self._error is not None:
+            raise self._error
+
+        meta = {k: (list(v) if isinstance(v, list) else v)
+                for k, v in self.meta.items()}
+
+        iterator_state = None
+        if self.iterator is not None:
+            iterator_state = self.iterator.get_state(epoch, batch_index,
+                                                     self._total_batches)
+
+        job = (filepaths, snapshot_model(self.model), meta, iterator_state)
+
+        if self._queue is not None:
+            self._queue.put(job)
+        else:
+            self._write(*job)
+
+    def _write(self, filepaths, snapshot, meta, iterator_state):
+        write_snapshot(filepaths[0], snapshot, meta, iterator_state)
+        for filepath in filepaths[1:]:
+            if filepath != filepaths[0]:
+                _copy_file(filepaths[0], filepath)
+
+    def _write_loop(self):
+        while True:
+            job = self._queue.get()
+            try:
+                if job is not None:
+                    self._write(*job)
+            except Exception as e:
+                self._logger.error('Failed to write %s: %s' % (job[0], e))
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+    def wait(self):
+        """ Blocks until every checkpoint is written
+        """
+        if self._queue is not None:
+            self._queue.join()
+
+        if self._error is not None:
+            raise self._error
+
+
+class StepValidation(callbacks.Callback):
+    """ Evaluates the model every `every` training batches on pre-assembled
+    batches (e.g. a fixed subsample of the validation set, see
+    DatasetIterator.cache). The metrics are logged and kept in history as
+    (batch, metrics) tuples
+
+    # Arguments
+        cache: instance of BatchCache
+        every: number of training batches between evaluations
+    """
+
+    def __init__(self, cache, every):
+        super(StepValidation, self).__init__()
+
+        self._logger = logging.getLogger('%s.%s' % (__name__,
+                                                    self.__class__.__name__))
+        self.cache = cache
+        self.every = every
+        self.history = []
+        self._total_batches = 0
+
+    def on_batch_end(self, batch, logs={}):
+        self._total_batches += 1
+
+        if self._total_batches % self.every:
+            return
+
+        totals, num_samples = 0., 0
+        for x, y in self.cache.batches:
+            outs = np.asarray(self.model.test_on_batch(x, y))
+            batch_size = len(x[-1])
+            totals = totals + outs * batch_size
+            num_samples += batch_size
+
+        metrics = dict(zip(['val_' + n for n in self.model.metrics_names],
+                           np.atleast_1d(totals / num_samples).tolist()))
+        self.history.append((self._total_batches, metrics))
+
+        self._logger.info('Batch %d: %s' % (
+            self._total_batches, ', '.join('%s: %.4f' % (k, metrics[k])
+                                           for k in sorted(metrics))))
+
+
+class SyncStopTraining(callbacks.Callback):
+    """ Ends the data-parallel training of every worker when a callback of
+    rank 0 (e.g. EarlyStopping) stops it. Keras only checks stop_training
+    at the end of each epoch, so the flag of rank 0 is broadcast there. It
+    must be the last callback of every worker
+
+    # Arguments
+        allreduce: instance of utils.distributed_utils.Allreduce
+    """
+
+    def __init__(self, allreduce):
+        super(SyncStopTraining, self).__init__()
+        self.allreduce = allreduce
+
+    def on_epoch_end(self, epoch, logs={}):
+        stop, = self.allreduce.broadcast(
+            [float(getattr(self.model, 'stop_training', False))])
+        self.model.stop_training = bool(stop)
 
 
 class ProgbarLogger(callbacks.ProgbarLogger):
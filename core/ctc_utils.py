@@ -4,7 +4,10 @@ import keras.backend as K
 import numpy as np
 import tensorflow as tf
 
+from utils.registry import CUSTOM_OBJECTS
 
+
+@CUSTOM_OBJECTS.register
 def decode(inputs, **kwargs):
     """ Decodes a sequence of probabilities choosing the path with highest
     probability of occur
@@ -52,11 +55,13 @@ def decode(inputs, **kwargs):
     return decoded
 
 
+@CUSTOM_OBJECTS.register
 def decode_output_shape(inputs_shape):
     y_pred_shape, seq_len_shape = inputs_shape
     return (y_pred_shape[:1], None)
 
 
+@CUSTOM_OBJECTS.register
 def ctc_lambda_func(args):
     """ CTC cost function
     """
@@ -70,12 +75,14 @@ def ctc_lambda_func(args):
                           inputs_length[:, 0])
 
 
+@CUSTOM_OBJECTS.register
 def ctc_dummy_loss(y_true, y_pred):
     """ Little hack to make CTC working with Keras
     """
     return y_pred
 
 
+@CUSTOM_OBJECTS.register
 def decoder_dummy_loss(y_true, y_pred):
     """ Little hack to make CTC working with Keras
     """
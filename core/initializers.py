@@ -2,7 +2,10 @@ import numpy as np
 
 import keras.backend as K
 
+from utils.registry import CUSTOM_OBJECTS
 
+
+@CUSTOM_OBJECTS.register
 def k_init(k):
     def init(shape, name=None):
         return K.variable(k*np.ones(shape), dtype='float32',
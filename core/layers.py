@@ -12,15 +12,20 @@ from keras.engine import Layer, InputSpec
 
 from .layers_utils import highway_bias_initializer
 from .layers_utils import layer_normalization
+from .layers_utils import normalize
 from .layers_utils import multiplicative_integration_init
 from .layers_utils import multiplicative_integration
 from .layers_utils import zoneout
+from .layers_utils import length_aware_rnn
 
 from .initializers import k_init
 
+from utils.registry import CUSTOM_OBJECTS
+
 import logging
 
 
+@CUSTOM_OBJECTS.register
 class LayerNormalization(Layer):
     '''Normalize from all of the summed inputs to the neurons in a layer on
     a single training case. Unlike batch normalization, layer normalization
@@ -89,6 +94,340 @@ class LayerNormalization(Layer):
         return dict(list(base_config.items()) + list(config.items()))
 
 
+@CUSTOM_OBJECTS.register
+class LengthMasking(Layer):
+    '''Masks the timesteps after the end of each sequence.
+
+    The custom recurrent layers (LSTM and RHN) use the mask to run in
+    length-aware mode: they skip the padded timesteps and the backward
+    direction only reverses the valid region of each sequence (see
+    `layers_utils.length_aware_rnn`).
+
+    # Input
+        A list [x, inputs_length], where x is a tensor (N, T, F) and
+        inputs_length is a tensor (N, 1) with the length of each sequence
+
+    # Output shape
+        Same shape as x.
+    '''
+    def __init__(self, **kwargs):
+        super(LengthMasking, self).__init__(**kwargs)
+
+    def call(self, x, mask=None):
+        return x[0]
+
+    def compute_mask(self, x, mask=None):
+        inputs, inputs_length = x
+        return tf.sequence_mask(K.cast(inputs_length[:, 0], 'int32'),
+                                maxlen=K.shape(inputs)[1])
+
+    def get_output_shape_for(self, input_shape):
+        return input_shape[0]
+
+
+@CUSTOM_OBJECTS.register
+class ClearMask(Layer):
+    '''Removes the mask of its input, so it can be fed to layers that do not
+    support masking (e.g. the ctc and decoder lambdas).
+    '''
+    def __init__(self, **kwargs):
+        self.supports_masking = True
+        super(ClearMask, self).__init__(**kwargs)
+
+    def call(self, x, mask=None):
+        return x
+
+    def compute_mask(self, x, mask=None):
+        return None
+
+
+@CUSTOM_OBJECTS.register
+class FusedDense(Layer):
+    '''Densely-connected layer fused with a clipped relu and dropout.
+
+    It is applied directly over the last axis of a 3D tensor, so it replaces
+    `TimeDistributed(Dense)`, `TimeDistributed(Activation)` and
+    `TimeDistributed(Dropout)` without their intermediate tensors and
+    reshapes.
+
+    # Arguments
+        output_dim: int > 0.
+        max_value: float. The activation is min(max(x, 0), max_value)
+        dropout: float between 0 and 1. Fraction of the output units to drop.
+        init: name of initialization function for the weights of the layer
+        W_regularizer: instance of [WeightRegularizer](../regularizers.md)
+            applied to the main weights matrix.
+        b_regularizer: instance of [WeightRegularizer](../regularizers.md),
+            applied to the bias.
+
+    # Input shape
+        3D tensor with shape: `(samples, timesteps, input_dim)`.
+
+    # Output shape
+        3D tensor with shape: `(samples, timesteps, output_dim)`.
+    '''
+    def __init__(self, output_dim, max_value=20., dropout=0.,
+                 init='glorot_uniform', W_regularizer=None,
+                 b_regularizer=None, **kwargs):
+        self.output_dim = output_dim
+        self.max_value = max_value
+        self.dropout = dropout
+        self.init = initializations.get(init)
+        self.W_regularizer = regularizers.get(W_regularizer)
+        self.b_regularizer = regularizers.get(b_regularizer)
+
+        if 0. < self.dropout < 1.:
+            self.uses_learning_phase = True
+
+        self.supports_masking = True
+        self.input_spec = [InputSpec(ndim=3)]
+        super(FusedDense, self).__init__(**kwargs)
+
+    def build(self, input_shape):
+        self.input_spec = [InputSpec(shape=input_shape)]
+        input_dim = input_shape[2]
+
+        self.W = self.add_weight((input_dim, self.output_dim),
+                                 initializer=self.init,
+                                 name='{}_W'.format(self.name),
+                                 regularizer=self.W_regularizer)
+        self.b = self.add_weight((self.output_dim,),
+                                 initializer=initializations.get('zero'),
+                                 name='{}_b'.format(self.name),
+                                 regularizer=self.b_regularizer)
+        self.built = True
+
+    def call(self, x, mask=None):
+        output = K.relu(K.dot(x, self.W) + self.b, max_value=self.max_value)
+
+        if 0. < self.dropout < 1.:
+            output = K.in_train_phase(K.dropout(output, self.dropout), output)
+
+        return output
+
+    def get_output_shape_for(self, input_shape):
+        return input_shape[:2] + (self.output_dim,)
+
+    def get_config(self):
+        config = {'output_dim': self.output_dim,
+                  'max_value': self.max_value,
+                  'dropout': self.dropout,
+                  'init': self.init.__name__,
+                  'W_regularizer': self.W_regularizer.get_config() if
+                  self.W_regularizer else None,
+                  'b_regularizer': self.b_regularizer.get_config() if
+                  self.b_regularizer else None}
+        base_config = super(FusedDense, self).get_config()
+        return dict(list(base_config.items()) + list(config.items()))
+
+
+@CUSTOM_OBJECTS.register
+class FrameStack(Layer):
+    '''Stacks each `factor` consecutive frames into a single one, reducing
+    the number of timesteps by `factor` (the last frames are zero padded).
+
+    Used in front of the RNN stack (frame stacking with downsampling) or
+    between recurrent layers (pyramidal reduction). The mask, if any, is
+    reduced as well.
+
+    # Arguments
+        factor: int. Time reduction factor
+
+    # Input shape
+        3D tensor with shape: `(samples, timesteps, input_dim)`.
+
+    # Output shape
+        3D tensor with shape:
+        `(samples, ceil(timesteps / factor), factor * input_dim)`.
+    '''
+    def __init__(self, factor=2, **kwargs):
+        self.factor = factor
+        self.supports_masking = True
+        super(FrameStack, self).__init__(**kwargs)
+
+    def call(self, x, mask=None):
+        input_dim = K.int_shape(x)[-1]
+        pad = tf.mod(-K.shape(x)[1], self.factor)
+
+        x = tf.pad(x, [[0, 0], [0, pad], [0, 0]])
+        return K.reshape(x, (K.shape(x)[0], -1, self.factor * input_dim))
+
+    def compute_mask(self, x, mask=None):
+        if mask is None:
+            return None
+        # A stacked frame is valid if its first frame is valid
+        return mask[:, ::self.factor]
+
+    def get_output_shape_for(self, input_shape):
+        timesteps = input_shape[1]
+        if timesteps is not None:
+            timesteps = (timesteps + self.factor - 1) // self.factor
+        return (input_shape[0], timesteps, self.factor * input_shape[2])
+
+    def get_config(self):
+        config = {'factor': self.factor}
+        base_config = super(FrameStack, self).get_config()
+        return dict(list(base_config.items()) + list(config.items()))
+
+
+@CUSTOM_OBJECTS.register
+class LengthReduction(Layer):
+    '''Length of the sequences after a time reduction by `factor` (i.e. frame
+    stacking or a convolution with `border_mode='same'` and stride `factor`)
+
+    # Arguments
+        factor: int. Time reduction factor
+
+    # Input
+        inputs_length: tensor (N, 1)
+
+    # Output
+        ceil(inputs_length / factor)
+    '''
+    def __init__(self, factor=2, **kwargs):
+        self.factor = factor
+        super(LengthReduction, self).__init__(**kwargs)
+
+    def call(self, x, mask=None):
+        return (x + self.factor - 1) // self.factor
+
+    def get_config(self):
+        config = {'factor': self.factor}
+        base_config = super(LengthReduction, self).get_config()
+        return dict(list(base_config.items()) + list(config.items()))
+
+
+@CUSTOM_OBJECTS.register
+class SeparableConvolution1D(Layer):
+    '''Depthwise separable 1-D convolution: a depthwise convolution (one
+    filter per input channel) followed by a pointwise (1x1) convolution.
+
+    It needs `filter_length * input_dim + input_dim * nb_filter` weights
+    instead of `filter_length * input_dim * nb_filter`.
+
+    # Arguments
+        nb_filter: number of output channels.
+        filter_length: length of the depthwise filters.
+        subsample_length: stride of the convolution.
+        border_mode: 'valid' or 'same'.
+        activation: activation function.
+        init: weight initialization function.
+        W_regularizer: instance of [WeightRegularizer](../regularizers.md)
+            applied to the depthwise and pointwise weights.
+        bias: whether to include a bias.
+
+    # Input shape
+        3D tensor with shape: `(samples, steps, input_dim)`.
+
+    # Output shape
+        3D tensor with shape: `(samples, new_steps, nb_filter)`.
+    '''
+    def __init__(self, nb_filter, filter_length, subsample_length=1,
+                 border_mode='same', activation='linear',
+                 init='glorot_uniform', W_regularizer=None, bias=True,
+                 **kwargs):
+        if border_mode not in {'valid', 'same'}:
+            raise ValueError('Invalid border mode for SeparableConvolution1D:'
+                             ' %s' % border_mode)
+        self.nb_filter = nb_filter
+        self.filter_length = filter_length
+        self.subsample_length = subsample_length
+        self.border_mode = border_mode
+        self.activation = activations.get(activation)
+        self.init = initializations.get(init)
+        self.W_regularizer = regularizers.get(W_regularizer)
+        self.bias = bias
+        self.input_spec = [InputSpec(ndim=3)]
+        super(SeparableConvolution1D, self).__init__(**kwargs)
+
+    def build(self, input_shape):
+        self.input_spec = [InputSpec(shape=input_shape)]
+        input_dim = input_shape[2]
+
+        self.depthwise_W = self.add_weight(
+            (self.filter_length, input_dim), initializer=self.init,
+            name='{}_depthwise_W'.format(self.name),
+            regularizer=self.W_regularizer)
+        self.pointwise_W = self.add_weight(
+            (input_dim, self.nb_filter), initializer=self.init,
+            name='{}_pointwise_W'.format(self.name),
+            regularizer=self.W_regularizer)
+
+        if self.bias:
+            self.b = self.add_weight((self.nb_filter,),
+                                     initializer=initializations.get('zero'),
+                                     name='{}_b'.format(self.name))
+
+        self.built = True
+
+    def call(self, x, mask=None):
+        input_dim = K.int_shape(x)[-1]
+
+        depthwise = K.reshape(self.depthwise_W,
+                              (self.filter_length, 1, input_dim, 1))
+        pointwise = K.reshape(self.pointwise_W,
+                              (1, 1, input_dim, self.nb_filter))
+
+        output = tf.nn.separable_conv2d(
+            K.expand_dims(x, 2), depthwise, pointwise,
+            strides=(1, self.subsample_length, 1, 1),
+            padding=self.border_mode.upper())
+        output = K.squeeze(output, 2)
+
+        if self.bias:
+            output += self.b
+
+        return self.activation(output)
+
+    def get_output_shape_for(self, input_shape):
+        length = input_shape[1]
+        if length is not None:
+            if self.border_mode == 'valid':
+                length -= self.filter_length - 1
+            length = (length + self.subsample_length - 1) // \
+                self.subsample_length
+        return (input_shape[0], length, self.nb_filter)
+
+    def get_config(self):
+        config = {'nb_filter': self.nb_filter,
+                  'filter_length': self.filter_length,
+                  'subsample_length': self.subsample_length,
+                  'border_mode': self.border_mode,
+                  'activation': self.activation.__name__,
+                  'init': self.init.__name__,
+                  'W_regularizer': self.W_regularizer.get_config() if
+                  self.W_regularizer else None,
+                  'bias': self.bias}
+        base_config = super(SeparableConvolution1D, self).get_config()
+        return dict(list(base_config.items()) + list(config.items()))
+
+
+@CUSTOM_OBJECTS.register
+class AddChannel(Layer):
+    '''Adds a channel axis, so the features (N, T, F) can be fed to 2-D
+    convolutions (with `dim_ordering='tf'`) as a (N, T, F, 1) image
+    '''
+    def call(self, x, mask=None):
+        return K.expand_dims(x, -1)
+
+    def get_output_shape_for(self, input_shape):
+        return input_shape + (1,)
+
+
+@CUSTOM_OBJECTS.register
+class MergeChannels(Layer):
+    '''Merges the frequency and channel axes of the 2-D convolution outputs
+    (N, T, F, C) into (N, T, F * C)
+    '''
+    def call(self, x, mask=None):
+        _, _, freq, channels = K.int_shape(x)
+        return K.reshape(x, (K.shape(x)[0], K.shape(x)[1], freq * channels))
+
+    def get_output_shape_for(self, input_shape):
+        return input_shape[:2] + (input_shape[2] * input_shape[3],)
+
+
+@CUSTOM_OBJECTS.register
 class RHN(Recurrent):
     '''Recurrent Highway Network - Julian Georg Zilly, Rupesh Kumar Srivastava,
     Jan Koutník, Jürgen Schmidhuber - 2016.
@@ -251,24 +590,43 @@ class RHN(Recurrent):
         else:
             self.states = [K.zeros((input_shape[0], self.output_dim))]
 
+    def call(self, x, mask=None):
+        if mask is None or self.stateful:
+            return super(RHN, self).call(x, mask)
+
+        last_output, outputs = length_aware_rnn(
+            self.step, self.preprocess_input(x), self.get_initial_states(x),
+            mask, constants=self.get_constants(x),
+            go_backwards=self.go_backwards)
+
+        return outputs if self.return_sequences else last_output
+
+    def preprocess_input(self, x):
+        """ Input projection of all timesteps in a single matmul, so the scan
+        only computes the recurrent term
+        """
+        if 0 < self.dropout_W < 1:
+            ones = K.ones_like(x[:, 0, :])
+            B_W = K.in_train_phase(K.dropout(ones, self.dropout_W), ones)
+            x = x * K.expand_dims(B_W, 1)
+
+        return K.dot(x, self.W)
+
     def step(self, x, states):
         s_tm1 = states[0]
 
         for layer in xrange(self.depth):
-            B_U = states[layer + 1][0]
+            B_U = states[layer + 1]
             U, b = self.Us[layer], self.bs[layer]
 
-            if layer == 0:
-                B_W = states[layer + 1][1]
-                Wx = K.dot(x * B_W, self.W)
-            else:
-                Wx = 0
+            # x is the input projection (see preprocess_input)
+            Wx = x if layer == 0 else 0
 
             Us = K.dot(s_tm1 * B_U, U)
 
             if self.mi:
-                a = multiplicative_integration(Wx, Us,
-                                               self.mi_params[layer]) + b
+                a = multiplicative_integration(Wx, Us, self.mi_params[layer],
+                                               has_input=(layer == 0)) + b
             else:
                 a = Wx + Us + b
 
@@ -279,7 +637,7 @@ class RHN(Recurrent):
 
             if self.has_layer_norm:
                 ln_gains, ln_biases = self.ln_weights[layer]
-                a0 = LN(a0, ln_gains[0], ln_biases[0])
+                a0 = layer_normalization(a0, ln_gains[0], ln_biases[0])
                 # a1 = LN(a1, ln_gains[1], ln_biases[1])
                 # if not self.coupling:
                 #     a2 = LN(a2, ln_gains[2], ln_biases[2])
@@ -300,31 +658,17 @@ class RHN(Recurrent):
         return s, [s]
 
     def get_constants(self, x):
+        # Input dropout is applied in preprocess_input
         constants = []
 
         for layer in xrange(self.depth):
-            constant = []
             if 0 < self.dropout_U < 1:
                 ones = K.ones_like(K.reshape(x[:, 0, 0], (-1, 1)))
                 ones = K.tile(ones, (1, self.output_dim))
                 B_U = K.in_train_phase(K.dropout(ones, self.dropout_U), ones)
-                constant.append(B_U)
+                constants.append(B_U)
             else:
-                constant.append(K.cast_to_floatx(1.))
-
-            if layer == 0:
-                if 0 < self.dropout_W < 1:
-                    input_shape = self.input_spec[0].shape
-                    input_dim = input_shape[-1]
-                    ones = K.ones_like(K.reshape(x[:, 0, 0], (-1, 1)))
-                    ones = K.tile(ones, (1, input_dim))
-                    B_W = K.in_train_phase(K.dropout(ones,
-                                                     self.dropout_W), ones)
-                    constant.append(B_W)
-                else:
-                    constant.append(K.cast_to_floatx(1.))
-
-            constants.append(constant)
+                constants.append(K.cast_to_floatx(1.))
 
         return constants
 
@@ -353,6 +697,7 @@ class RHN(Recurrent):
         return dict(list(base_config.items()) + list(config.items()))
 
 
+@CUSTOM_OBJECTS.register
 class LSTM(keras_layers.LSTM):
     """
     # Arguments
@@ -429,20 +774,72 @@ to option `gpu`.")
 
         return layer_normalization(x, gain, bias)
 
+    def call(self, x, mask=None):
+        if mask is None or self.stateful:
+            return super(LSTM, self).call(x, mask)
+
+        last_output, outputs = length_aware_rnn(
+            self.step, self.preprocess_input(x), self.get_initial_states(x),
+            mask, constants=self.get_constants(x),
+            go_backwards=self.go_backwards)
+
+        return outputs if self.return_sequences else last_output
+
+    def preprocess_input(self, x):
+        """ Input projection (with its dropout and layer normalization) of
+        all timesteps in a single matmul, so the scan only computes the
+        recurrent term. With multiplicative integration, the output holds
+        `alpha * Wx + beta1` and `beta2 * Wx + b` concatenated.
+
+        The gain and bias of the Uh layer normalization are merged into these
+        terms, so the scan only normalizes Uh
+        """
+        if 0 < self.dropout_W < 1:
+            ones = K.ones_like(x[:, 0, :])
+            B_W = K.in_train_phase(K.dropout(ones, self.dropout_W), ones)
+            x = x * K.expand_dims(B_W, 1)
+
+        Wx = self._layer_norm(K.dot(x, self.W), 'Wx')
+
+        if self.mi is not None:
+            # z = (alpha * Wx + beta1) * Uh + (beta2 * Wx + b)
+            scale = self.mi_alpha * Wx + self.mi_beta1
+            shift = self.mi_beta2 * Wx + self.b
+
+            if self.layer_norm is not None:
+                gain, bias = self.layer_norm_params['Uh']
+                shift += scale * bias
+                scale *= gain
+
+            return K.concatenate([scale, shift])
+
+        if self.layer_norm is not None:
+            return Wx + self.b + self.layer_norm_params['Uh'][1]
+
+        return Wx + self.b
+
+    def get_constants(self, x):
+        # Input dropout is applied in preprocess_input
+        return super(LSTM, self).get_constants(x)[:1]
+
     def step(self, x, states):
         h_tm1 = states[0]
         c_tm1 = states[1]
         B_U = states[2]
-        B_W = states[3]
 
-        Uh = self._layer_norm(K.dot(h_tm1 * B_U[0], self.U), 'Uh')
-        Wx = self._layer_norm(K.dot(x * B_W[0], self.W), 'Wx')
+        Uh = K.dot(h_tm1 * B_U[0], self.U)
+
+        if self.layer_norm is not None:
+            # The bias (and, with mi, the gain) are merged into x
+            Uh = normalize(Uh)
+            if self.mi is None:
+                Uh *= self.layer_norm_params['Uh'][0]
 
+        # x is the input projection (see preprocess_input)
         if self.mi is not None:
-            z = self.mi_alpha * Wx * Uh + self.mi_beta1 * Uh + \
-                self.mi_beta2 * Wx + self.b
+            z = x[:, :4 * self.output_dim] * Uh + x[:, 4 * self.output_dim:]
         else:
-            z = Wx + Uh + self.b
+            z = x + Uh
 
         z_i = z[:, :self.output_dim]
         z_f = z[:, self.output_dim: 2 * self.output_dim]
@@ -479,6 +876,7 @@ to option `gpu`.")
         return dict(list(base_config.items()) + list(config.items()))
 
 
+@CUSTOM_OBJECTS.register
 def recurrent(output_dim, model='keras_lstm', activation='tanh',
               regularizer=None, dropout=0., **kwargs):
     if model == 'rnn':
@@ -8,17 +8,31 @@ from keras import activations, initializations, regularizers
 from keras.layers import GRU, SimpleRNN
 from keras.layers import LSTM as keras_LSTM
 
+from utils.registry import CUSTOM_OBJECTS
 
+
+@CUSTOM_OBJECTS.register
 def highway_bias_initializer(shape, name=None):
     return -2 * initializations.one(shape, name=name)
 
 
+@CUSTOM_OBJECTS.register
+def normalize(x, epsilon=1e-5):
+    # Normalizes over the last axis, so it also works over all timesteps. The
+    # mean and the mean of squares are reduced in a single pass over x
+    axis = K.ndim(x) - 1
+    mean = K.mean(x, axis=axis, keepdims=True)
+    mean_sq = K.mean(K.square(x), axis=axis, keepdims=True)
+    var = K.maximum(mean_sq - K.square(mean), 0.)
+    return (x - mean) * tf.rsqrt(var + epsilon)
+
+
+@CUSTOM_OBJECTS.register
 def layer_normalization(x, gain, bias, epsilon=1e-5):
-    mean, std = tf.nn.moments(x, [1], keep_dims=True)
-    x_normed = (x - mean) / K.sqrt(std + epsilon) * gain + bias
-    return x_normed
+    return normalize(x, epsilon) * gain + bias
 
 
+@CUSTOM_OBJECTS.register
 def multiplicative_integration_init(shape, alpha_init='one',
                                     beta1_init='one', beta2_init='one',
                                     name='mi', has_input=True):
@@ -31,6 +45,13 @@ def multiplicative_integration_init(shape, alpha_init='one',
     return beta1
 
 
+@CUSTOM_OBJECTS.register
+def clipped_relu(x, max_value=20.):
+    '''ReLU clipped at max_value (20 by default, as in Deep Speech)'''
+    return K.relu(x, max_value=max_value)
+
+
+@CUSTOM_OBJECTS.register
 def zoneout(level, h_tm1, h, noise_shape):
     '''Apply a zoneout function to preserve a fraction of values from h_tm1 in
     h.'''
@@ -42,6 +63,7 @@ def zoneout(level, h_tm1, h, noise_shape):
     return h
 
 
+@CUSTOM_OBJECTS.register
 def multiplicative_integration(Wx, Uz, params, has_input=True):
     if has_input:
         alpha, beta1, beta2 = params
@@ -51,16 +73,111 @@ def multiplicative_integration(Wx, Uz, params, has_input=True):
     return beta1 * Uz
 
 
+def _map_batch(fn, x):
+    ''' Applies fn to every batch tensor in a (nested) list of constants
+    '''
+    if isinstance(x, (list, tuple)):
+        return [_map_batch(fn, i) for i in x]
+    if hasattr(x, 'get_shape') and x.get_shape().ndims:
+        return fn(x)
+    return x
+
+
+@CUSTOM_OBJECTS.register
+def length_aware_rnn(step_function, inputs, initial_states, mask,
+                     constants=None, go_backwards=False):
+    ''' Iterates over the time dimension like `K.rnn`, but aware of the length
+    of each sequence (given by the mask, with the padding at the end).
+
+    Sequences are sorted by length, so at each timestep only the sequences
+    that did not end yet are computed and the scan stops at the longest one.
+    If go_backwards is True, only the valid region of each sequence is
+    reversed, so the backward recurrence never starts inside the padding.
+
+    # Outputs
+        A tuple (last_output, outputs). The first state must be the output of
+        the step function. outputs is zero in the padded timesteps and follows
+        the `K.rnn` convention (it is reversed in time if go_backwards)
+    '''
+    constants = constants or []
+    uses_learning_phase = [getattr(inputs, '_uses_learning_phase', False)]
+
+    lengths = tf.reduce_sum(tf.cast(mask, 'int32'), 1)
+    batch_size = tf.shape(inputs)[0]
+    num_timesteps = tf.shape(inputs)[1]
+
+    if go_backwards:
+        inputs = tf.reverse_sequence(inputs, lengths, 1, 0)
+
+    # Longest sequences first
+    _, order = tf.nn.top_k(lengths, k=batch_size, sorted=True)
+    inputs = tf.transpose(tf.gather(inputs, order), [1, 0, 2])
+    lengths_sorted = tf.gather(lengths, order)
+    states = [tf.gather(s, order) for s in initial_states]
+    constants = _map_batch(lambda c: tf.gather(c, order), constants)
+
+    # Number of sequences that did not end at each timestep
+    max_len = lengths_sorted[0]
+    num_active = tf.reduce_sum(
+        tf.cast(tf.expand_dims(lengths_sorted, 0) >
+                tf.expand_dims(tf.range(max_len), 1), 'int32'), 1)
+
+    output_ta = tf.TensorArray(dtype=inputs.dtype, size=max_len)
+
+    def _step(time, output_ta_t, *states):
+        n = num_active[time]
+
+        output, new_states = step_function(
+            inputs[time][:n],
+            [s[:n] for s in states] + _map_batch(lambda c: c[:n],
+                                                 constants))
+        if getattr(output, '_uses_learning_phase', False):
+            uses_learning_phase[0] = True
+
+        new_states = [tf.concat([new_s, s[n:]], 0)
+                      for new_s, s in zip(new_states, states)]
+        output = tf.concat([output, tf.zeros(
+            tf.stack([batch_size - n, tf.shape(output)[1]]),
+            dtype=output.dtype)], 0)
+
+        return (time + 1, output_ta_t.write(time, output)) + tuple(new_states)
+
+    final_outputs = tf.while_loop(
+        cond=lambda time, *_: time < max_len,
+        body=_step,
+        loop_vars=(tf.constant(0, dtype='int32'), output_ta) + tuple(states),
+        swap_memory=True)
+
+    outputs = final_outputs[1].stack()
+    outputs = tf.pad(outputs, [[0, num_timesteps - max_len], [0, 0], [0, 0]])
+    outputs = tf.transpose(outputs, [1, 0, 2])
+
+    # Restoring the original order
+    inv_order = tf.invert_permutation(order)
+    outputs = tf.gather(outputs, inv_order)
+    last_output = tf.gather(final_outputs[2], inv_order)
+
+    if go_backwards:
+        outputs = K.reverse(tf.reverse_sequence(outputs, lengths, 1, 0), 1)
+
+    last_output._uses_learning_phase = uses_learning_phase[0]
+    outputs._uses_learning_phase = uses_learning_phase[0]
+
+    return last_output, outputs
+
+
+@CUSTOM_OBJECTS.register
 def to_dense(x):
     if K.is_sparse(x):
         return tf.sparse_tensor_to_dense(x, default_value=-1)
     return x
 
 
+@CUSTOM_OBJECTS.register
 def to_dense_output_shape(input_shape):
     return input_shape
 
 
-LN = layer_normalization
-mi = multiplicative_integration
-mi_init = multiplicative_integration_init
+LN = CUSTOM_OBJECTS.register(layer_normalization, 'LN')
+mi = CUSTOM_OBJECTS.register(multiplicative_integration, 'mi')
+mi_init = CUSTOM_OBJECTS.register(multiplicative_integration_init, 'mi_init')
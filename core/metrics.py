@@ -1,6 +1,9 @@
 import tensorflow as tf
 
+from utils.registry import CUSTOM_OBJECTS
 
+
+@CUSTOM_OBJECTS.register
 def ler(y_true, y_pred, **kwargs):
     """
         Label Error Rate. For more information see 'tf.edit_distance'
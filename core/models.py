@@ -4,6 +4,7 @@ from __future__ import print_function
 
 import core.ctc_utils as ctc_utils
 from utils.hparams import HParams
+from utils.registry import MODELS
 
 import keras
 import keras.backend as K
@@ -16,43 +17,102 @@ from keras.layers import Input
 from keras.layers import GaussianNoise
 from keras.layers import TimeDistributed
 from keras.layers import Dense
+from keras.layers import Activation
+from keras.layers import SimpleRNN
 from .layers import LSTM
 from keras.layers import Masking
 from keras.layers import Bidirectional
 from keras.layers import Lambda
 from keras.layers import Dropout
 from keras.layers import merge
+from keras.layers import Convolution1D
+from keras.layers import Convolution2D
 
 from keras.regularizers import l1, l2, l1l2
 
 from .layers import recurrent
+from .layers import FusedDense
+from .layers_utils import clipped_relu
+from .layers import LengthMasking
+from .layers import ClearMask
+from .layers import FrameStack
+from .layers import LengthReduction
+from .layers import SeparableConvolution1D
+from .layers import AddChannel
+from .layers import MergeChannels
 
 
-def ctc_model(inputs, output, **kwargs):
+def length_input():
+    return Input(name='inputs_length', shape=(None,), dtype='int32')
+
+
+def _has_mask(x):
+    layer, node_index, tensor_index = x._keras_history
+    return layer.inbound_nodes[node_index].output_masks[tensor_index] \
+        is not None
+
+
+def ctc_model(inputs, output, inputs_length=None, output_length=None,
+              **kwargs):
     """ Given the input and output returns a model appending ctc_loss, the
     decoder, labels, and inputs_length
 
     # Arguments
+        inputs_length: the inputs_length placeholder, if it was already used
+        by the network (e.g. in length-aware mode). Otherwise, it is created.
+        output_length: length of the output sequences, if the network reduces
+        the number of timesteps (see time_reduction). Defaults to
+        inputs_length
         see core.ctc_utils.layer_utils.decode for more arguments
     """
 
     # Define placeholders
     labels = Input(name='labels', shape=(None,), dtype='int32', sparse=True)
-    inputs_length = Input(name='inputs_length', shape=(None,), dtype='int32')
+    if inputs_length is None:
+        inputs_length = length_input()
+
+    # The ctc and decoder lambdas do not support masking
+    if _has_mask(output):
+        output = ClearMask()(output)
+
+    if output_length is None:
+        output_length = inputs_length
 
     # Define a decoder
     dec = Lambda(ctc_utils.decode, output_shape=ctc_utils.decode_output_shape,
                  arguments={'is_greedy': True}, name='decoder')
-    y_pred = dec([output, inputs_length])
+    y_pred = dec([output, output_length])
 
     ctc = Lambda(ctc_utils.ctc_lambda_func, output_shape=(1,), name="ctc")
     # Define loss as a layer
-    loss = ctc([output, labels, inputs_length])
+    loss = ctc([output, labels, output_length])
 
     return Model(input=[inputs, labels, inputs_length], output=[loss, y_pred])
 
 
-def graves2006(num_features=26, num_hiddens=100, num_classes=28, std=.6):
+def time_reduction(o, inputs_length, factor, conv=None, **kwargs):
+    """ Reduces the number of timesteps of o by factor, either stacking the
+    frames or with a strided 1-D convolution with `conv` filters
+
+    # Outputs
+        a tuple (o, inputs_length) with the reduced output and lengths
+    """
+    if conv:
+        o = Convolution1D(conv, kwargs.pop('filter_length', 2 * factor + 1),
+                          border_mode='same', subsample_length=factor,
+                          **kwargs)(o)
+    elif factor > 1:
+        o = FrameStack(factor)(o)
+
+    if factor > 1:
+        inputs_length = LengthReduction(factor)(inputs_length)
+
+    return o, inputs_length
+
+
+@MODELS.register
+def graves2006(num_features=26, num_hiddens=100, num_classes=28, std=.6,
+               length_aware=False):
     """ Implementation of Graves' model
     Reference:
         [1] Graves, Alex, et al. "Connectionist temporal classification:
@@ -64,16 +124,23 @@ def graves2006(num_features=26, num_hiddens=100, num_classes=28, std=.6):
     x = Input(name='inputs', shape=(None, num_features))
     o = x
 
+    inputs_length = None
+    if length_aware:
+        inputs_length = length_input()
+        o = LengthMasking()([o, inputs_length])
+
     o = GaussianNoise(std)(o)
     o = Bidirectional(LSTM(num_hiddens,
                       return_sequences=True,
                       consume_less='gpu'))(o)
     o = TimeDistributed(Dense(num_classes))(o)
 
-    return ctc_model(x, o)
+    return ctc_model(x, o, inputs_length=inputs_length)
 
 
-def eyben(num_features=39, num_hiddens=[78, 120, 27], num_classes=28):
+@MODELS.register
+def eyben(num_features=39, num_hiddens=[78, 120, 27], num_classes=28,
+          length_aware=False):
     """ Implementation of Eybens' model
     Reference:
         [1] Eyben, Florian, et al. "From speech to letters-using a novel neural
@@ -87,6 +154,11 @@ def eyben(num_features=39, num_hiddens=[78, 120, 27], num_classes=28):
     x = Input(name='inputs', shape=(None, num_features))
     o = x
 
+    inputs_length = None
+    if length_aware:
+        inputs_length = length_input()
+        o = LengthMasking()([o, inputs_length])
+
     if num_hiddens[0]:
         o = TimeDistributed(Dense(num_hiddens[0]))(o)
     if num_hiddens[1]:
@@ -100,11 +172,37 @@ def eyben(num_features=39, num_hiddens=[78, 120, 27], num_classes=28):
 
     o = TimeDistributed(Dense(num_classes))(o)
 
-    return ctc_model(x, o)
+    return ctc_model(x, o, inputs_length=inputs_length)
 
 
+def dense_block(o, num_hiddens, max_value=20, dropout=0., fused=True):
+    """ Dense layer with clipped relu (and dropout) applied to all timesteps
+    """
+    if fused:
+        return FusedDense(num_hiddens, max_value=max_value, dropout=dropout)(o)
+
+    o = TimeDistributed(Dense(num_hiddens))(o)
+    o = TimeDistributed(Activation(clipped_relu_fn(max_value)))(o)
+    if dropout:
+        o = TimeDistributed(Dropout(dropout))(o)
+    return o
+
+
+def clipped_relu_fn(max_value):
+    """ Clipped relu activation. The default max_value is saved by name, so
+    the model can be loaded without custom objects
+    """
+    if max_value == 20:
+        return clipped_relu
+
+    def clipped_relu_(x):
+        return relu(x, max_value=max_value)
+    return clipped_relu_
+
+
+@MODELS.register
 def maas(num_features=81, num_classes=29, num_hiddens=1824, dropout=0.1,
-         max_value=20):
+         max_value=20, fused=True):
     """ Maas' model.
     Reference:
         [1] Maas, Andrew L., et al. "Lexicon-Free Conversational Speech
@@ -114,30 +212,23 @@ def maas(num_features=81, num_classes=29, num_hiddens=1824, dropout=0.1,
     x = Input(name='inputs', shape=(None, num_features))
     o = x
 
-    def clipped_relu(x):
-        return relu(x, max_value=max_value)
-
     # First layer
-    o = TimeDistributed(Dense(num_hiddens))(o)
-    o = TimeDistributed(Activation(clipped_relu))(o)
+    o = dense_block(o, num_hiddens, max_value, fused=fused)
 
     # Second layer
-    o = TimeDistributed(Dense(num_hiddens))(o)
-    o = TimeDistributed(Activation(clipped_relu))(o)
+    o = dense_block(o, num_hiddens, max_value, fused=fused)
 
     # Third layer
     o = Bidirectional(SimpleRNN(num_hiddens, return_sequences=True,
                                 dropout_W=dropout,
-                                activation=clipped_relu,
+                                activation=clipped_relu_fn(max_value),
                                 init='he_normal'), merge_mode='sum')(o)
 
     # Fourth layer
-    o = TimeDistributed(Dense(num_hiddens))(o)
-    o = TimeDistributed(Activation(clipped_relu))(o)
+    o = dense_block(o, num_hiddens, max_value, fused=fused)
 
     # Fifth layer
-    o = TimeDistributed(Dense(num_hiddens))(o)
-    o = TimeDistributed(Activation(clipped_relu))(o)
+    o = dense_block(o, num_hiddens, max_value, fused=fused)
 
     # Output layer
     o = TimeDistributed(Dense(num_classes))(o)
@@ -145,8 +236,9 @@ def maas(num_features=81, num_classes=29, num_hiddens=1824, dropout=0.1,
     return ctc_model(x, o)
 
 
+@MODELS.register
 def deep_speech(num_features=81, num_classes=29, num_hiddens=2048, dropout=0.1,
-                max_value=20):
+                max_value=20, fused=True):
     """ Deep Speech model.
 
         Contains five layers: 3 FC - BRNN - 1 FC
@@ -171,6 +263,9 @@ def deep_speech(num_features=81, num_classes=29, num_hiddens=2048, dropout=0.1,
         * Speaker adaptation - none
         * Hidden units: 2560
         * Essemble of 6 networks
+    Note:
+        With fused=True (default), each dense block is a single FusedDense
+        layer (dense, clipped relu and dropout)
     Reference:
         [1] HANNUN, A. Y. et al. Deep Speech: Scaling up end-to-end speech
         recognition. arXiV, 2014.
@@ -178,35 +273,24 @@ def deep_speech(num_features=81, num_classes=29, num_hiddens=2048, dropout=0.1,
     x = Input(name='inputs', shape=(None, num_features))
     o = x
 
-    def clipped_relu(x):
-        return relu(x, max_value=max_value)
-
     # First layer
-    o = TimeDistributed(Dense(num_hiddens))(o)
-    o = TimeDistributed(Activation(clipped_relu))(o)
-    o = TimeDistributed(Dropout(dropout))(o)
+    o = dense_block(o, num_hiddens, max_value, dropout, fused=fused)
 
     # Second layer
-    o = TimeDistributed(Dense(num_hiddens))(o)
-    o = TimeDistributed(Activation(clipped_relu))(o)
-    o = TimeDistributed(Dropout(dropout))(o)
+    o = dense_block(o, num_hiddens, max_value, dropout, fused=fused)
 
     # Third layer
-    o = TimeDistributed(Dense(num_hiddens))(o)
-    o = TimeDistributed(Activation(clipped_relu))(o)
-    o = TimeDistributed(Dropout(dropout))(o)
+    o = dense_block(o, num_hiddens, max_value, dropout, fused=fused)
 
     # Fourth layer
     o = Bidirectional(SimpleRNN(num_hiddens, return_sequences=True,
                                 dropout_W=dropout,
-                                activation=clipped_relu,
+                                activation=clipped_relu_fn(max_value),
                                 init='he_normal'), merge_mode='sum')(o)
-    o = TimeDistributed(Dropout(dropout))(o)
+    o = Dropout(dropout)(o)
 
     # Fifth layer
-    o = TimeDistributed(Dense(num_hiddens))(o)
-    o = TimeDistributed(Activation(clipped_relu))(o)
-    o = TimeDistributed(Dropout(dropout))(o)
+    o = dense_block(o, num_hiddens, max_value, dropout, fused=fused)
 
     # Output layer
     o = TimeDistributed(Dense(num_classes))(o)
@@ -214,10 +298,12 @@ def deep_speech(num_features=81, num_classes=29, num_hiddens=2048, dropout=0.1,
     return ctc_model(x, o)
 
 
+@MODELS.register
 def brsmv1(num_features=39, num_classes=28, num_hiddens=256, num_layers=5,
            dropout=0.2, zoneout=0., input_dropout=False,
            input_std_noise=.0, weight_decay=1e-4, residual=None,
-           layer_norm=None, mi=None, activation='tanh'):
+           layer_norm=None, mi=None, activation='tanh', length_aware=False,
+           conv_frontend=None, frame_stack=None, pyramid=None):
     """ BRSM v1.0
     Improved features:
         * Residual connection
@@ -225,9 +311,20 @@ def brsmv1(num_features=39, num_classes=28, num_hiddens=256, num_layers=5,
         * Zoneout
         * Layer Normalization
         * Multiplicative Integration
+        * Length-aware recurrence (skips the padded timesteps)
+        * Time reduction: strided convolutions, frame stacking and pyramidal
+        reduction between the recurrent layers
     Note:
         Dropout, zoneout and weight decay is tied through layers, in order to
         minimizing the number of hyper parameters
+    Time reduction:
+        conv_frontend: list of [nb_filter, filter_length, stride] of the 1-D
+        convolutions (with relu) in front of the RNN stack
+        frame_stack: stacks (and downsamples) this number of input frames
+        pyramid: list with the time reduction factor (frame stacking) before
+        each recurrent layer but the first, e.g. [2, 2, 1, 1]. The residual
+        connection is skipped where the number of features changes
+        The labels must not be longer than the reduced sequences
     Reference:
         [1] Gal, Y, "A Theoretically Grounded Application of Dropout in
         Recurrent Neural Networks", 2015.
@@ -247,9 +344,25 @@ def brsmv1(num_features=39, num_classes=28, num_hiddens=256, num_layers=5,
     x = Input(name='inputs', shape=(None, num_features))
     o = x
 
+    inputs_length = length_input()
+    output_length = inputs_length
+
     if input_std_noise is not None:
         o = GaussianNoise(input_std_noise)(o)
 
+    for nb_filter, filter_length, stride in conv_frontend or []:
+        o, output_length = time_reduction(o, output_length, stride,
+                                          conv=nb_filter,
+                                          filter_length=filter_length,
+                                          activation='relu',
+                                          W_regularizer=l2(weight_decay))
+
+    if frame_stack:
+        o, output_length = time_reduction(o, output_length, frame_stack)
+
+    if length_aware:
+        o = LengthMasking()([o, output_length])
+
     if residual is not None:
         o = TimeDistributed(Dense(num_hiddens*2,
                                   W_regularizer=l2(weight_decay)))(o)
@@ -257,7 +370,13 @@ def brsmv1(num_features=39, num_classes=28, num_hiddens=256, num_layers=5,
     if input_dropout:
         o = Dropout(dropout)(o)
 
+    pyramid = [1] + list(pyramid or [1] * (num_layers - 1))
+    assert len(pyramid) == num_layers
+
     for i, _ in enumerate(range(num_layers)):
+        if pyramid[i] > 1:
+            o, output_length = time_reduction(o, output_length, pyramid[i])
+
         new_o = Bidirectional(LSTM(num_hiddens,
                                    return_sequences=True,
                                    W_regularizer=l2(weight_decay),
@@ -270,7 +389,7 @@ def brsmv1(num_features=39, num_classes=28, num_hiddens=256, num_layers=5,
                                    layer_norm=layer_norm,
                                    activation=activation))(o)
 
-        if residual is not None:
+        if residual is not None and pyramid[i] == 1:
             o = merge([new_o,  o], mode=residual)
         else:
             o = new_o
@@ -278,4 +397,100 @@ def brsmv1(num_features=39, num_classes=28, num_hiddens=256, num_layers=5,
     o = TimeDistributed(Dense(num_classes,
                               W_regularizer=l2(weight_decay)))(o)
 
-    return ctc_model(x, o)
+    return ctc_model(x, o, inputs_length=inputs_length,
+                     output_length=output_length)
+
+
+@MODELS.register
+def convnet(num_features=39, num_classes=28, conv2d=None,
+            conv_layers=[[256, 11, 2], [256, 11, 1], [256, 11, 1]],
+            conv_type='conv', num_hiddens=256, num_layers=1, dropout=0.2,
+            weight_decay=1e-4, input_std_noise=.0, length_aware=False):
+    """ Convolutional front-end model
+    Topology:
+        * Optional 2-D convolutions over time and frequency
+        * Strided 1-D convolutions
+        * A thin BiLSTM stack or, if num_layers is 0, a fully convolutional
+        CTC head
+    Note:
+        The convolutions are computed over all timesteps at once and the
+        strides shorten the sequences seen by the recurrent layers, so it
+        trains much faster than the fully recurrent models on CPU
+    Arguments:
+        conv2d: list of [nb_filter, time_length, freq_length, time_stride,
+        freq_stride] of the 2-D convolutions
+        conv_layers: list of [nb_filter, filter_length, stride] of the 1-D
+        convolutions
+        conv_type: type of the 1-D convolutions. One of 'conv', 'separable'
+        (depthwise separable convolution) and 'gated' (gated linear unit)
+    Reference:
+        [1] Amodei, Dario, et al. "Deep speech 2: End-to-end speech
+        recognition in english and mandarin.", 2016.
+        [2] Chollet, Francois. "Xception: Deep Learning with Depthwise
+        Separable Convolutions.", 2016.
+        [3] Dauphin, Yann N., et al. "Language Modeling with Gated
+        Convolutional Networks.", 2016.
+    """
+    if conv_type not in ('conv', 'separable', 'gated'):
+        raise ValueError('Invalid conv_type %s' % conv_type)
+
+    x = Input(name='inputs', shape=(None, num_features))
+    o = x
+
+    inputs_length = length_input()
+    output_length = inputs_length
+
+    if input_std_noise is not None:
+        o = GaussianNoise(input_std_noise)(o)
+
+    if conv2d:
+        o = AddChannel()(o)
+        for nb_filter, time_length, freq_length, time_stride, freq_stride \
+                in conv2d:
+            o = Convolution2D(nb_filter, time_length, freq_length,
+                              subsample=(time_stride, freq_stride),
+                              border_mode='same', activation='relu',
+                              dim_ordering='tf',
+                              W_regularizer=l2(weight_decay))(o)
+            if time_stride > 1:
+                output_length = LengthReduction(time_stride)(output_length)
+        o = MergeChannels()(o)
+
+    for nb_filter, filter_length, stride in conv_layers:
+        conv_args = {'subsample_length': stride, 'border_mode': 'same',
+                     'W_regularizer': l2(weight_decay)}
+
+        if conv_type == 'separable':
+            o = SeparableConvolution1D(nb_filter, filter_length,
+                                       activation='relu', **conv_args)(o)
+        elif conv_type == 'gated':
+            a = Convolution1D(nb_filter, filter_length, **conv_args)(o)
+            b = Convolution1D(nb_filter, filter_length, activation='sigmoid',
+                              **conv_args)(o)
+            o = merge([a, b], mode='mul')
+        else:
+            o = Convolution1D(nb_filter, filter_length, activation='relu',
+                              **conv_args)(o)
+
+        if stride > 1:
+            output_length = LengthReduction(stride)(output_length)
+
+        if dropout:
+            o = Dropout(dropout)(o)
+
+    if length_aware:
+        o = LengthMasking()([o, output_length])
+
+    for i in range(num_layers):
+        o = Bidirectional(LSTM(num_hiddens,
+                               return_sequences=True,
+                               W_regularizer=l2(weight_decay),
+                               U_regularizer=l2(weight_decay),
+                               dropout_W=dropout,
+                               dropout_U=dropout))(o)
+
+    o = TimeDistributed(Dense(num_classes,
+                              W_regularizer=l2(weight_decay)))(o)
+
+    return ctc_model(x, o, inputs_length=inputs_length,
+                     output_length=output_length)
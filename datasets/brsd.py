@@ -7,12 +7,12 @@ from datasets import CSLU, VoxForge, Sid, LapsBM
 
 import os
 import re
-import librosa
 import codecs
 
-from utils.generic_utils import get_from_module
+from utils.registry import DATASETS
 
 
+@DATASETS.register
 class BRSD(DatasetParser):
     """ Brazilian Portuguese Speech dataset reader and parser
 
@@ -71,7 +71,7 @@ class BRSD(DatasetParser):
                 continue
 
             try:
-                dataset_cls = get_from_module('datasets*', name, regex=True)
+                dataset_cls = DATASETS.get(name)
                 dataset = dataset_cls(dataset_dir=path)
 
                 for d in dataset._iter():
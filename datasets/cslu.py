@@ -1,11 +1,12 @@
 from datasets import DatasetParser
+from utils.registry import DATASETS
 
 import os
 import re
-import librosa
 import codecs
 
 
+@DATASETS.register
 class CSLU(DatasetParser):
     """ CSLU Spoltech Port dataset reader and parser
 
@@ -19,6 +20,8 @@ class CSLU(DatasetParser):
         super(CSLU, self).__init__(dataset_dir, name, **kwargs)
 
     def _iter(self):
+        import librosa
+
         trans_directory = os.path.join(self.dataset_dir, 'trans')
 
         for speaker_path in os.listdir(trans_directory):
@@ -4,12 +4,13 @@ from keras.preprocessing.image import Iterator
 from keras.preprocessing.sequence import pad_sequences
 
 import scipy
-import librosa
 import h5py
 import numpy as np
 import codecs
 import json
 import os
+import pickle
+import threading
 
 import time
 
@@ -19,6 +20,24 @@ from utils import generic_utils as utils
 import logging
 
 
+def limit_generator(generator, num_samples):
+    """ Yields the batches of generator until num_samples samples
+
+    fit_generator loads the batches in advance and drops the ones that it
+    does not train, so the last batch is repeated afterwards instead of
+    consuming the next ones of the generator (e.g. when resuming an epoch
+    before calling fit_generator with the whole iterator)
+    """
+    batch = None
+    while num_samples > 0:
+        batch = next(generator)
+        num_samples -= len(batch[0][-1])
+        yield batch
+
+    while True:
+        yield batch
+
+
 class DatasetGenerator(object):
     """ Dataset generator that handles several forms of input and return an
     iterator over it. Only works for a CTC model
@@ -31,10 +50,20 @@ class DatasetGenerator(object):
         batch_size: number of samples per batch
         shuffle: reordering index per epoch. This avoid some bias in training
         seed: default None
+        shard: tuple (rank, num_shards). If set, the iterators only cover
+        the samples of the shard `rank` (see DatasetIterator)
+        loader_cpus: cores where the threads that load the batches are
+        pinned to (see DatasetIterator)
+        sortagrad: number of epochs iterated in ascending duration order
+        bucketing: if True, the batches (but not their samples) are
+        shuffled after the sortagrad epochs
+        initial_epoch: epoch of the first iteration (e.g. when resuming)
     """
 
     def __init__(self, input_parser=None, label_parser=None, batch_size=32,
-                 shuffle=True, seed=None, mode='train'):
+                 shuffle=True, seed=None, mode='train', shard=None,
+                 loader_cpus=None, sortagrad=0, bucketing=False,
+                 initial_epoch=0):
         self._logger = logging.getLogger('%s.%s' % (__name__,
                                                     self.__class__.__name__))
         self.input_parser = input_parser
@@ -43,6 +72,19 @@ class DatasetGenerator(object):
         self.shuffle = shuffle
         self.seed = seed
         self.mode = mode
+        self.shard = shard
+        self.loader_cpus = loader_cpus
+        self.sortagrad = sortagrad
+        self.bucketing = bucketing
+        self.initial_epoch = initial_epoch
+
+    def _iterator_kwargs(self):
+        return {'batch_size': self.batch_size, 'shuffle': self.shuffle,
+                'seed': self.seed, 'input_parser': self.input_parser,
+                'label_parser': self.label_parser, 'mode': self.mode,
+                'shard': self.shard, 'loader_cpus': self.loader_cpus,
+                'sortagrad': self.sortagrad, 'bucketing': self.bucketing,
+                'initial_epoch': self.initial_epoch}
 
     def flow_from_fname(self, fname, datasets=None):
         """ Returns an specific iterator given the filename
@@ -84,53 +126,34 @@ class DatasetGenerator(object):
 
     def flow_from_json(self, fname, dataset=None):
         """ Returns JSONIterator given the filename"""
-        return JSONIterator(
-            fname, dataset, batch_size=self.batch_size,
-            shuffle=self.shuffle, seed=self.seed,
-            input_parser=self.input_parser,
-            label_parser=self.label_parser,
-            mode=self.mode)
+        return JSONIterator(fname, dataset, **self._iterator_kwargs())
 
     def flow_from_dl(self, dl, dataset=None):
         """ Return DictListIterator given a list of dictionaries. Each
         dictionary must have the keys 'input' and 'label'
         """
-        return DictListIterator(dl, dataset, batch_size=self.batch_size,
-                                shuffle=self.shuffle, seed=self.seed,
-                                input_parser=self.input_parser,
-                                label_parser=self.label_parser,
-                                mode=self.mode)
+        return DictListIterator(dl, dataset, **self._iterator_kwargs())
 
     def flow_from_h5_group(self, h5_group=None):
         """ Returns H5Iterator given a h5group from a HDF5 data
         """
-        return H5Iterator(h5_group, batch_size=self.batch_size,
-                          shuffle=self.shuffle, seed=self.seed,
-                          input_parser=self.input_parser,
-                          label_parser=self.label_parser,
-                          mode=self.mode)
+        return H5Iterator(h5_group, **self._iterator_kwargs())
 
     def flow_from_h5_file(self, h5_file, dataset='/'):
         h5_f = h5py.File(h5_file, 'r')
-        return H5Iterator(h5_f[dataset], batch_size=self.batch_size,
-                          shuffle=self.shuffle, seed=self.seed,
-                          input_parser=self.input_parser,
-                          label_parser=self.label_parser,
-                          mode=self.mode)
+        return H5Iterator(h5_f[dataset], **self._iterator_kwargs())
 
     def flow(self, inputs, labels):
-        return DatasetIterator(inputs, labels, batch_size=self.batch_size,
-                               shuffle=self.shuffle, seed=self.seed,
-                               input_parser=self.input_parser,
-                               label_parser=self.label_parser,
-                               mode=self.mode)
+        return DatasetIterator(inputs, labels, **self._iterator_kwargs())
 
 
 class DatasetIterator(Iterator):
 
     def __init__(self, inputs, labels=None, batch_size=32, shuffle=False,
                  seed=None, input_parser=None, label_parser=None,
-                 standarize=None, mode='train'):
+                 standarize=None, mode='train', shard=None,
+                 loader_cpus=None, sortagrad=0, bucketing=False,
+                 initial_epoch=0):
         """ DatasetIterator iterates in a batch over a dataset and do some
         preprocessing on inputs and labels
 
@@ -149,6 +172,23 @@ class DatasetIterator(Iterator):
             standarize: if a set (mean, std), the input will be
             normalized
             mode: if 'predict', only the inputs is generated
+            shard: tuple (rank, num_shards). If set, only the samples
+            rank, rank + num_shards, ... are iterated. All shards have the
+            same size (the last len(inputs) % num_shards samples are
+            dropped), so each data-parallel worker runs the same number of
+            batches per epoch
+            loader_cpus: cores (list or taskset string) where each thread
+            that calls next() (e.g. the fit_generator workers) is pinned
+            to. Keep them disjoint from the compute cores (see setup_gpu)
+            sortagrad: number of epochs iterated in ascending `durations`
+            order (SortaGrad curriculum). Needs the durations of the
+            dataset (e.g. H5Iterator)
+            bucketing: if True, the epochs after the sortagrad ones iterate
+            over batches of samples with similar durations, in random order.
+            Otherwise, the samples are shuffled (if shuffle is True)
+            initial_epoch: epoch of the first iteration, so a resumed
+            training (see MetaCheckpoint) skips the finished sortagrad
+            epochs
         """
 
         if labels is not None and len(inputs) != len(labels):
@@ -171,14 +211,162 @@ class DatasetIterator(Iterator):
             logging.warning('Feature extractor is not None. It may slow down'
                             + ' training')
 
-        super(DatasetIterator, self).__init__(len(inputs), batch_size,
+        self.loader_cpus = utils.parse_cpus(loader_cpus)
+        self._pinned_threads = set()
+
+        self.sortagrad = sortagrad or 0
+        self.bucketing = bucketing
+        self.epoch = initial_epoch or 0
+        self._sorted_indices = None
+        # Orders of the last epochs (see get_state) and the resumed state
+        self._epoch_orders = {}
+        self._resume = None
+        self.seed = seed
+
+        self.shard = shard
+        self.indices = None
+        num_samples = len(inputs)
+
+        if shard is not None:
+            rank, num_shards = shard
+            num_samples = len(inputs) // num_shards
+            self.indices = np.arange(rank, len(inputs),
+                                     num_shards)[:num_samples]
+
+        super(DatasetIterator, self).__init__(num_samples, batch_size,
                                               shuffle, seed)
 
     @property
     def len(self):
-        """ Return the total size of dataset
+        """ Return the total size of dataset (or of its shard)
+        """
+        return self.n
+
+    def select(self, indices):
+        """ Restricts the iterator to some samples (e.g. the ones that were
+        not predicted yet) and restarts it
+
+        # Arguments
+            indices: indices of the samples (of the shard, if set)
+        """
+        indices = np.asarray(indices, dtype='int64')
+        if self.indices is not None:
+            indices = self.indices[indices]
+
+        self.indices = indices
+        self.n = len(indices)
+        self._sorted_indices = None
+        self.index_generator = self._flow_index(self.n, self.batch_size,
+                                                self.shuffle, self.seed)
+
+    def _flow_index(self, n, batch_size=32, shuffle=False, seed=None):
+        """ Same as keras Iterator._flow_index, but the order of each epoch
+        is given by _epoch_order
         """
-        return len(self.inputs)
+        self.reset()
+        while 1:
+            if seed is not None:
+                np.random.seed(seed + self.total_batches_seen)
+            if self.batch_index == 0:
+                if self._resume is not None:
+                    index_array, self.batch_index = self._resume
+                    self._resume = None
+                else:
+                    index_array = self._epoch_order(n, batch_size, shuffle)
+                # fit_generator loads up to max_q_size (10) batches before
+                # they are trained, so they may belong to the next epochs
+                self._epoch_orders[self.epoch] = index_array
+                self._epoch_orders.pop(self.epoch - 10, None)
+                self.epoch += 1
+            current_index = (self.batch_index * batch_size) % n
+            if n >= current_index + batch_size:
+                current_batch_size = batch_size
+                self.batch_index += 1
+            else:
+                current_batch_size = n - current_index
+                self.batch_index = 0
+            self.total_batches_seen += 1
+            yield (index_array[current_index:
+                               current_index + current_batch_size],
+                   current_index, current_batch_size)
+
+    def get_state(self, epoch, batch_index, total_batches_seen):
+        """ State of the iteration after batch_index batches of epoch were
+        trained (see restore_state)
+
+        # Arguments
+            epoch: current epoch
+            batch_index: number of trained batches of the epoch
+            total_batches_seen: number of trained batches since the first
+            epoch (the shuffling of keras is seeded with
+            seed + total_batches_seen)
+        """
+        state = {'epoch': epoch, 'batch_index': batch_index,
+                 'total_batches_seen': total_batches_seen,
+                 'permutation': None}
+        if self.seed is not None:
+            state['seed'] = self.seed
+        if batch_index:
+            state['permutation'] = self._epoch_orders[epoch]
+        return state
+
+    def restore_state(self, state):
+        """ Continues the iteration from a state returned by get_state. It
+        must be called before the first batch
+
+        # Outputs
+            number of remaining samples of the current epoch
+        """
+        if state.get('seed') != self.seed:
+            self._logger.warning('The seed of the iterator (%s) differs from '
+                                 'the saved one (%s)' % (self.seed,
+                                                         state.get('seed')))
+
+        self.epoch = state['epoch']
+        self.total_batches_seen = state['total_batches_seen']
+
+        if not state['batch_index']:
+            return self.n
+
+        permutation = np.asarray(state['permutation'])
+        if len(permutation) != self.n:
+            raise ValueError('The saved permutation has %d samples, but the '
+                             'dataset has %d' % (len(permutation), self.n))
+
+        self._resume = (permutation, state['batch_index'])
+
+        return self.n - state['batch_index'] * self.batch_size
+
+    def _epoch_order(self, n, batch_size, shuffle):
+        if self.epoch < self.sortagrad:
+            self._logger.debug('Epoch %d sorted by duration' % self.epoch)
+            return self._sorted_by_duration()
+
+        if self.bucketing:
+            sorted_indices = self._sorted_by_duration()
+            batches = [sorted_indices[i: i + batch_size]
+                       for i in range(0, n, batch_size)]
+            # The last (and maybe smaller) batch is kept at the end
+            order = np.random.permutation(len(batches) - 1)
+            return np.concatenate([batches[i] for i in order] +
+                                  [batches[-1]])
+
+        if shuffle:
+            return np.random.permutation(n)
+
+        return np.arange(n)
+
+    def _sorted_by_duration(self):
+        if self._sorted_indices is None:
+            durations = getattr(self, 'durations', None)
+            if durations is None:
+                raise ValueError('sortagrad and bucketing need the '
+                                 'durations of the dataset')
+            durations = np.asarray(durations[:])
+            if self.indices is not None:
+                durations = durations[self.indices]
+            self._sorted_indices = np.argsort(durations, kind='mergesort')
+        return self._sorted_indices
 
     def next(self):
         """ Iterates over batches
@@ -192,11 +380,17 @@ class DatasetIterator(Iterator):
                 model
         """
 
+        if self.loader_cpus:
+            self._pin_thread()
+
         # Copy from DirectoryIterator from keras
         with self.lock:
             index_array, current_index, current_batch_size = next(
                 self.index_generator)
 
+        if self.indices is not None:
+            index_array = self.indices[index_array]
+
         index_array.sort()
 
         index_array_list = index_array.tolist()
@@ -212,6 +406,77 @@ class DatasetIterator(Iterator):
 
         return self._make_in_out(batch_inputs, batch_labels, batch_inputs_len)
 
+    def cache(self, num_samples=None, seed=0, cache_dir=None):
+        """ Assembles the padded batches once, so they can be reused (e.g.
+        to validate every epoch). The samples are sorted by length, which
+        minimizes the padding
+
+        # Arguments
+            num_samples: if set, only a fixed random subsample of the
+            dataset is cached
+            seed: seed of the subsample
+            cache_dir: if set, the padded inputs are saved in this directory
+            and memory-mapped instead of kept in memory
+
+        # Outputs
+            BatchCache
+        """
+        indices = np.arange(self.n)
+        if num_samples and num_samples < self.n:
+            indices = np.sort(np.random.RandomState(seed).choice(
+                self.n, num_samples, replace=False))
+        if self.indices is not None:
+            indices = self.indices[indices]
+
+        if getattr(self, 'durations', None) is not None:
+            lengths = np.asarray(self.durations[:])[indices]
+        else:
+            lengths = np.array([len(self.inputs[i]) for i in indices])
+        indices = indices[np.argsort(lengths, kind='mergesort')]
+
+        if cache_dir is not None:
+            utils.safe_mkdirs(cache_dir)
+
+        batches, targets = [], []
+        for start in range(0, len(indices), self.batch_size):
+            # h5py needs increasing indices
+            index_array = np.sort(indices[start: start + self.batch_size])
+            index_list = index_array.tolist()
+
+            batch_inputs, batch_inputs_len = self._make_in(
+                self.inputs[index_list], len(index_list))
+
+            if cache_dir is not None:
+                fname = os.path.join(cache_dir,
+                                     'batch_%05d.npy' % len(batches))
+                np.save(fname, batch_inputs)
+                batch_inputs = np.load(fname, mmap_mode='r')
+
+            batch_labels = None
+            if self.labels is not None:
+                batch_labels = self._make_out(self.labels[index_list],
+                                              len(index_list))
+
+            batches.append(self._make_in_out(batch_inputs, batch_labels,
+                                             batch_inputs_len))
+            targets.append((batch_labels, batch_inputs_len))
+
+        if cache_dir is not None:
+            # Everything but the padded inputs, see BatchCache.load
+            with open(os.path.join(cache_dir, 'batches.pkl'), 'wb') as f:
+                pickle.dump((len(indices), targets), f, 2)
+
+        self._logger.info('%d samples cached in %d batches' % (
+            len(indices), len(batches)))
+
+        return BatchCache(batches, len(indices))
+
+    def _pin_thread(self):
+        thread_id = threading.current_thread().ident
+        if thread_id not in self._pinned_threads:
+            utils.set_cpu_affinity(self.loader_cpus, current_thread=True)
+            self._pinned_threads.add(thread_id)
+
     def _make_in_out(self, batch_inputs, batch_labels, batch_inputs_len=None):
         # if label is not provided output is not necessary
         if batch_labels is None:
@@ -224,6 +489,7 @@ class DatasetIterator(Iterator):
         if self.input_parser is not None:
             inputs = np.asarray([self.input_parser(i) for i in inputs])
 
+        # The features may be stored as float16 (see DatasetParser.to_h5)
         batch_inputs = pad_sequences(inputs, dtype='float32', padding='post')
 
         if self.standarize:
@@ -251,6 +517,59 @@ class DatasetIterator(Iterator):
         return scipy.sparse.coo_matrix((data, (rows, cols)), dtype='int32')
 
 
+class BatchCache(object):
+    """ Iterates cyclically over pre-assembled batches (see
+    DatasetIterator.cache). It can be used as the validation data of
+    fit_generator (with nb_val_samples=len)
+    """
+
+    def __init__(self, batches, num_samples):
+        self.batches = batches
+        self.num_samples = num_samples
+        self.batch_index = 0
+        self.lock = threading.Lock()
+
+    @classmethod
+    def load(cls, cache_dir):
+        """ Loads the batches saved by DatasetIterator.cache. The inputs are
+        memory-mapped, so the processes that load the same directory share
+        them
+        """
+        with open(os.path.join(cache_dir, 'batches.pkl'), 'rb') as f:
+            num_samples, targets = pickle.load(f)
+
+        batches = []
+        for index, (batch_labels, batch_inputs_len) in enumerate(targets):
+            batch_inputs = np.load(os.path.join(
+                cache_dir, 'batch_%05d.npy' % index), mmap_mode='r')
+
+            if batch_labels is None:
+                batches.append([batch_inputs, batch_inputs_len])
+            else:
+                batches.append(([batch_inputs, batch_labels,
+                                 batch_inputs_len],
+                                [np.zeros((batch_inputs.shape[0],)),
+                                 batch_labels]))
+
+        return cls(batches, num_samples)
+
+    @property
+    def len(self):
+        return self.num_samples
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        with self.lock:
+            batch = self.batches[self.batch_index]
+            self.batch_index = (self.batch_index + 1) % len(self.batches)
+        return batch
+
+    def __next__(self):
+        return self.next()
+
+
 class H5Iterator(DatasetIterator):
 
     def __init__(self, h5group, **kwargs):
@@ -85,7 +85,7 @@ class DatasetParser(object):
         return fname
 
     def to_h5(self, fname=None, input_parser=audio.raw, label_parser=None,
-              split_sets=True, override=False):
+              split_sets=True, override=False, dtype='float32'):
         ''' Generates h5df file for the dataset
         Note that this function will calculate the features rather than store
         the path to the audio file
@@ -94,6 +94,9 @@ class DatasetParser(object):
             split_sets: if True and dataset is split in several sets (e.g.
             train, valid, test) the h5 file will create the corresponding
             datasets; otherwise no dataset is create
+            dtype: dtype of the stored features. float16 halves the file
+            size; the features are upcast to float32 when the batches are
+            assembled
         '''
         if not issubclass(input_parser.__class__, audio.Feature):
             raise TypeError("input_parser must be an instance of audio.Feature")
@@ -129,7 +132,7 @@ class DatasetParser(object):
 
                 inputs = group.create_dataset(
                     'inputs', (0,), maxshape=(None,),
-                    dtype=h5py.special_dtype(vlen=np.dtype('float32')))
+                    dtype=h5py.special_dtype(vlen=np.dtype(dtype)))
 
                 if input_parser.num_feats:
                     inputs.attrs['num_feats'] = input_parser.num_feats
@@ -158,7 +161,7 @@ class DatasetParser(object):
                 duration = d['duration']
 
                 inputs.resize(inputs.shape[0] + 1, axis=0)
-                inputs[inputs.shape[0] - 1] = input_.flatten().astype('float32')
+                inputs[inputs.shape[0] - 1] = input_.flatten().astype(dtype)
 
                 labels.resize(labels.shape[0] + 1, axis=0)
                 labels[labels.shape[0] - 1] = label.encode('utf8')
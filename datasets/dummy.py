@@ -1,14 +1,15 @@
 from datasets import DatasetParser
+from utils.registry import DATASETS
 
 import os
 import re
-import librosa
 import codecs
 import tempfile
 
 import numpy as np
 
 
+@DATASETS.register
 class Dummy(DatasetParser):
     """ Fake dataset reader and parser to do some tests
 
@@ -58,6 +59,7 @@ class Dummy(DatasetParser):
         self._dataset_dir = value
 
     def _iter(self):
+        import librosa
 
         counter = 0
         total = self.num_speakers * self.num_utterances_per_speaker
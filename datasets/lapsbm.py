@@ -1,11 +1,12 @@
 from datasets import DatasetParser
+from utils.registry import DATASETS
 
 import os
 import re
-import librosa
 import codecs
 
 
+@DATASETS.register
 class LapsBM(DatasetParser):
     """ Laps benchmark version 1.4 dataset reader and parser
 
@@ -35,6 +36,8 @@ class LapsBM(DatasetParser):
         super(LapsBM, self).__init__(dataset_dir, name, **kwargs)
 
     def _iter(self):
+        import librosa
+
         for speaker_path in os.listdir(self.dataset_dir):
 
             root_path = os.path.join(os.path.abspath(self.dataset_dir),
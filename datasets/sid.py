@@ -1,8 +1,8 @@
 from datasets import DatasetParser
+from utils.registry import DATASETS
 
 import os
 import re
-import librosa
 import codecs
 
 import numpy as np
@@ -10,6 +10,7 @@ import numpy as np
 regex = r"Nome=(?P<name>.*)[\n]+Idade=(?P<age>.*)[\n]+.*[\n]+Sexo=(?P<gender>.*)[\n]+Escolaridade=(?P<education>.*)[\n]+"
 
 
+@DATASETS.register
 class Sid(DatasetParser):
     """ Sid dataset reader and parser
     """
@@ -21,6 +22,8 @@ class Sid(DatasetParser):
         super(Sid, self).__init__(dataset_dir, name, **kwargs)
 
     def _iter(self):
+        import librosa
+
         for speaker_path in os.listdir(self.dataset_dir):
 
             root_path = os.path.join(os.path.abspath(self.dataset_dir),
@@ -1,13 +1,14 @@
 from datasets import DatasetParser
+from utils.registry import DATASETS
 
 import os
 import re
-import librosa
 import codecs
 
 regex = r"User\s+Name\:[\s]*(?P<speaker>.*)[\n]+.*[\n]+Gender\:[\s]*(?P<gender>[a-zA-Z]+)[\w\r\s\n:\/]+Pronunciation dialect\:\s+(?P<dialect>.*)"
 
 
+@DATASETS.register
 class VoxForge(DatasetParser):
     """ VoxForge (only portuguese brazilian audio files) dataset reader and parser
 
@@ -31,6 +32,8 @@ class VoxForge(DatasetParser):
             self.dataset_dir = os.path.join(self.dataset_dir, 'files')
 
     def _iter(self):
+        import librosa
+
         for speaker_path in os.listdir(self.dataset_dir):
 
             if speaker_path in self.IGNORED_LIST:
@@ -5,22 +5,127 @@ from __future__ import print_function
 import os
 import codecs
 import json
+import time
 import numpy as np
 # Preventing pool_allocator message
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
 
 import argparse
-import h5py
 import inspect
 
 from preprocessing import audio, text
 
 from utils import generic_utils as utils
 from utils.hparams import HParams
+from utils.registry import FEATURES, PARSERS
 
-from datasets.dataset_generator import DatasetGenerator, DatasetIterator
 
-from utils.core_utils import setup_gpu, load_model
+def evaluate(model_fname, args_nondefault, engine='keras', dtype='float32'):
+    """ Evaluates the model over the dataset
+
+    # Arguments
+        engine: 'keras' or 'numpy' (greedy decoder, see utils.numpy_engine)
+        dtype: dtype of the weights and activations. float16 and int8 (for
+        quantized models) are only supported by the numpy engine
+
+    # Outputs
+        a tuple (metrics, elapsed), where metrics is a dictionary with the
+        model metrics and elapsed is the evaluation time in seconds
+    """
+    if engine == 'numpy':
+        return evaluate_numpy(model_fname, args_nondefault, dtype)
+
+    if dtype != 'float32':
+        raise ValueError('The keras engine only supports float32 (the CTC '
+                         'ops need float32). Use --engine numpy')
+
+    # Imported when used, so `eval.py --help` starts fast
+    from datasets.dataset_generator import DatasetGenerator
+    from utils.core_utils import setup_gpu, load_model
+
+    # GPU configuration
+    setup_gpu(args_nondefault.gpu, args_nondefault.allow_growth,
+              intra_op=args_nondefault.intra_op,
+              inter_op=args_nondefault.inter_op, cpus=args_nondefault.cpus)
+
+    # Loading model
+    model, meta = load_model(model_fname, return_meta=True, mode='eval')
+
+    args = HParams(**meta['training_args']).update(vars(args_nondefault))
+
+    # Features extractor
+    input_parser = FEATURES.get(args.input_parser,
+                                params=args.input_parser_params)
+
+    # Recovering text parser
+    label_parser = PARSERS.get(args.label_parser,
+                               params=args.label_parser_params)
+
+    data_gen = DatasetGenerator(input_parser, label_parser,
+                                batch_size=args.batch_size, seed=0,
+                                loader_cpus=args_nondefault.loader_cpus)
+    test_flow = data_gen.flow_from_fname(args.dataset, datasets=args.subset)
+
+    num_samples = test_flow.len
+    if args.num_samples:
+        num_samples = min(args.num_samples, num_samples)
+
+    start = time.time()
+    metrics = model.evaluate_generator(test_flow, num_samples,
+                                       max_q_size=10, nb_worker=1)
+    elapsed = time.time() - start
+
+    metrics = dict(zip(model.metrics_names, metrics))
+
+    from keras import backend as K
+    K.clear_session()
+
+    return metrics, elapsed
+
+
+def evaluate_numpy(model_fname, args_nondefault, dtype='float32'):
+    """ Evaluates the model with the numpy engine and the greedy decoder
+
+    # Outputs
+        a tuple (metrics, elapsed), where metrics is a dictionary with the
+        greedy label error rate
+    """
+    from datasets.dataset_generator import DatasetGenerator
+    from utils import numpy_engine
+    from utils.metrics_utils import ler, sparse_to_list
+
+    # The numpy engine runs in the calling thread
+    utils.set_cpu_affinity(args_nondefault.cpus)
+
+    model, meta = numpy_engine.load_model(model_fname, return_meta=True,
+                                          dtype=dtype)
+
+    args = HParams(**meta['training_args']).update(vars(args_nondefault))
+
+    input_parser = FEATURES.get(args.input_parser,
+                                params=args.input_parser_params)
+    label_parser = PARSERS.get(args.label_parser,
+                               params=args.label_parser_params)
+
+    data_gen = DatasetGenerator(input_parser, label_parser,
+                                batch_size=args.batch_size, seed=0,
+                                loader_cpus=args_nondefault.loader_cpus)
+    test_flow = data_gen.flow_from_fname(args.dataset, datasets=args.subset)
+
+    num_samples = test_flow.len
+    if args.num_samples:
+        num_samples = min(args.num_samples, num_samples)
+
+    start = time.time()
+    lers = []
+    while len(lers) < num_samples:
+        (inputs, labels, inputs_length), _ = next(test_flow)
+        y_pred = model.decode(inputs, inputs_length)
+        lers.extend(ler(sparse_to_list(labels), y_pred))
+    elapsed = time.time() - start
+
+    return {'greedy_ler': np.mean(lers[:num_samples])}, elapsed
+
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Evaluating an ASR system.')
@@ -28,6 +133,19 @@ if __name__ == '__main__':
     parser.add_argument('--model', required=True, type=str)
     parser.add_argument('--dataset', required=True, type=str)
     parser.add_argument('--subset', type=str, default='test')
+    parser.add_argument('--num_samples', default=None, type=int)
+
+    # Reference model (e.g. the float32 model of a quantized one)
+    parser.add_argument('--compare_to', default=None, type=str)
+
+    # Inference engine and dtype (float16 and int8 are only supported by
+    # numpy)
+    parser.add_argument('--engine', default='keras', type=str,
+                        choices=['keras', 'numpy'])
+    parser.add_argument('--dtype', default='float32', type=str,
+                        choices=['float32', 'float16', 'int8'])
+    parser.add_argument('--compare_dtype', default='float32', type=str,
+                        choices=['float32', 'float16', 'int8'])
 
     parser.add_argument('--batch_size', default=32, type=int)
 
@@ -43,6 +161,11 @@ if __name__ == '__main__':
     # Other configs
     parser.add_argument('--gpu', default='0', type=str)
     parser.add_argument('--allow_growth', default=False, action='store_true')
+    # CPU threads and affinity (e.g. --cpus 0-11 --loader_cpus 12-15)
+    parser.add_argument('--intra_op', default=None, type=int)
+    parser.add_argument('--inter_op', default=None, type=int)
+    parser.add_argument('--cpus', default=None, type=str)
+    parser.add_argument('--loader_cpus', default=None, type=str)
 
     parser.add_argument('--save_transcriptions', default=None, type=str)
 
@@ -50,33 +173,34 @@ if __name__ == '__main__':
     args_nondefault = utils.parse_nondefault_args(
         args, parser.parse_args(
             ['--model', args.model, '--dataset', args.dataset]))
-
-    # GPU configuration
-    setup_gpu(args.gpu, args.allow_growth)
-
-    # Loading model
-    model, meta = load_model(args.model, return_meta=True, mode='eval')
-
-    args = HParams(**meta['training_args']).update(vars(args_nondefault))
-
-    # Features extractor
-    input_parser = utils.get_from_module('preprocessing.audio',
-                                         args.input_parser,
-                                         params=args.input_parser_params)
-
-    # Recovering text parser
-    label_parser = utils.get_from_module('preprocessing.text',
-                                         args.label_parser,
-                                         params=args.label_parser_params)
-
-    data_gen = DatasetGenerator(input_parser, label_parser,
-                                batch_size=args.batch_size, seed=0)
-    test_flow = data_gen.flow_from_fname(args.dataset, datasets=args.subset)
-
-    metrics = model.evaluate_generator(test_flow, test_flow.len,
-                                       max_q_size=10, nb_worker=1)
-
-    for m, v in zip(model.metrics_names, metrics):
-        print('%s: %4f' % (m, v))
-
-    from keras import backend as K; K.clear_session()
+    # Always forwarded to the evaluation
+    args_nondefault.gpu = args.gpu
+    args_nondefault.allow_growth = args.allow_growth
+    for k in ('intra_op', 'inter_op', 'cpus', 'loader_cpus'):
+        setattr(args_nondefault, k, getattr(args, k))
+
+    metrics, elapsed = evaluate(args.model, args_nondefault,
+                                engine=args.engine, dtype=args.dtype)
+
+    for m in sorted(metrics):
+        print('%s: %4f' % (m, metrics[m]))
+    print('elapsed time: %.2fs' % elapsed)
+
+    if args.compare_to:
+        ref_metrics, ref_elapsed = evaluate(args.compare_to, args_nondefault,
+                                            engine=args.engine,
+                                            dtype=args.compare_dtype)
+
+        print('\nCompared to %s (%s):' % (args.compare_to,
+                                         args.compare_dtype))
+        for m in sorted(metrics):
+            if m in ref_metrics:
+                print('%s: %4f (delta: %+4f)' % (m, ref_metrics[m],
+                                                 metrics[m] - ref_metrics[m]))
+        speedup = ref_elapsed / elapsed
+        if speedup >= 1:
+            print('elapsed time: %.2fs (speedup: %.2fx)' % (ref_elapsed,
+                                                           speedup))
+        else:
+            print('elapsed time: %.2fs (slowdown: %.2fx)' % (ref_elapsed,
+                                                            1 / speedup))
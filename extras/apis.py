@@ -1,8 +1,76 @@
 import os
+import json
+import random
+import threading
+import time
+import httplib
+import urlparse
+import urllib
+
 import speech_recognition as sr
 
 r = sr.Recognizer()
 
+
+class APIError(Exception):
+    """ Error of a HTTP API. Requests that failed with `status` 429 (too many
+    requests) or 5xx are worth retrying
+    """
+
+    def __init__(self, message, status=None):
+        super(APIError, self).__init__(message)
+        self.status = status
+
+
+def is_retryable(e):
+    """ Whether a request that raised e should be retried (network errors,
+    rate limits and server errors, but not audios that could not be
+    understood)
+    """
+    if isinstance(e, sr.UnknownValueError):
+        return False
+    if isinstance(e, APIError) and e.status is not None:
+        return e.status == 429 or e.status >= 500
+    return True
+
+
+def call_with_retries(fn, max_retries=5, backoff=1., max_backoff=60.):
+    """ Calls fn, retrying with exponential backoff (and jitter) while it
+    raises retryable errors (see is_retryable)
+    """
+    for attempt in range(max_retries + 1):
+        try:
+            return fn()
+        except Exception as e:
+            if attempt == max_retries or not is_retryable(e):
+                raise
+            time.sleep(min(max_backoff, backoff * 2 ** attempt) *
+                       random.uniform(.5, 1.))
+
+
+class RateLimiter(object):
+    """ Spaces the calls of wait() (from any thread) so that at most rate
+    calls are made per second. If rate is None, it never waits
+    """
+
+    def __init__(self, rate=None):
+        self.interval = 1. / rate if rate else 0.
+        self.next_time = 0.
+        self.lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+
+        with self.lock:
+            now = time.time()
+            delay = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.interval
+
+        if delay > 0:
+            time.sleep(delay)
+
+
 def recognize_from_api(audio, api, name='API', safe=True, **kwargs):
     if not isinstance(audio, sr.AudioData):
         with sr.AudioFile(audio) as source:
@@ -20,26 +88,66 @@ def recognize_from_api(audio, api, name='API', safe=True, **kwargs):
     service; {0}" % (name, e)
 
 
-def recognize_google(audio,
-                     credentials=os.environ['GOOGLE_CLOUD_API'],
-                     **kwargs):
-
+def recognize_google(audio, credentials=None, **kwargs):
+    credentials = credentials or os.environ['GOOGLE_CLOUD_API']
     return recognize_from_api(audio, r.recognize_google_cloud,
                               name='Google Cloud Speech',
                               credentials_json=credentials,
                               **kwargs)
 
 
-def recognize_bing(audio, key=os.environ['BING_API'], **kwargs):
+def recognize_bing(audio, key=None, **kwargs):
+    key = key or os.environ['BING_API']
     return recognize_from_api(audio, r.recognize_bing,
                               name='Microsoft Bing Voice',
                               key=key, **kwargs)
 
 
-def recognize_ibm(audio,
-                  username=os.environ['IBM_USERNAME'],
-                  password=os.environ['IBM_PASSWORD'], **kwargs):
+def recognize_ibm(audio, username=None, password=None, **kwargs):
+    username = username or os.environ['IBM_USERNAME']
+    password = password or os.environ['IBM_PASSWORD']
     return recognize_from_api(audio, r.recognize_ibm,
                               name='IBM Speech to Text',
                               username=username, password=password,
                               **kwargs)
+
+
+def recognize_http(audio, url=None, language='pt-BR', timeout=60.,
+                   safe=True):
+    """ Sends the wav file to a HTTP endpoint (e.g. a self-hosted recognizer
+    or extras/stub_api_server.py), which answers with a json
+    `{"transcript": ...}`
+
+    # Arguments
+        url: endpoint. Defaults to the environment variable ASR_API_URL
+    """
+    url = urlparse.urlparse(url or os.environ['ASR_API_URL'])
+
+    if isinstance(audio, sr.AudioData):
+        body = audio.get_wav_data()
+    else:
+        with open(audio, 'rb') as f:
+            body = f.read()
+
+    conn = httplib.HTTPConnection(url.hostname, url.port, timeout=timeout)
+    try:
+        conn.request('POST', '%s?%s' % (url.path or '/',
+                                        urllib.urlencode({'lang': language})),
+                     body, {'Content-Type': 'audio/wav'})
+        response = conn.getresponse()
+        data = response.read()
+    except Exception as e:
+        if not safe:
+            raise
+        return "\tCould not request results from %s; %s" % (url.netloc, e)
+    finally:
+        conn.close()
+
+    if response.status != 200:
+        if not safe:
+            raise APIError('%s returned %d: %s' % (url.netloc,
+                                                   response.status, data),
+                           status=response.status)
+        return "\t%s returned %d" % (url.netloc, response.status)
+
+    return json.loads(data)['transcript']
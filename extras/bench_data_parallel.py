@@ -0,0 +1,127 @@
+from __future__ import absolute_import, division, print_function
+
+import os
+# Preventing pool_allocator message
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
+
+import argparse
+import json
+import multiprocessing
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from utils import distributed_utils
+
+
+def worker(args):
+    """ Times the data-parallel training steps of one worker. Rank 0 appends
+    the result to args.output
+    """
+    from keras import backend as K
+    from utils.core_utils import setup_gpu, DataParallelTrainFunction
+    from extras.bench_model import build_model, make_batch
+
+    # Disjoint share of the cores (as in train.py)
+    cpus = list(range(multiprocessing.cpu_count()))
+    share = len(cpus) // args.world_size
+    setup_gpu('-1', cpus=cpus[args.rank * share:
+                              (args.rank + 1) * share] or cpus)
+
+    allreduce = distributed_utils.Allreduce(args.rank, args.world_size,
+                                            args.port)
+
+    model = build_model(args.model, args.model_params)
+    if args.world_size > 1:
+        model.train_function = DataParallelTrainFunction(model, allreduce)
+
+    num_features = model.get_layer('inputs').input_shape[-1]
+    num_classes = model.get_layer('decoder').input_shape[0][-1]
+
+    # Each worker has its own batch
+    x, y = make_batch(args.batch_size, args.seq_len, num_features,
+                      num_classes, args.label_len, min_len=args.min_len,
+                      seed=args.rank)
+
+    for _ in range(args.warmup):
+        model.train_on_batch(x, y)
+
+    timings = []
+    for _ in range(args.num_steps):
+        start = time.time()
+        model.train_on_batch(x, y)
+        timings.append(time.time() - start)
+
+    if args.rank == 0:
+        with open(args.output, 'a') as f:
+            f.write(json.dumps({'num_workers': args.world_size,
+                                'time_per_step': np.mean(timings),
+                                'std': np.std(timings)}) + '\n')
+
+    allreduce.close()
+    K.clear_session()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measures the scaling of \
+the data-parallel training (see train.py --num_workers) over random data. \
+The batch size is per worker, so the global batch grows with the number of \
+workers.')
+
+    parser.add_argument('--model', default='brsmv1', type=str)
+    parser.add_argument('--model_params', nargs='+', default=[])
+
+    parser.add_argument('--num_workers', nargs='+', default=[1, 2, 4, 8],
+                        type=int)
+    parser.add_argument('--batch_size', default=32, type=int)
+    parser.add_argument('--seq_len', default=400, type=int)
+    parser.add_argument('--min_len', default=None, type=int)
+    parser.add_argument('--label_len', default=40, type=int)
+    parser.add_argument('--num_steps', default=10, type=int)
+    parser.add_argument('--warmup', default=2, type=int)
+
+    # Set by the launcher on each worker
+    parser.add_argument('--rank', default=None, type=int)
+    parser.add_argument('--port', default=None, type=int)
+    parser.add_argument('--world_size', default=None, type=int)
+    parser.add_argument('--output', default=None, type=str)
+
+    args = parser.parse_args()
+
+    if args.rank is not None:
+        worker(args)
+        sys.exit(0)
+
+    fd, output = tempfile.mkstemp(suffix='.jsonl')
+    os.close(fd)
+
+    for num_workers in args.num_workers:
+        print('Running %d worker(s)...' % num_workers)
+        return_code = distributed_utils.launch(
+            num_workers, sys.argv[1:] + ['--world_size', str(num_workers),
+                                         '--output', output],
+            module='extras.bench_data_parallel')
+        if return_code:
+            sys.exit(return_code)
+
+    with open(output) as f:
+        results = [json.loads(l) for l in f]
+    os.remove(output)
+
+    print('model: %s %s' % (args.model, ' '.join(args.model_params)))
+    print('batch size per worker: %d, timesteps: %d, cores: %d' % (
+        args.batch_size, args.seq_len, multiprocessing.cpu_count()))
+    print('%8s %14s %10s %8s %11s' % ('workers', 'time/step (s)',
+                                      'samples/s', 'speedup', 'efficiency'))
+
+    base = None
+    for r in results:
+        samples_per_sec = (r['num_workers'] * args.batch_size /
+                           r['time_per_step'])
+        base = base or samples_per_sec / r['num_workers']
+        speedup = samples_per_sec / base
+        print('%8d %14.4f %10.2f %7.2fx %10.1f%%' % (
+            r['num_workers'], r['time_per_step'], samples_per_sec, speedup,
+            100. * speedup / r['num_workers']))
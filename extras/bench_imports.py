@@ -0,0 +1,120 @@
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import runpy
+import subprocess
+import sys
+import time
+
+# Only the standard library is imported here: the modules already imported
+# are not timed by profile_imports
+try:
+    import __builtin__ as builtins
+except ImportError:
+    import builtins
+
+ENTRY_POINTS = ['train.py', 'eval.py', 'predict.py', 'serve.py']
+
+
+def time_help(script, repeat=5):
+    """ Measures the wall time of `python script --help` (a fresh process,
+    so the imports are never cached)
+
+    # Outputs
+        list with the time of each run in seconds
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.time()
+        with open('/dev/null', 'w') as devnull:
+            subprocess.check_call([sys.executable, script, '--help'],
+                                  stdout=devnull)
+        times.append(time.time() - start)
+    return times
+
+
+def profile_imports(script):
+    """ Runs `script --help` in this process recording the time of the first
+    import of each module (python 2 has no `-X importtime`)
+
+    # Outputs
+        list of (module, self time, cumulative time) in seconds, in import
+        order. The cumulative time includes the imports it triggered
+    """
+    original_import = builtins.__import__
+    records, stack = [], []
+
+    def timed_import(name, *args, **kwargs):
+        if name in sys.modules:
+            return original_import(name, *args, **kwargs)
+
+        stack.append(0.)
+        start = time.time()
+        try:
+            return original_import(name, *args, **kwargs)
+        finally:
+            cumulative = time.time() - start
+            children = stack.pop()
+            if stack:
+                stack[-1] += cumulative
+            records.append((name, cumulative - children, cumulative))
+
+    builtins.__import__ = timed_import
+    sys.argv = [script, '--help']
+    stdout, sys.stdout = sys.stdout, open('/dev/null', 'w')
+    try:
+        runpy.run_path(script, run_name='__main__')
+    except SystemExit:
+        pass
+    finally:
+        builtins.__import__ = original_import
+        sys.stdout = stdout
+
+    # Implicit relative imports (python 2) may be tried more than once
+    seen, first = set(), []
+    for record in records:
+        if record[0] not in seen:
+            seen.add(record[0])
+            first.append(record)
+    return first
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measures the start-up time \
+of the entry points (`SCRIPT --help`) and which imports dominate it.')
+
+    parser.add_argument('--scripts', nargs='+', default=ENTRY_POINTS)
+    parser.add_argument('--repeat', default=5, type=int)
+    # Number of slowest imports shown per script (0 disables the profile)
+    parser.add_argument('--top', default=15, type=int)
+
+    # Set on the profiling subprocess
+    parser.add_argument('--worker', default=None, type=str)
+
+    args = parser.parse_args()
+
+    if args.worker:
+        records = profile_imports(args.worker)
+        records.sort(key=lambda r: -r[2])
+
+        print('%12s | %12s | %s' % ('self [us]', 'cumulative', 'module'))
+        for name, self_time, cumulative in records[:args.top]:
+            print('%12d | %12d | %s' % (1e6 * self_time, 1e6 * cumulative,
+                                        name))
+        sys.exit(0)
+
+    print('%-12s %10s %10s' % ('script', 'min (s)', 'mean (s)'))
+    for script in args.scripts:
+        times = time_help(script, args.repeat)
+        print('%-12s %10.3f %10.3f' % (script, min(times),
+                                       sum(times) / len(times)))
+
+    if args.top:
+        for script in args.scripts:
+            print('\nSlowest imports of %s --help:' % script)
+            sys.stdout.flush()
+            with open('/dev/null', 'w') as devnull:
+                subprocess.check_call([sys.executable, '-m',
+                                       'extras.bench_imports', '--worker',
+                                       script, '--top', str(args.top)],
+                                      stderr=devnull)
@@ -0,0 +1,150 @@
+from __future__ import absolute_import, division, print_function
+
+import os
+# Preventing pool_allocator message
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
+
+import argparse
+import resource
+import time
+
+import numpy as np
+import scipy.sparse
+
+from utils.hparams import HParams
+from utils.registry import MODELS
+
+
+def make_batch(batch_size, seq_len, num_features, num_classes, label_len,
+               min_len=None, seed=0):
+    """ Random batch in the same format generated by DatasetIterator
+    """
+    rng = np.random.RandomState(seed)
+
+    inputs_length = np.full((batch_size,), seq_len, dtype='int32')
+    if min_len:
+        inputs_length = rng.randint(min_len, seq_len + 1, size=(batch_size,))
+        inputs_length[0] = seq_len
+
+    inputs = rng.randn(batch_size, seq_len, num_features).astype('float32')
+    for i, length in enumerate(inputs_length):
+        inputs[i, length:] = 0.
+
+    rows = np.repeat(np.arange(batch_size), label_len)
+    cols = np.tile(np.arange(label_len), batch_size)
+    data = rng.randint(0, num_classes - 1, size=(batch_size * label_len,))
+    labels = scipy.sparse.coo_matrix((data, (rows, cols)), dtype='int32')
+
+    return ([inputs, labels, inputs_length],
+            [np.zeros((batch_size,)), labels])
+
+
+def build_model(model_name, model_params):
+    """ Creates and compiles a model as in train.py
+    """
+    from keras.optimizers import Adam
+    from core import metrics
+    from core.ctc_utils import ctc_dummy_loss, decoder_dummy_loss
+
+    model_fn = MODELS.get(model_name)
+    model = model_fn(**HParams().parse(model_params).values())
+    model.compile(loss={'ctc': ctc_dummy_loss,
+                        'decoder': decoder_dummy_loss},
+                  optimizer=Adam(clipnorm=400),
+                  metrics={'decoder': metrics.ler},
+                  loss_weights=[1, 0])
+    return model
+
+
+def benchmark(model_name, model_params, args):
+    """ Times the training (or inference) steps of a model
+
+    # Outputs
+        a tuple (num_params, timings)
+    """
+    from keras import backend as K
+
+    model = build_model(model_name, model_params)
+
+    num_features = model.get_layer('inputs').input_shape[-1]
+    num_classes = model.get_layer('decoder').input_shape[0][-1]
+
+    x, y = make_batch(args.batch_size, args.seq_len, num_features,
+                      num_classes, args.label_len, min_len=args.min_len)
+
+    if args.mode == 'train':
+        step_fn = lambda: model.train_on_batch(x, y)
+    else:
+        step_fn = lambda: model.predict_on_batch(x)
+
+    for _ in range(args.warmup):
+        step_fn()
+
+    timings = []
+    for _ in range(args.num_steps):
+        start = time.time()
+        step_fn()
+        timings.append(time.time() - start)
+
+    num_params = model.count_params()
+    K.clear_session()
+
+    return num_params, timings
+
+
+def report(model_name, model_params, num_params, timings, args):
+    print('model: %s %s' % (model_name, ' '.join(model_params)))
+    print('parameters: %d' % num_params)
+    print('mode: %s, batch size: %d, timesteps: %d' % (
+        args.mode, args.batch_size, args.seq_len))
+    print('time per step: %.4fs (std %.4fs)' % (np.mean(timings),
+                                               np.std(timings)))
+    print('time per timestep: %.3fms' % (1e3 * np.mean(timings) /
+                                         args.seq_len))
+    print('steps/s: %.3f' % (1. / np.mean(timings)))
+    print('samples/s: %.2f' % (args.batch_size / np.mean(timings)))
+    # Peak of the whole process, so benchmark each model in its own run
+    print('peak memory: %.1f MB' % (
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks the training \
+and inference speed of a model over random data.')
+
+    parser.add_argument('--model', default='brsmv1', type=str)
+    parser.add_argument('--model_params', nargs='+', default=[])
+
+    # Reference model (e.g. brsmv1 with about the same number of parameters)
+    parser.add_argument('--compare_to', default=None, type=str)
+    parser.add_argument('--compare_params', nargs='+', default=[])
+
+    parser.add_argument('--mode', default='train', type=str,
+                        choices=['train', 'predict'])
+    parser.add_argument('--batch_size', default=32, type=int)
+    parser.add_argument('--seq_len', default=400, type=int)
+    parser.add_argument('--min_len', default=None, type=int)
+    parser.add_argument('--label_len', default=40, type=int)
+    parser.add_argument('--num_steps', default=10, type=int)
+    parser.add_argument('--warmup', default=2, type=int)
+
+    parser.add_argument('--gpu', default='-1', type=str)
+
+    args = parser.parse_args()
+
+    from utils.core_utils import setup_gpu
+
+    setup_gpu(args.gpu)
+
+    num_params, timings = benchmark(args.model, args.model_params, args)
+    report(args.model, args.model_params, num_params, timings, args)
+
+    if args.compare_to:
+        setup_gpu(args.gpu)
+        ref_params, ref_timings = benchmark(args.compare_to,
+                                            args.compare_params, args)
+        print()
+        report(args.compare_to, args.compare_params, ref_params, ref_timings,
+               args)
+        print('\nparameters ratio: %.2f' % (num_params / ref_params))
+        print('speedup: %.2fx' % (np.mean(ref_timings) / np.mean(timings)))
@@ -0,0 +1,79 @@
+from __future__ import absolute_import, division, print_function
+
+import os
+# Preventing pool_allocator message
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
+
+import argparse
+import time
+
+import h5py
+import numpy as np
+
+
+def load_batches(fname, subset, batch_size, num_samples):
+    """ Reads padded batches of features from a HDF5 dataset
+    """
+    batches = []
+    with h5py.File(fname, 'r') as f:
+        inputs = f[subset]['inputs']
+        num_feats = inputs.attrs['num_feats']
+        num_samples = min(num_samples, len(inputs))
+
+        for start in range(0, num_samples, batch_size):
+            feats = [inputs[i].reshape((-1, num_feats)) for i in
+                     range(start, min(start + batch_size, num_samples))]
+            lengths = np.asarray([x.shape[0] for x in feats])
+            batch = np.zeros((len(feats), lengths.max(), num_feats),
+                             dtype='float32')
+            for i, x in enumerate(feats):
+                batch[i, :x.shape[0]] = x
+            batches.append((batch, lengths))
+
+    return batches
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compares the numpy engine \
+against keras (startup time, throughput and outputs).')
+
+    parser.add_argument('--model', required=True, type=str)
+    parser.add_argument('--dataset', required=True, type=str)
+    parser.add_argument('--subset', default='test', type=str)
+    parser.add_argument('--batch_size', default=8, type=int)
+    parser.add_argument('--num_samples', default=64, type=int)
+    parser.add_argument('--atol', default=1e-4, type=float)
+    parser.add_argument('--no_keras', action='store_true', default=False)
+
+    args = parser.parse_args()
+
+    batches = load_batches(args.dataset, args.subset, args.batch_size,
+                           args.num_samples)
+
+    start = time.time()
+    from utils.numpy_engine import load_model as load_numpy_model
+    np_model = load_numpy_model(args.model)
+    print('numpy engine startup: %.2fs' % (time.time() - start))
+
+    start = time.time()
+    np_outputs = [np_model.predict(x, l) for x, l in batches]
+    np_elapsed = time.time() - start
+    print('numpy engine: %.2f samples/s' % (args.num_samples / np_elapsed))
+
+    if not args.no_keras:
+        start = time.time()
+        from utils.core_utils import setup_gpu, load_model
+        setup_gpu('-1')
+        model = load_model(args.model, mode='predict', decoder=False)
+        print('keras startup: %.2fs' % (time.time() - start))
+
+        start = time.time()
+        k_outputs = [model.predict([x, l], batch_size=len(x))
+                     for x, l in batches]
+        k_elapsed = time.time() - start
+        print('keras: %.2f samples/s' % (args.num_samples / k_elapsed))
+
+        max_diff = max(np.max(np.abs(a - b))
+                       for a, b in zip(np_outputs, k_outputs))
+        print('max abs difference: %g (%s)' % (
+            max_diff, 'ok' if max_diff <= args.atol else 'MISMATCH'))
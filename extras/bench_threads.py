@@ -0,0 +1,148 @@
+from __future__ import absolute_import, division, print_function
+
+import os
+# Preventing pool_allocator message
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
+
+import argparse
+import itertools
+import json
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+
+def worker(args):
+    """ Times the training steps with one setting and appends the result to
+    args.output
+    """
+    from keras import backend as K
+    from utils.core_utils import setup_gpu
+    from utils.registry import PARSERS
+    from extras.bench_model import build_model, make_batch
+
+    cpus = args.cpus if args.pin else None
+    loader_cpus = args.loader_cpus if args.pin else None
+
+    setup_gpu('-1', intra_op=args.intra_op, inter_op=args.inter_op,
+              cpus=cpus)
+
+    model = build_model(args.model, args.model_params)
+
+    num_features = model.get_layer('inputs').input_shape[-1]
+    num_classes = model.get_layer('decoder').input_shape[0][-1]
+
+    x, y = make_batch(args.batch_size, args.seq_len, num_features,
+                      num_classes, args.label_len, min_len=args.min_len)
+
+    for _ in range(args.warmup):
+        model.train_on_batch(x, y)
+
+    if args.dataset:
+        # The batches are loaded by the fit_generator thread
+        from datasets.dataset_generator import DatasetGenerator
+
+        label_parser = PARSERS.get(args.label_parser, params=[])
+        data_gen = DatasetGenerator(None, label_parser,
+                                    batch_size=args.batch_size, seed=0,
+                                    loader_cpus=loader_cpus)
+        flow = data_gen.flow_from_fname(args.dataset, datasets='train')
+
+        start = time.time()
+        model.fit_generator(flow, args.num_steps * args.batch_size,
+                            nb_epoch=1, verbose=0, max_q_size=10,
+                            nb_worker=1)
+        timings = [(time.time() - start) / args.num_steps]
+    else:
+        timings = []
+        for _ in range(args.num_steps):
+            start = time.time()
+            model.train_on_batch(x, y)
+            timings.append(time.time() - start)
+
+    with open(args.output, 'a') as f:
+        f.write(json.dumps({'intra_op': args.intra_op,
+                            'inter_op': args.inter_op,
+                            'pin': args.pin,
+                            'time_per_step': np.mean(timings)}) + '\n')
+
+    K.clear_session()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Sweeps the intra-op and \
+inter-op threads and the CPU affinity (see setup_gpu) of the training. Each \
+setting runs in its own process.')
+
+    parser.add_argument('--model', default='brsmv1', type=str)
+    parser.add_argument('--model_params', nargs='+', default=[])
+
+    parser.add_argument('--intra_op', nargs='+', default=[1, 2, 4, 8],
+                        type=int)
+    parser.add_argument('--inter_op', nargs='+', default=[1, 2], type=int)
+    # If set, each setting is also run pinned to these cores
+    parser.add_argument('--cpus', default=None, type=str)
+    parser.add_argument('--loader_cpus', default=None, type=str)
+
+    # If set, the batches are loaded from the train set of the dataset
+    parser.add_argument('--dataset', default=None, type=str)
+    parser.add_argument('--label_parser', type=str,
+                        default='simple_char_parser')
+
+    parser.add_argument('--batch_size', default=32, type=int)
+    parser.add_argument('--seq_len', default=400, type=int)
+    parser.add_argument('--min_len', default=None, type=int)
+    parser.add_argument('--label_len', default=40, type=int)
+    parser.add_argument('--num_steps', default=10, type=int)
+    parser.add_argument('--warmup', default=2, type=int)
+
+    # Set on each run
+    parser.add_argument('--worker', default=False, action='store_true')
+    parser.add_argument('--pin', default=False, action='store_true')
+    parser.add_argument('--output', default=None, type=str)
+
+    args = parser.parse_args()
+
+    if args.worker:
+        args.intra_op, = args.intra_op
+        args.inter_op, = args.inter_op
+        worker(args)
+        sys.exit(0)
+
+    fd, output = tempfile.mkstemp(suffix='.jsonl')
+    os.close(fd)
+
+    pin_settings = [False, True] if args.cpus else [False]
+    base_args = sys.argv[1:]
+
+    for intra_op, inter_op, pin in itertools.product(
+            args.intra_op, args.inter_op, pin_settings):
+        print('Running intra_op=%d inter_op=%d pin=%s...' % (intra_op,
+                                                             inter_op, pin))
+        run_args = base_args + ['--intra_op', str(intra_op),
+                                '--inter_op', str(inter_op),
+                                '--worker', '--output', output]
+        if pin:
+            run_args.append('--pin')
+        return_code = subprocess.call([sys.executable, '-m',
+                                       'extras.bench_threads'] + run_args)
+        if return_code:
+            sys.exit(return_code)
+
+    with open(output) as f:
+        results = [json.loads(l) for l in f]
+    os.remove(output)
+
+    print('model: %s %s' % (args.model, ' '.join(args.model_params)))
+    print('batch size: %d, timesteps: %d, cpus: %s, loader cpus: %s' % (
+        args.batch_size, args.seq_len, args.cpus, args.loader_cpus))
+    print('%8s %8s %5s %14s %10s' % ('intra_op', 'inter_op', 'pin',
+                                     'time/step (s)', 'samples/s'))
+
+    for r in sorted(results, key=lambda r: r['time_per_step']):
+        print('%8d %8d %5s %14.4f %10.2f' % (
+            r['intra_op'], r['inter_op'], r['pin'], r['time_per_step'],
+            args.batch_size / r['time_per_step']))
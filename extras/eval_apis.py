@@ -6,13 +6,90 @@ import os
 import argparse
 import codecs
 import json
+import threading
 import time
+import Queue
 
-from preprocessing import audio, text
 from utils import generic_utils as utils
+from utils.registry import PARSERS
+
+from extras import apis
+
+
+def save_results(results, fname):
+    """ Writes the results to a temporary file and renames it, so an
+    interruption never leaves a truncated file
+    """
+    with codecs.open(fname + '.tmp', 'w', encoding='utf8') as f:
+        json.dump(results, f)
+    os.rename(fname + '.tmp', fname)
+
+
+class APIRunner(object):
+    """ Sends the audios to one API from num_workers threads, at most rate
+    requests per second. Failed requests are retried with exponential
+    backoff (see apis.call_with_retries)
+
+    # Arguments
+        name: name of the API
+        recognize: function(audio) that returns the transcription
+        on_done: function(index, name, transcription) called from the
+        worker threads after each request. The transcription of the
+        failed requests is ''
+    """
+
+    def __init__(self, name, recognize, on_done, num_workers=4, rate=None,
+                 max_retries=5, backoff=1.):
+        self.name = name
+        self.recognize = recognize
+        self.on_done = on_done
+        self.limiter = apis.RateLimiter(rate)
+        self.max_retries = max_retries
+        self.backoff = backoff
+
+        self.queue = Queue.Queue()
+        self.threads = [threading.Thread(target=self._work)
+                        for _ in range(num_workers)]
+        for thread in self.threads:
+            thread.daemon = True
+
+    def start(self, audios):
+        """ Starts the requests
+
+        # Arguments
+            audios: list of (index, audio path)
+        """
+        for item in audios:
+            self.queue.put(item)
+        for thread in self.threads:
+            self.queue.put(None)
+            thread.start()
+
+    def _request(self, audio):
+        self.limiter.wait()
+        return self.recognize(audio)
+
+    def _work(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+
+            index, audio = item
+            try:
+                transcription = apis.call_with_retries(
+                    lambda: self._request(audio),
+                    max_retries=self.max_retries, backoff=self.backoff)
+            except Exception as e:
+                # Retried on resume
+                transcription = ''
+                print('%s failed on %s: %s' % (self.name, audio, e))
+
+            self.on_done(index, self.name, transcription)
+
+    def is_alive(self):
+        return any(thread.is_alive() for thread in self.threads)
 
-import apis
-import speech_recognition as sr
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Evaluating an ASR system \
@@ -34,6 +111,17 @@ over all dataset, not only with the dt key equals test.')
     parser.add_argument('--save', default=None, type=str)
     parser.add_argument('--apis', default=['google', 'ibm', 'microsoft'],
                         nargs='+')
+    # Endpoint of the `http` api (e.g. extras/stub_api_server.py)
+    parser.add_argument('--http_url', default=None, type=str)
+
+    # Concurrency (per api)
+    parser.add_argument('--num_workers', default=4, type=int)
+    parser.add_argument('--rate', default=None, type=float,
+                        help='Maximum number of requests per second')
+    parser.add_argument('--max_retries', default=5, type=int)
+    parser.add_argument('--backoff', default=1., type=float,
+                        help='Seconds before the first retry (doubled on '
+                        'each retry)')
 
     args = parser.parse_args()
 
@@ -43,9 +131,8 @@ over all dataset, not only with the dt key equals test.')
         save = '%s_eval_apis.json' % args.dataset.split(os.path.sep)[-2]
 
     # Recovering text parser
-    label_parser = utils.get_from_module('preprocessing.text',
-                                        args.label_parser,
-                                        params=args.label_parser_params)
+    label_parser = PARSERS.get(args.label_parser,
+                               params=args.label_parser_params)
 
     if not utils.check_ext(args.dataset, 'json'):
         raise ValueError('dataset must be a json file')
@@ -55,48 +142,66 @@ over all dataset, not only with the dt key equals test.')
     if not args.all and 'dt' in dataset[0]:
         dataset = [d for d in dataset if d['dt'] == 'test']
 
-    apis = {'google': apis.recognize_google,
-            'ibm': apis.recognize_ibm,
-            'microsoft': apis.recognize_bing}
+    recognizers = {'google': apis.recognize_google,
+                   'ibm': apis.recognize_ibm,
+                   'microsoft': apis.recognize_bing,
+                   'http': lambda audio, **kwargs: apis.recognize_http(
+                       audio, url=args.http_url, **kwargs)}
 
     eval_apis = []
     if args.resume:
         with codecs.open(save, 'r', encoding='utf8') as f:
             eval_apis = json.load(f)
 
-    for i, data in enumerate(dataset):
-
-        if len(eval_apis) > i:
-            result = eval_apis[i]
-        else:
-            result = {}
-            result['label'] = data['label']
-            result['audio'] = data['audio']
-
-            if args.all and 'dt' in data:
-                result['dt'] = data['dt']
-
-        for api_name in args.apis:
-            if api_name in result and result[api_name] != '':
-                continue
-            try:
-                result[api_name] = apis[api_name](data['audio'], safe=False,
-                                                  language=args.language)
-            except Exception as e:
-                result[api_name] = ''
-                print(e)
-
-        if len(eval_apis) > i:
-            eval_apis[i] = result
-        else:
-            eval_apis.append(result)
-
-        if (args.save_every % (i + 1)) == 0:
-            with codecs.open(save, 'w', encoding='utf8') as f:
-                json.dump(eval_apis, f)
-
-        print('Done %d/%d' % (i + 1, len(dataset)))
-        time.sleep(.1)
-
-    with codecs.open(save, 'w', encoding='utf8') as f:
-        json.dump(eval_apis, f)
+    for data in dataset[len(eval_apis):]:
+        result = {}
+        result['label'] = data['label']
+        result['audio'] = data['audio']
+
+        if args.all and 'dt' in data:
+            result['dt'] = data['dt']
+
+        eval_apis.append(result)
+
+    lock = threading.Lock()
+    progress = {'done': 0, 'saved': 0}
+
+    def on_done(index, api_name, transcription):
+        with lock:
+            eval_apis[index][api_name] = transcription
+            progress['done'] += 1
+
+    runners, num_requests = [], 0
+    for api_name in args.apis:
+        # Empty transcriptions (failed requests) are requested again
+        pending = [(i, result['audio']) for i, result in enumerate(eval_apis)
+                   if result.get(api_name, '') == '']
+        num_requests += len(pending)
+
+        recognize = (lambda api: lambda audio: recognizers[api](
+            audio, safe=False, language=args.language))(api_name)
+        runner = APIRunner(api_name, recognize, on_done,
+                           num_workers=args.num_workers, rate=args.rate,
+                           max_retries=args.max_retries, backoff=args.backoff)
+        runner.start(pending)
+        runners.append(runner)
+
+    start = time.time()
+    try:
+        while any(runner.is_alive() for runner in runners):
+            time.sleep(.5)
+            with lock:
+                done = progress['done']
+                if done - progress['saved'] < args.save_every:
+                    continue
+                progress['saved'] = done
+                save_results(eval_apis, save)
+
+            print('Done %d/%d requests (%.2f requests/s)' % (
+                done, num_requests, done / (time.time() - start)))
+    except KeyboardInterrupt:
+        print('Interrupted. Saving the finished requests...')
+
+    with lock:
+        save_results(eval_apis, save)
+    print('Done %d/%d requests' % (progress['done'], num_requests))
@@ -0,0 +1,246 @@
+from __future__ import absolute_import, division, print_function
+
+import os
+# Preventing pool_allocator message
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
+
+import argparse
+import csv
+import json
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from utils import generic_utils as utils
+from utils.hparams import HParams
+from utils.registry import FEATURES, PARSERS
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Training args that change the cached batches
+PARSER_ARGS = ('input_parser', 'input_parser_params', 'label_parser',
+               'label_parser_params')
+
+
+def find_checkpoints(folder, checkpoint='best.h5'):
+    """ Walks folder looking for the checkpoints of each experiment
+    """
+    models = []
+    for subdir, dirs, files in os.walk(folder):
+        if checkpoint in files:
+            models.append(os.path.join(subdir, checkpoint))
+    return sorted(models)
+
+
+def build_caches(models, args, work_dir):
+    """ Reads the dataset once per parser configuration and saves its padded
+    batches in work_dir (see DatasetIterator.cache)
+
+    # Outputs
+        list of tasks (dictionaries with the model and the cache dir)
+    """
+    from datasets.dataset_generator import DatasetGenerator
+
+    caches, tasks = {}, []
+    for model in models:
+        try:
+            meta = utils.load_meta(model)
+        except KeyError:
+            logger.warning('meta not found in %s. Skipping' % model)
+            continue
+
+        hparams = HParams(**meta['training_args'])
+        for k in PARSER_ARGS:
+            if getattr(args, k) is not None:
+                setattr(hparams, k, getattr(args, k))
+
+        key = json.dumps([getattr(hparams, k) for k in PARSER_ARGS])
+        if key not in caches:
+            cache_dir = os.path.join(work_dir, 'cache_%d' % len(caches))
+
+            input_parser = FEATURES.get(
+                hparams.input_parser, params=hparams.input_parser_params or [])
+            label_parser = PARSERS.get(
+                hparams.label_parser, params=hparams.label_parser_params or [])
+
+            data_gen = DatasetGenerator(input_parser, label_parser,
+                                        batch_size=args.batch_size, seed=0)
+            test_flow = data_gen.flow_from_fname(args.dataset,
+                                                 datasets=args.subset)
+            test_flow.cache(num_samples=args.num_samples, seed=0,
+                            cache_dir=cache_dir)
+            caches[key] = cache_dir
+
+        tasks.append({'model': model, 'cache_dir': caches[key]})
+
+    return tasks
+
+
+def worker(args):
+    """ Evaluates the tasks not claimed yet by the other workers. The results
+    are appended to work_dir/results_RANK.jsonl
+    """
+    from keras import backend as K
+    from datasets.dataset_generator import BatchCache
+    from utils.core_utils import setup_gpu, load_model
+
+    gpu = args.gpus[args.rank % len(args.gpus)]
+
+    cpus = utils.parse_cpus(args.cpus)
+    if cpus is not None:
+        share = len(cpus) // args.num_workers
+        cpus = cpus[args.rank * share: (args.rank + 1) * share] or cpus
+
+    with open(os.path.join(args.work_dir, 'tasks.json')) as f:
+        tasks = json.load(f)
+
+    caches = {}
+    output = os.path.join(args.work_dir, 'results_%d.jsonl' % args.rank)
+
+    for index, task in enumerate(tasks):
+        # The first worker that creates the file evaluates the task
+        try:
+            os.close(os.open(os.path.join(args.work_dir, 'task_%05d' % index),
+                             os.O_CREAT | os.O_EXCL))
+        except OSError:
+            continue
+
+        if task['cache_dir'] not in caches:
+            caches[task['cache_dir']] = BatchCache.load(task['cache_dir'])
+        cache = caches[task['cache_dir']]
+
+        result = {'model': task['model'], 'worker': args.rank}
+        try:
+            setup_gpu(gpu, args.allow_growth, intra_op=args.intra_op,
+                      inter_op=args.inter_op, cpus=cpus)
+            model = load_model(task['model'], mode='eval')
+
+            start = time.time()
+            metrics = model.evaluate_generator(
+                BatchCache(cache.batches, cache.len), cache.len,
+                max_q_size=10, nb_worker=1)
+            result['elapsed'] = time.time() - start
+
+            result.update(zip(model.metrics_names,
+                              [float(m) for m in metrics]))
+        except Exception as e:
+            logger.exception('Unable to evaluate %s' % task['model'])
+            result['error'] = str(e)
+        finally:
+            K.clear_session()
+
+        with open(output, 'a') as f:
+            f.write(json.dumps(result) + '\n')
+
+        logger.info('%s evaluated by worker %d' % (task['model'], args.rank))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Evaluates many checkpoints \
+over the same dataset. The batches are read once and shared (memory-mapped) \
+by a pool of worker processes.')
+
+    parser.add_argument('--folder', default='results', type=str)
+    parser.add_argument('--checkpoint', default='best.h5', type=str)
+    # If set, folder is ignored
+    parser.add_argument('--models', nargs='+', default=None)
+
+    parser.add_argument('--dataset', required=True, type=str)
+    parser.add_argument('--subset', type=str, default='test')
+    parser.add_argument('--num_samples', default=None, type=int)
+    parser.add_argument('--batch_size', default=32, type=int)
+
+    # Recovered from the meta of each model if not set
+    parser.add_argument('--input_parser', type=str, default=None)
+    parser.add_argument('--input_parser_params', nargs='+', default=None)
+    parser.add_argument('--label_parser', type=str, default=None)
+    parser.add_argument('--label_parser_params', nargs='+', default=None)
+
+    # Workers (each one with its own session)
+    parser.add_argument('--num_workers', default=2, type=int)
+    parser.add_argument('--gpus', nargs='+', default=['0'])
+    parser.add_argument('--allow_growth', default=False, action='store_true')
+    # Split among the workers
+    parser.add_argument('--cpus', default=None, type=str)
+    parser.add_argument('--intra_op', default=None, type=int)
+    parser.add_argument('--inter_op', default=None, type=int)
+
+    # If set, the cached batches are kept in a subdirectory of it
+    parser.add_argument('--cache_dir', default=None, type=str)
+    parser.add_argument('--save', default=None, type=str)
+
+    # Set on each worker
+    parser.add_argument('--worker', default=False, action='store_true')
+    parser.add_argument('--rank', default=0, type=int)
+    parser.add_argument('--work_dir', default=None, type=str)
+
+    args = parser.parse_args()
+
+    if args.worker:
+        worker(args)
+        sys.exit(0)
+
+    models = args.models or find_checkpoints(args.folder, args.checkpoint)
+    if not len(models):
+        raise ValueError('No checkpoint found')
+
+    if args.cache_dir is not None:
+        utils.safe_mkdirs(args.cache_dir)
+    work_dir = tempfile.mkdtemp(dir=args.cache_dir)
+
+    try:
+        tasks = build_caches(models, args, work_dir)
+        with open(os.path.join(work_dir, 'tasks.json'), 'w') as f:
+            json.dump(tasks, f)
+
+        num_workers = min(args.num_workers, len(tasks))
+        print('Evaluating %d models with %d workers...' % (len(tasks),
+                                                          num_workers))
+
+        base_args = sys.argv[1:] + ['--worker', '--work_dir', work_dir,
+                                    '--num_workers', str(num_workers)]
+        workers = [subprocess.Popen([sys.executable, '-m',
+                                     'extras.eval_sweep'] + base_args +
+                                    ['--rank', str(rank)])
+                   for rank in range(num_workers)]
+        return_codes = [w.wait() for w in workers]
+
+        results = []
+        for rank in range(num_workers):
+            output = os.path.join(work_dir, 'results_%d.jsonl' % rank)
+            if os.path.exists(output):
+                with open(output) as f:
+                    results.extend(json.loads(l) for l in f)
+    finally:
+        if args.cache_dir is None:
+            shutil.rmtree(work_dir)
+
+    if any(return_codes) or len(results) < len(tasks):
+        print('%d/%d models were evaluated' % (len(results), len(tasks)))
+
+    metrics = sorted(set(k for r in results for k in r) -
+                     set(['model', 'worker', 'elapsed', 'error']))
+    sort_key = 'decoder_ler' if 'decoder_ler' in metrics else 'loss'
+    results.sort(key=lambda r: r.get(sort_key, float('inf')))
+
+    print('%-50s' % 'model' + ''.join('%14s' % m for m in metrics) +
+          '%12s' % 'elapsed (s)')
+    for r in results:
+        if 'error' in r:
+            print('%-50s %s' % (r['model'][-50:], r['error']))
+            continue
+        print('%-50s' % r['model'][-50:] +
+              ''.join('%14.4f' % r.get(m, float('nan')) for m in metrics) +
+              '%12.2f' % r['elapsed'])
+
+    if args.save is not None:
+        columns = ['model'] + metrics + ['elapsed', 'error']
+        with open(args.save, 'w') as f:
+            writer = csv.writer(f)
+            writer.writerow(columns)
+            for r in results:
+                writer.writerow([r.get(c, '') for c in columns])
@@ -0,0 +1,33 @@
+from __future__ import absolute_import, division, print_function
+
+import os
+# Preventing pool_allocator message
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
+
+import argparse
+
+from utils.core_utils import setup_gpu, export_frozen_model
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Exports an inference-only \
+frozen graph of a trained model.')
+
+    parser.add_argument('--model', required=True, type=str)
+    parser.add_argument('--output_dir', required=True, type=str)
+
+    parser.add_argument('--no_decoder', action='store_true', default=False)
+    parser.add_argument('--greedy', action='store_true', default=False)
+    parser.add_argument('--beam_width', default=400, type=int)
+
+    parser.add_argument('--gpu', default='-1', type=str)
+
+    args = parser.parse_args()
+
+    setup_gpu(args.gpu)
+
+    fname = export_frozen_model(args.model, args.output_dir,
+                                decoder=(not args.no_decoder),
+                                is_greedy=args.greedy,
+                                beam_width=args.beam_width)
+
+    print('Model %s exported at %s' % (args.model, fname))
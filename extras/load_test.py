@@ -0,0 +1,132 @@
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import json
+import socket
+import httplib
+import threading
+import time
+
+import h5py
+import numpy as np
+
+
+class UnixHTTPConnection(httplib.HTTPConnection):
+    """ HTTP connection over an unix socket
+    """
+
+    def __init__(self, path, timeout=None):
+        httplib.HTTPConnection.__init__(self, 'localhost', timeout=timeout)
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.path)
+
+
+def make_connection(args):
+    if args.unix_socket:
+        return UnixHTTPConnection(args.unix_socket, timeout=args.timeout)
+    return httplib.HTTPConnection(args.host, args.port, timeout=args.timeout)
+
+
+def request(args, method, path, body=None):
+    conn = make_connection(args)
+    try:
+        conn.request(method, path, body,
+                     {'Content-Type': 'application/json'})
+        response = conn.getresponse()
+        return response.status, json.loads(response.read())
+    finally:
+        conn.close()
+
+
+def load_bodies(args):
+    """ Returns the request bodies. Features are read from the HDF5 file;
+    otherwise the audio paths are sent to be processed by the server
+    """
+    if args.files:
+        return [json.dumps({'input': f}) for f in args.files]
+
+    with h5py.File(args.dataset, 'r') as f:
+        group = f[args.subset]
+        inputs = group['inputs']
+        num_feats = inputs.attrs['num_feats']
+        num_samples = min(len(inputs), args.num_samples)
+        return [json.dumps({'features':
+                            inputs[i].reshape((-1, num_feats)).tolist()})
+                for i in range(num_samples)]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Load generator for the \
+serving script (serve.py).')
+
+    parser.add_argument('--host', default='127.0.0.1', type=str)
+    parser.add_argument('--port', default=8000, type=int)
+    parser.add_argument('--unix_socket', default=None, type=str)
+    parser.add_argument('--timeout', default=60., type=float)
+
+    parser.add_argument('--dataset', default=None, type=str)
+    parser.add_argument('--subset', default='test', type=str)
+    parser.add_argument('--num_samples', default=100, type=int)
+    parser.add_argument('--files', default=None, type=str, nargs='+')
+
+    parser.add_argument('--num_requests', default=1000, type=int)
+    parser.add_argument('--concurrency', default=16, type=int)
+
+    args = parser.parse_args()
+
+    if args.dataset is None and args.files is None:
+        raise ValueError('dataset or files args must be set.')
+
+    bodies = load_bodies(args)
+
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+    counter = iter(range(args.num_requests))
+
+    def worker():
+        while True:
+            with lock:
+                try:
+                    i = next(counter)
+                except StopIteration:
+                    return
+
+            start = time.time()
+            try:
+                status, response = request(args, 'POST', '/recognize',
+                                           bodies[i % len(bodies)])
+                if status != 200:
+                    raise IOError(response.get('error'))
+            except Exception as e:
+                with lock:
+                    errors.append(e)
+                continue
+
+            with lock:
+                latencies.append(time.time() - start)
+
+    threads = [threading.Thread(target=worker)
+               for _ in range(args.concurrency)]
+
+    start = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.time() - start
+
+    print('Requests: %d (%d errors)' % (len(latencies) + len(errors),
+                                        len(errors)))
+    print('Throughput: %.2f requests/s' % (len(latencies) / elapsed))
+    if latencies:
+        print('Client latency p50: %.4fs' % np.percentile(latencies, 50))
+        print('Client latency p99: %.4fs' % np.percentile(latencies, 99))
+
+    status, metrics = request(args, 'GET', '/metrics')
+    print('Server metrics:')
+    for k, v in sorted(metrics.items()):
+        print('\t%s: %s' % (k, v))
@@ -2,11 +2,8 @@ from __future__ import absolute_import, division, print_function
 
 import argparse
 
-from utils import generic_utils as utils
 from utils.hparams import HParams
-
-import preprocessing
-import datasets
+from utils.registry import DATASETS, FEATURES, PARSERS
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Generates a preprocessed dataset (hdf5 file) by providing the path to the dataset and the correct parser.')
@@ -26,18 +23,18 @@ if __name__ == '__main__':
 
     parser.add_argument('--override', action='store_true')
 
+    # float16 halves the size of the features
+    parser.add_argument('--dtype', type=str, default='float32',
+                        choices=['float32', 'float16'])
+
     args = parser.parse_args()
 
-    parser = utils.get_from_module('datasets*',
-                                   args.parser,
-                                   regex=True)
+    parser = DATASETS.get(args.parser)
 
-    input_parser = utils.get_from_module('preprocessing.audio',
-                                         args.input_parser,
-                                         params=args.input_parser_params)
-    label_parser = utils.get_from_module('preprocessing.text',
-                                         args.label_parser,
-                                         params=args.label_parser_params)
+    input_parser = FEATURES.get(args.input_parser,
+                                params=args.input_parser_params)
+    label_parser = PARSERS.get(args.label_parser,
+                               params=args.label_parser_params)
 
     dataset = parser(args.dataset_dir,
                      **HParams().parse(args.parser_params).values())
@@ -45,6 +42,7 @@ if __name__ == '__main__':
     output_file = dataset.to_h5(fname=args.output_file,
                                 input_parser=input_parser,
                                 label_parser=label_parser,
-                                override=args.override)
+                                override=args.override,
+                                dtype=args.dtype)
 
     print('Dataset %s saved at %s' % (parser.name, output_file))
@@ -0,0 +1,25 @@
+from __future__ import absolute_import, division, print_function
+
+import argparse
+
+from utils.quantization_utils import quantize_model
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Post-training int8 \
+quantization of the W and U matrices of a trained model.')
+
+    parser.add_argument('--model', required=True, type=str)
+    parser.add_argument('--output_file', required=True, type=str)
+    parser.add_argument('--min_size', default=0, type=int)
+
+    args = parser.parse_args()
+
+    sizes = quantize_model(args.model, args.output_file,
+                           min_size=args.min_size)
+
+    print('Weights size: %.2f MB -> %.2f MB' % (sizes['original'] / 2**20,
+                                                 sizes['quantized'] / 2**20))
+    print('Quantized model saved at %s' % args.output_file)
+    print('Compare it against the original model with:\n'
+          '\tpython eval.py --model %s --compare_to %s --dataset DATASET'
+          % (args.output_file, args.model))
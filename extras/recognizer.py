@@ -13,6 +13,7 @@ import numpy as np
 import speech_recognition as sr
 
 import utils.generic_utils as utils
+from utils.registry import FEATURES, PARSERS
 
 from core.dataset_generator import DatasetIterator
 from utils.core_utils import setup_gpu
@@ -65,15 +66,12 @@ if __name__ == "__main__":
         training_args = meta['training_args']
 
         # Features extractor
-        input_parser = utils.get_from_module('preprocessing.audio',
-                                             training_args['feats'],
-                                             params=training_args['feats_params'])
+        input_parser = FEATURES.get(training_args['feats'],
+                                    params=training_args['feats_params'])
 
         # Recovering text parser
-        label_parser = utils.get_from_module('preprocessing.text',
-                                             training_args['label_parser'],
-                                             params=training_args['label_parser_params']
-                                            )
+        label_parser = PARSERS.get(training_args['label_parser'],
+                                   params=training_args['label_parser_params'])
 
         data_it = DatasetIterator(np.array([f for a, f in audios]),
                                   label_parser=input_parser,
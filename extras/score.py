@@ -0,0 +1,106 @@
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import codecs
+import json
+
+from utils.metrics_utils import error_counts, error_rate, group_counts
+from utils.registry import PARSERS
+
+
+def _input_of(entry):
+    # predict.py stores the audio path in `input`, eval_apis in `audio`
+    return entry.get('input', entry.get('audio'))
+
+
+def print_table(title, groups):
+    """ Prints the CER/WER (and S/D/I percentages) of each group
+
+    # Arguments
+        title: header of the first column
+        groups: list of (name, char counts, word counts, number of samples)
+    """
+    print('%-24s %6s %8s %6s %6s %6s %8s' % (title, 'n', 'CER', 'S', 'D',
+                                             'I', 'WER'))
+    for name, char, word, n in groups:
+        s, d, i, num = char
+        num = max(num, 1)
+        print('%-24s %6d %7.2f%% %5.1f%% %5.1f%% %5.1f%% %7.2f%%' % (
+            name[:24], n, 100 * error_rate(char), 100 * s / num,
+            100 * d / num, 100 * i / num, 100 * error_rate(word)))
+    print()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Scores the transcriptions \
+saved by predict.py (or eval_apis) with the character and word error rates.')
+
+    parser.add_argument('--results', required=True, type=str)
+    parser.add_argument('--hyp_key', default='prediction', type=str)
+    parser.add_argument('--ref_key', default='label', type=str)
+
+    # Dataset json (see dataset_parser.to_json) with the speakers/datasets
+    parser.add_argument('--dataset', default=None, type=str)
+    parser.add_argument('--by', nargs='+', default=[])
+
+    # If set, the references and hypotheses are sanitized by the parser
+    parser.add_argument('--label_parser', default=None, type=str)
+    parser.add_argument('--label_parser_params', nargs='+', default=[])
+
+    parser.add_argument('--save', default=None, type=str)
+
+    args = parser.parse_args()
+
+    with codecs.open(args.results, 'r', encoding='utf8') as f:
+        results = f.read()
+    try:
+        results = json.loads(results)
+    except ValueError:
+        # json lines (see predict.py)
+        results = [json.loads(l) for l in results.splitlines() if l.strip()]
+
+    results = [r for r in results if r.get(args.hyp_key) is not None]
+    if not len(results):
+        raise ValueError('No result with the key %s' % args.hyp_key)
+
+    if args.label_parser is not None:
+        label_parser = PARSERS.get(args.label_parser,
+                                   params=args.label_parser_params)
+        normalize = label_parser._sanitize
+    else:
+        normalize = lambda s: s
+
+    refs = [u' '.join(normalize(r[args.ref_key]).split()) for r in results]
+    hyps = [u' '.join(normalize(r[args.hyp_key]).split()) for r in results]
+
+    char_counts = error_counts(hyps, refs, unit='char')
+    word_counts = error_counts(hyps, refs, unit='word')
+
+    print_table('total', [('all', char_counts.sum(axis=0),
+                           word_counts.sum(axis=0), len(results))])
+
+    if args.dataset is not None:
+        with codecs.open(args.dataset, 'r', encoding='utf8') as f:
+            dataset = {_input_of(d): d for d in json.load(f)}
+        for r in results:
+            r.update({k: v for k, v in dataset.get(_input_of(r), {}).items()
+                      if k not in r})
+
+    for key in args.by:
+        groups = [u'%s' % r.get(key) for r in results]
+        chars, words = (group_counts(char_counts, groups),
+                        group_counts(word_counts, groups))
+        sizes = {g: groups.count(g) for g in chars}
+
+        print_table(key, [(g, chars[g], words[g], sizes[g])
+                          for g in sorted(chars, key=lambda g: -sizes[g])])
+
+    if args.save is not None:
+        for r, char, word in zip(results, char_counts, word_counts):
+            r['char_errors'] = dict(zip('SDIN', char.tolist()))
+            r['word_errors'] = dict(zip('SDIN', word.tolist()))
+
+        with codecs.open(args.save, 'w', encoding='utf8') as f:
+            json.dump({'cer': float(error_rate(char_counts)),
+                       'wer': float(error_rate(word_counts)),
+                       'results': results}, f)
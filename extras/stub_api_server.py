@@ -0,0 +1,129 @@
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import codecs
+import hashlib
+import json
+import random
+import threading
+import time
+import SocketServer
+import BaseHTTPServer
+
+import logging
+
+
+class StubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """ Mimics a speech recognition API (see apis.recognize_http): a POST
+    with the wav file is answered with `{"transcript": ...}` after the
+    configured latency. Some requests may fail with 503 (error_rate) or 429
+    (more than max_rps requests per second)
+    """
+
+    def do_POST(self):
+        server = self.server
+
+        length = int(self.headers.getheader('content-length', 0))
+        body = self.rfile.read(length)
+
+        with server.lock:
+            now = time.time()
+            server.requests = [t for t in server.requests if now - t < 1.]
+            limited = server.max_rps and len(server.requests) >= \
+                server.max_rps
+            server.requests.append(now)
+
+        time.sleep(max(0., random.gauss(server.latency, server.jitter)))
+
+        if limited:
+            return self._send(429, {'error': 'too many requests'})
+
+        if random.random() < server.error_rate:
+            return self._send(503, {'error': 'service unavailable'})
+
+        transcript = server.transcripts.get(hashlib.sha1(body).hexdigest(),
+                                            server.default_transcript)
+        self._send(200, {'transcript': transcript})
+
+    def _send(self, code, data):
+        body = json.dumps(data)
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.getLogger(__name__).debug(format, *args)
+
+
+class StubServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """ Threaded stub server
+
+    # Arguments
+        address: (host, port)
+        latency: mean seconds before each answer
+        jitter: standard deviation of the latency
+        error_rate: fraction of the requests answered with 503
+        max_rps: if set, the requests beyond it (per second) get a 429
+        transcripts: dictionary mapping the sha1 of each audio file to its
+        transcript. Unknown audios are answered with default_transcript
+    """
+    daemon_threads = True
+
+    def __init__(self, address, latency=0., jitter=0., error_rate=0.,
+                 max_rps=None, transcripts=None, default_transcript=u''):
+        BaseHTTPServer.HTTPServer.__init__(self, address, StubHandler)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.max_rps = max_rps
+        self.transcripts = transcripts or {}
+        self.default_transcript = default_transcript
+
+        self.lock = threading.Lock()
+        self.requests = []
+
+
+def load_transcripts(dataset):
+    """ Maps the sha1 of the audio files of a dataset json to their labels
+    """
+    with codecs.open(dataset, 'r', encoding='utf8') as f:
+        data = json.load(f)
+
+    transcripts = {}
+    for d in data:
+        with open(d.get('audio', d.get('input')), 'rb') as f:
+            transcripts[hashlib.sha1(f.read()).hexdigest()] = d['label']
+    return transcripts
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Local stub of a speech \
+recognition API, to test extras/eval_apis.py offline (--apis http \
+--http_url http://HOST:PORT/recognize).')
+
+    parser.add_argument('--host', default='127.0.0.1', type=str)
+    parser.add_argument('--port', default=8080, type=int)
+
+    parser.add_argument('--latency', default=.5, type=float)
+    parser.add_argument('--jitter', default=.1, type=float)
+    parser.add_argument('--error_rate', default=0., type=float)
+    parser.add_argument('--max_rps', default=None, type=float)
+
+    # If set, each audio of the dataset is answered with its label
+    parser.add_argument('--dataset', default=None, type=str)
+
+    args = parser.parse_args()
+
+    transcripts = load_transcripts(args.dataset) if args.dataset else None
+
+    server = StubServer((args.host, args.port), latency=args.latency,
+                        jitter=args.jitter, error_rate=args.error_rate,
+                        max_rps=args.max_rps, transcripts=transcripts)
+
+    print('Listening on http://%s:%d' % (args.host, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
@@ -0,0 +1,251 @@
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import codecs
+import itertools
+import json
+import multiprocessing
+import os
+import time
+
+import h5py
+import numpy as np
+
+from utils import generic_utils as utils
+from utils.metrics_utils import error_counts, error_rate
+from utils.numpy_engine import ctc_beam_search_decode
+from utils.registry import PARSERS
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Decoder parameters that can be tuned (see ctc_beam_search_decode)
+TUNABLE = {'beam_width': int, 'temperature': float,
+           'insertion_bonus': float, 'prune': float}
+
+# Set by the initializer of each worker
+_worker = {}
+
+
+def cache_posteriors(fname, cache_dir):
+    """ Copies the posteriors saved by `predict.py --no_decoder` (vlen
+    datasets, which can not be memory-mapped) to a flat float32 file of
+    shape (total timesteps, num_labels). It is only rebuilt if fname changes
+
+    # Outputs
+        the cache meta (num_labels, num_frames and number of samples)
+    """
+    meta_fname = os.path.join(cache_dir, 'meta.json')
+    mtime = os.path.getmtime(fname)
+
+    if os.path.exists(meta_fname):
+        with open(meta_fname) as f:
+            meta = json.load(f)
+        if meta['source'] == os.path.abspath(fname) and \
+                meta['mtime'] == mtime:
+            return meta
+
+    utils.safe_mkdirs(cache_dir)
+
+    with h5py.File(fname, 'r') as f:
+        predictions = f['predictions']
+        num_labels = int(predictions.attrs['num_labels'])
+        labels = [l.decode('utf8') if isinstance(l, bytes) else l
+                  for l in f['labels']]
+
+        offsets = [0]
+        with open(os.path.join(cache_dir, 'posteriors.f32'), 'wb') as out:
+            for prediction in predictions:
+                out.write(np.asarray(prediction, dtype='float32').tobytes())
+                offsets.append(offsets[-1] + prediction.size // num_labels)
+
+    np.save(os.path.join(cache_dir, 'offsets.npy'), np.array(offsets))
+    with codecs.open(os.path.join(cache_dir, 'labels.json'), 'w',
+                     encoding='utf8') as f:
+        json.dump(labels, f)
+
+    meta = {'source': os.path.abspath(fname), 'mtime': mtime,
+            'num_labels': num_labels, 'num_frames': offsets[-1],
+            'num_samples': len(labels)}
+    with open(meta_fname, 'w') as f:
+        json.dump(meta, f)
+
+    return meta
+
+
+def parse_space(specs):
+    """ Parses the search space, e.g. ['beam_width=10,100', 'prune=5:15'].
+    Values separated by commas are choices and `low:high` is a range (only
+    for random search)
+    """
+    space = {}
+    for spec in specs:
+        name, values = spec.split('=')
+        if name not in TUNABLE:
+            raise ValueError('%s is not tunable. Choose from %s' % (
+                name, ', '.join(sorted(TUNABLE))))
+
+        cast = TUNABLE[name]
+        if ':' in values:
+            low, high = values.split(':')
+            space[name] = (cast(low), cast(high))
+        else:
+            space[name] = [cast(v) for v in values.split(',')]
+    return space
+
+
+def grid_search(space):
+    names = sorted(space)
+    if any(isinstance(space[n], tuple) for n in names):
+        raise ValueError('ranges (low:high) are only supported by random '
+                         'search')
+    return [dict(zip(names, values))
+            for values in itertools.product(*[space[n] for n in names])]
+
+
+def random_search(space, num_trials, seed=0):
+    rng = np.random.RandomState(seed)
+    configs = []
+    for _ in range(num_trials):
+        config = {}
+        for name, values in sorted(space.items()):
+            if not isinstance(values, tuple):
+                config[name] = values[rng.randint(len(values))]
+            elif TUNABLE[name] is int:
+                config[name] = int(rng.randint(values[0], values[1] + 1))
+            else:
+                config[name] = float(rng.uniform(*values))
+        configs.append(config)
+    return configs
+
+
+def _init_worker(cache_dir, indices, label_parser, top_paths):
+    with open(os.path.join(cache_dir, 'meta.json')) as f:
+        meta = json.load(f)
+    with codecs.open(os.path.join(cache_dir, 'labels.json'), 'r',
+                     encoding='utf8') as f:
+        labels = json.load(f)
+
+    _worker['posteriors'] = np.memmap(
+        os.path.join(cache_dir, 'posteriors.f32'), dtype='float32', mode='r',
+        shape=(meta['num_frames'], meta['num_labels']))
+    _worker['offsets'] = np.load(os.path.join(cache_dir, 'offsets.npy'))
+    _worker['indices'] = indices
+    _worker['refs'] = [u' '.join(label_parser._sanitize(labels[i]).split())
+                       for i in indices]
+    _worker['label_parser'] = label_parser
+    _worker['top_paths'] = top_paths
+
+
+def evaluate(config):
+    """ Decodes the cached posteriors with config and scores them
+    """
+    posteriors, offsets = _worker['posteriors'], _worker['offsets']
+    label_parser = _worker['label_parser']
+    refs = _worker['refs']
+
+    start = time.time()
+    hyps, oracle = [], []
+    for index, ref in zip(_worker['indices'], refs):
+        y_pred = posteriors[offsets[index]: offsets[index + 1]]
+        paths = ctc_beam_search_decode(y_pred, len(y_pred),
+                                       top_paths=_worker['top_paths'],
+                                       **config)
+        texts = [u' '.join(label_parser.imap(p).split()) for p, _ in paths]
+        hyps.append(texts[0])
+
+        # Best of the top paths
+        counts = error_counts(texts, [ref] * len(texts))
+        oracle.append(counts[np.argmin(counts[:, :3].sum(axis=1))])
+
+    char_counts = error_counts(hyps, refs, unit='char')
+    word_counts = error_counts(hyps, refs, unit='word')
+
+    return {'config': config,
+            'cer': float(error_rate(char_counts)),
+            'wer': float(error_rate(word_counts)),
+            'oracle_cer': float(error_rate(oracle)),
+            'char_counts': char_counts.sum(axis=0).tolist(),
+            'elapsed': time.time() - start}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Tunes the beam search \
+decoder on the posteriors saved by `predict.py --no_decoder --save FILE`, \
+without running the network again.')
+
+    parser.add_argument('--posteriors', required=True, type=str)
+    # Defaults to the posteriors file without extension + _cache
+    parser.add_argument('--cache_dir', default=None, type=str)
+
+    parser.add_argument('--label_parser', type=str,
+                        default='simple_char_parser')
+    parser.add_argument('--label_parser_params', nargs='+', default=[])
+
+    # e.g. --space beam_width=10,50,100 temperature=0.8:1.2
+    parser.add_argument('--space', nargs='+',
+                        default=['beam_width=1,10,50,100'])
+    # If set, num_trials random configurations are evaluated instead of
+    # the whole grid
+    parser.add_argument('--random', default=None, type=int)
+    parser.add_argument('--top_paths', default=1, type=int)
+
+    parser.add_argument('--num_samples', default=None, type=int)
+    parser.add_argument('--seed', default=0, type=int)
+    parser.add_argument('--num_workers', type=int,
+                        default=multiprocessing.cpu_count())
+
+    parser.add_argument('--save', default=None, type=str)
+
+    args = parser.parse_args()
+
+    cache_dir = args.cache_dir or '%s_cache' % os.path.splitext(
+        args.posteriors)[0]
+    meta = cache_posteriors(args.posteriors, cache_dir)
+
+    label_parser = PARSERS.get(args.label_parser,
+                               params=args.label_parser_params)
+
+    indices = np.arange(meta['num_samples'])
+    if args.num_samples and args.num_samples < len(indices):
+        indices = np.sort(np.random.RandomState(args.seed).choice(
+            indices, args.num_samples, replace=False))
+
+    space = parse_space(args.space)
+    if args.random:
+        configs = random_search(space, args.random, seed=args.seed)
+    else:
+        configs = grid_search(space)
+
+    num_workers = min(args.num_workers, len(configs))
+    print('Evaluating %d configurations over %d samples with %d workers...'
+          % (len(configs), len(indices), num_workers))
+
+    pool = multiprocessing.Pool(num_workers, initializer=_init_worker,
+                                initargs=(cache_dir, indices, label_parser,
+                                          args.top_paths))
+    try:
+        results = []
+        for result in pool.imap_unordered(evaluate, configs):
+            logger.info('%s: cer %.4f, wer %.4f' % (
+                result['config'], result['cer'], result['wer']))
+            results.append(result)
+    finally:
+        pool.terminate()
+
+    results.sort(key=lambda r: (r['cer'], r['wer']))
+
+    names = sorted(space)
+    fmt = lambda v: '%16.4g' % v if isinstance(v, float) else '%16s' % v
+    print(''.join('%16s' % n for n in names) +
+          '%9s %9s %11s %12s' % ('CER', 'WER', 'oracle CER', 'elapsed (s)'))
+    for r in results:
+        print(''.join(fmt(r['config'][n]) for n in names) +
+              '%8.2f%% %8.2f%% %10.2f%% %12.2f' % (
+                  100 * r['cer'], 100 * r['wer'], 100 * r['oracle_cer'],
+                  r['elapsed']))
+
+    if args.save is not None:
+        with open(args.save, 'w') as f:
+            json.dump(results, f)
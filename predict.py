@@ -1,19 +1,113 @@
 import argparse
 import json
-import h5py
 import os
 import numpy as np
 import codecs
 
-from datasets.dataset_generator import DatasetGenerator, DatasetIterator
-
-from utils.core_utils import setup_gpu, load_model
-
 from utils.hparams import HParams
 from utils import generic_utils as utils
+from utils.registry import FEATURES, PARSERS
 
 from preprocessing import audio, text
 
+# Only needed by `--no_decoder` (see H5Writer)
+h5py = utils.LazyModule('h5py')
+
+
+class JsonLinesWriter(object):
+    """ Appends each result as a json line
+
+    # Arguments
+        fname: output file
+        resume: if True, the results already in fname are kept (an
+        incomplete last line, e.g. of a crash, is removed)
+    """
+
+    def __init__(self, fname, resume=False):
+        self.done = set()
+        offset = 0
+
+        if resume and os.path.exists(fname):
+            with open(fname, 'rb') as f:
+                for line in f:
+                    # A line without its newline was cut by a crash, even
+                    # if its json is complete
+                    if not line.endswith(b'\n'):
+                        break
+                    try:
+                        result = json.loads(line.decode('utf8'))
+                    except ValueError:
+                        break
+                    self.done.add(result['input'])
+                    offset += len(line)
+
+        self.f = codecs.open(fname, 'a' if resume else 'w', encoding='utf8')
+        self.f.truncate(offset)
+
+    def write(self, result):
+        self.f.write(json.dumps(result) + '\n')
+
+    def flush(self):
+        self.f.flush()
+
+    def close(self):
+        self.f.close()
+
+
+class H5Writer(object):
+    """ Appends the outputs of the network (before the decoder) to a HDF5
+    file with the datasets `predictions` (flattened, see its attr
+    num_labels), `labels` and `inputs`
+
+    # Arguments
+        fname: output file
+        resume: if True, the results already in fname are kept (the
+        datasets are truncated to the last complete result)
+    """
+
+    def __init__(self, fname, resume=False):
+        self.f = h5py.File(fname, 'a' if resume else 'w')
+        self.done = set()
+
+        if 'predictions' in self.f:
+            datasets = [self.f[k] for k in ('predictions', 'labels', 'inputs')]
+            size = min(d.shape[0] for d in datasets)
+            for d in datasets:
+                d.resize(size, axis=0)
+            self.done.update(i.decode('utf8') if isinstance(i, bytes) else i
+                             for i in self.f['inputs'][:])
+
+    def _create_datasets(self, num_labels):
+        predictions = self.f.create_dataset(
+            'predictions', (0,), maxshape=(None,),
+            dtype=h5py.special_dtype(vlen=np.dtype('float32')))
+        predictions.attrs['num_labels'] = num_labels
+
+        for name in ('labels', 'inputs'):
+            self.f.create_dataset(name, (0,), maxshape=(None,),
+                                  dtype=h5py.special_dtype(vlen=unicode))
+
+    def write(self, result):
+        if 'predictions' not in self.f:
+            self._create_datasets(result['prediction'].shape[-1])
+
+        values = {'predictions':
+                  result['prediction'].flatten().astype('float32'),
+                  'labels': result['label'].encode('utf8'),
+                  'inputs': result['input']}
+
+        for name in ('predictions', 'labels', 'inputs'):
+            dataset = self.f[name]
+            dataset.resize(dataset.shape[0] + 1, axis=0)
+            dataset[dataset.shape[0] - 1] = values[name]
+
+    def flush(self):
+        self.f.flush()
+
+    def close(self):
+        self.f.close()
+
+
 if __name__ == '__main__':
 
     parser = argparse.ArgumentParser(description='Evaluating an ASR system.')
@@ -36,43 +130,74 @@ if __name__ == '__main__':
     # Other configs
     parser.add_argument('--gpu', default='0', type=str)
     parser.add_argument('--allow_growth', default=False, action='store_true')
-
+    # CPU threads and affinity (e.g. --cpus 0-11 --loader_cpus 12-15)
+    parser.add_argument('--intra_op', default=None, type=int)
+    parser.add_argument('--inter_op', default=None, type=int)
+    parser.add_argument('--cpus', default=None, type=str)
+    parser.add_argument('--loader_cpus', default=None, type=str)
+
+    # The decoded outputs are saved as json lines and the outputs of the
+    # network (no_decoder) as HDF5
     parser.add_argument('--save', default=None, type=str)
     parser.add_argument('--override', default=False, action='store_true')
+    # Skips the inputs already saved
+    parser.add_argument('--resume', default=False, action='store_true')
+    parser.add_argument('--flush_every', default=128, type=int)
 
     args = parser.parse_args()
     args_nondefault = utils.parse_nondefault_args(
         args, parser.parse_args(
             ['--model', args.model, '--dataset', args.dataset]))
 
+    # Imported after parsing the arguments, so `--help` starts fast
+    from datasets.dataset_generator import DatasetGenerator, DatasetIterator
+
+    from utils.core_utils import setup_gpu, load_model
+    from utils.frozen_utils import load_frozen_model
+
     if args.dataset is None and args.file is None:
         raise ValueError('dataset or file args must be set.')
 
     if args.dataset and args.file:
         print('Both dataset and file args was set. Ignoring file args.')
 
+    if args.save is not None and os.path.exists(args.save):
+        if not (args.override or args.resume):
+            raise IOError('Unable to create file')
+
     # GPU configuration
-    setup_gpu(args.gpu, args.allow_growth)
+    setup_gpu(args.gpu, args.allow_growth, intra_op=args.intra_op,
+              inter_op=args.inter_op, cpus=args.cpus)
+    loader_cpus = args.loader_cpus
+    # Output settings (the defaults are not in args_nondefault and train.py
+    # has its own --save)
+    save, resume, flush_every = args.save, args.resume, args.flush_every
 
     # Loading model
-    model, meta = load_model(args.model, return_meta=True, mode='eval')
+    frozen = os.path.isdir(args.model)
+    if frozen:
+        # Inference-only model exported by extras/export_model.py
+        model, meta = load_frozen_model(args.model, return_meta=True)
+    else:
+        model, meta = load_model(args.model, return_meta=True, mode='eval')
 
     args = HParams(**meta['training_args']).update(vars(args_nondefault))
 
+    if frozen:
+        args.no_decoder = not meta['decoder']
+
     # Features extractor
-    input_parser = utils.get_from_module('preprocessing.audio',
-                                         args.input_parser,
-                                         params=args.input_parser_params)
+    input_parser = FEATURES.get(args.input_parser,
+                                params=args.input_parser_params)
 
     # Recovering text parser
-    label_parser = utils.get_from_module('preprocessing.text',
-                                         args.label_parser,
-                                         params=args.label_parser_params)
+    label_parser = PARSERS.get(args.label_parser,
+                               params=args.label_parser_params)
 
     if args.dataset is not None:
         data_gen = DatasetGenerator(input_parser, label_parser,
                                     batch_size=1, seed=0, mode='predict',
-                                    shuffle=False)
+                                    shuffle=False, loader_cpus=loader_cpus)
         test_flow = data_gen.flow_from_fname(args.dataset,
                                              datasets=args.subset)
     else:
@@ -82,11 +207,35 @@ if __name__ == '__main__':
                                     shuffle=False)
         test_flow.labels = np.array([u''])
 
-    model = load_model(args.model, mode='predict',
-                       decoder=(not args.no_decoder))
+    if not frozen:
+        model = load_model(args.model, mode='predict',
+                           decoder=(not args.no_decoder))
 
-    results = []
-    for index in range(test_flow.len):
+    if args.no_decoder and save is None:
+        raise ValueError('save param must be set if no_decoder is True')
+
+    writer = None
+    if save is not None:
+        writer = (H5Writer if args.no_decoder else JsonLinesWriter)(
+            save, resume=resume)
+
+    # The results are identified by the audio path or, if the dataset stores
+    # the features (HDF5), by the subset and index
+    if isinstance(test_flow.inputs, np.ndarray):
+        names = test_flow.inputs
+    else:
+        names = [u'%s/%d' % (args.subset, i) for i in range(test_flow.len)]
+
+    # Indices of the inputs that were not saved yet
+    pending = range(test_flow.len)
+    if writer is not None and writer.done:
+        pending = [i for i in pending if names[i] not in writer.done]
+        print('%d/%d already done.' % (test_flow.len - len(pending),
+                                       test_flow.len))
+        if len(pending):
+            test_flow.select(pending)
+
+    for count, index in enumerate(pending, 1):
         prediction = model.predict(test_flow.next())
         if not args.no_decoder:
             prediction = label_parser.imap(prediction[0])
@@ -97,59 +246,19 @@ if __name__ == '__main__':
         else:
             prediction = prediction[0]
 
-        results.append({'label': test_flow.labels[index],
-                        'prediction': prediction,
-                        'input': test_flow.inputs[index]})
+        if writer is None:
+            continue
 
-    if args.save is not None:
-        if os.path.exists(args.save):
-            if not args.override:
-                raise IOError('Unable to create file')
-            os.remove(args.save)
+        writer.write({'label': test_flow.labels[index],
+                      'prediction': prediction, 'input': names[index]})
 
-        if args.no_decoder:
-            with h5py.File(args.save) as f:
-                predictions = f.create_dataset(
-                    'predictions', (0,), maxshape=(None,),
-                    dtype=h5py.special_dtype(vlen=np.dtype('float32')))
-                predictions.attrs['num_labels'] = results[0]['prediction'].shape[-1]
+        if count % flush_every == 0:
+            writer.flush()
+            print('%d/%d done.' % (count, len(pending)))
 
-                labels = f.create_dataset(
-                    'labels', (0,), maxshape=(None,),
-                    dtype=h5py.special_dtype(vlen=unicode))
-
-                inputs = f.create_dataset(
-                    'inputs', (0,), maxshape=(None,),
-                    dtype=h5py.special_dtype(vlen=unicode))
-
-                for index, result in enumerate(results):
-
-                    label = result['label']
-                    prediction = result['prediction']
-                    input_ = result['input']
-
-                    inputs.resize(inputs.shape[0] + 1, axis=0)
-                    inputs[inputs.shape[0] - 1] = input_
-
-                    labels.resize(labels.shape[0] + 1, axis=0)
-                    labels[labels.shape[0] - 1] = label.encode('utf8')
-
-                    predictions.resize(predictions.shape[0] + 1, axis=0)
-                    predictions[predictions.shape[0] - 1] = prediction.flatten().astype('float32')
-
-                    # Flush to disk only when it reaches 128 samples
-                    if index % 128 == 0:
-                        print('%d/%d done.' % (index, len(results)))
-                        f.flush()
-
-                f.flush()
-                print('%d/%d done.' % (len(results), len(results)))
-        else:
-            raise ValueError('save param must be set if no_decoder is Truepython')
-
-    else:
-        with codecs.open(args.save, 'w', encoding='utf8') as f:
-            json.dump(results, f)
+    if writer is not None:
+        writer.close()
+        print('%d/%d done.' % (len(pending), len(pending)))
 
     from keras import backend as K
     K.clear_session()
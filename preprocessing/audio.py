@@ -5,14 +5,14 @@ from __future__ import division
 from __future__ import print_function
 
 from . import audio_utils as sigproc
+from utils.registry import FEATURES
 
 import os
 import numpy as np
 import logging
 
-from scipy import signal
-from scipy.fftpack import dct
-import librosa
+# scipy and librosa are imported when used, so importing the features (e.g.
+# by `train.py --help`) is fast
 
 
 class Feature(object):
@@ -54,6 +54,7 @@ class Feature(object):
         """
         if ((isinstance(audio, str) or isinstance(audio, unicode))
             and os.path.isfile(audio)):
+            import librosa
             audio, current_fs = librosa.audio.load(audio)
             audio = librosa.core.resample(audio, current_fs, self.fs)
             feats = self._call(audio)
@@ -157,6 +158,7 @@ class Feature(object):
         return self._num_feats
 
 
+@FEATURES.register
 class FBank(Feature):
     """Compute Mel-filterbank energy features from an audio signal.
 
@@ -174,12 +176,12 @@ class FBank(Feature):
         pre_emph: apply preemphasis filter with preemph as coefficient.
         0 is no filter. Default is 0.97.
         win_func: the analysis window to apply to each frame.
-            By default hamming window is applied.
+            By default (None) hamming window is applied.
     """
 
     def __init__(self, win_len=0.025, win_step=0.01,
                  num_filt=40, nfft=512, low_freq=20, high_freq=7800,
-                 pre_emph=0.97, win_fun=signal.hamming, **kwargs):
+                 pre_emph=0.97, win_fun=None, **kwargs):
 
         super(FBank, self).__init__(**kwargs)
 
@@ -193,6 +195,9 @@ class FBank(Feature):
         self.low_freq = low_freq
         self.high_freq = high_freq or self.fs / 2
         self.pre_emph = pre_emph
+        if win_fun is None:
+            from scipy import signal
+            win_fun = signal.hamming
         self.win_fun = win_fun
         self._filterbanks = self._get_filterbanks()
 
@@ -306,6 +311,7 @@ class FBank(Feature):
         return "fbank"
 
 
+@FEATURES.register
 class MFCC(FBank):
     """Compute MFCC features from an audio signal.
 
@@ -349,6 +355,8 @@ class MFCC(FBank):
         """
         feat, energy = super(MFCC, self)._call(signal)
 
+        from scipy.fftpack import dct
+
         feat = np.log(feat)
         feat = dct(feat, type=2, axis=1, norm='ortho')[:, :self.num_cep]
         feat = self._lifter(feat, self.cep_lifter)
@@ -391,6 +399,7 @@ class MFCC(FBank):
         return "mfcc"
 
 
+@FEATURES.register
 class LogFbank(FBank):
     """Compute Mel-filterbank energy features from an audio signal.
 
@@ -445,6 +454,7 @@ class LogFbank(FBank):
         return "logfbank"
 
 
+@FEATURES.register
 class Raw(Feature):
     """ Raw features extractor
     """
@@ -462,4 +472,4 @@ class Raw(Feature):
         return "raw"
 
 
-raw = Raw()
+raw = FEATURES.register(Raw(), 'raw')
@@ -6,6 +6,8 @@ from unidecode import unidecode
 import logging
 import numpy as np
 
+from utils.registry import PARSERS
+
 PUNCTUATIONS = "'""-,.!?:;"
 ACCENTS = u'ãõçâêôáíóúàüóé'
 
@@ -31,6 +33,7 @@ class BaseParser(object):
         pass
 
 
+@PARSERS.register
 class CharParser(BaseParser):
     """ Class responsible to map any text in a certain character vocabulary
 
@@ -143,5 +146,6 @@ class CharParser(BaseParser):
         return vocab, inv_vocab
 
 
-simple_char_parser = CharParser()
-complex_char_parser = CharParser(mode='s|p|a|d')
+simple_char_parser = PARSERS.register(CharParser(), 'simple_char_parser')
+complex_char_parser = PARSERS.register(CharParser(mode='s|p|a|d'),
+                                       'complex_char_parser')
@@ -0,0 +1,217 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+# Preventing pool_allocator message
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
+
+import argparse
+import json
+import SocketServer
+import BaseHTTPServer
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+
+import logging
+
+from utils import generic_utils as utils
+from utils.hparams import HParams
+from utils.registry import FEATURES, PARSERS
+from utils.batching import BatchCoalescer
+
+from utils.core_utils import setup_gpu, load_model
+
+
+class RecognizerHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """ Handles the HTTP requests
+
+    Routes:
+        POST /recognize: JSON body with the key `input` (path to an audio
+        file) or `features` (a list of feature frames). Returns the
+        transcription
+        GET /metrics: latency percentiles and queue depth
+    """
+
+    def do_GET(self):
+        if self.path != '/metrics':
+            return self._send(404, {'error': 'not found'})
+
+        metrics = self.server.coalescer.monitor.summary()
+        metrics['queue_depth'] = self.server.coalescer.queue_depth
+
+        self._send(200, metrics)
+
+    def do_POST(self):
+        if self.path != '/recognize':
+            return self._send(404, {'error': 'not found'})
+
+        try:
+            length = int(self.headers.getheader('content-length', 0))
+            body = json.loads(self.rfile.read(length))
+
+            if 'features' in body:
+                feats = np.asarray(body['features'], dtype='float32')
+            elif self.server.input_parser is not None:
+                # Feature extraction runs in the thread pool
+                feats = self.server.pool.apply(self.server.input_parser,
+                                               (body['input'],))
+            else:
+                raise ValueError('input_parser is not set. Send features '
+                                 'instead.')
+
+            transcription = self.server.coalescer.submit(
+                feats, timeout=self.server.request_timeout)
+        except (ValueError, KeyError) as e:
+            return self._send(400, {'error': str(e)})
+        except Exception as e:
+            return self._send(500, {'error': str(e)})
+
+        self._send(200, {'transcription': transcription})
+
+    def _send(self, code, data):
+        body = json.dumps(data)
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # Unix sockets does not have a (host, port) address
+        if isinstance(self.client_address, tuple):
+            return BaseHTTPServer.BaseHTTPRequestHandler.address_string(self)
+        return 'unix'
+
+    def log_message(self, format, *args):
+        logging.getLogger(__name__).info(format, *args)
+
+
+class HTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class UnixHTTPServer(SocketServer.ThreadingMixIn,
+                     SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+
+def make_batch_fn(model, label_parser):
+    """ Returns a function that runs the model over a list of features
+    """
+    import tensorflow as tf
+
+    # Keras predict must run in the graph where the model was loaded
+    graph = tf.get_default_graph()
+    model._make_predict_function()
+
+    def batch_fn(batch):
+        inputs_length = np.asarray([f.shape[0] for f in batch])
+        inputs = np.zeros((len(batch), inputs_length.max(),
+                           batch[0].shape[1]), dtype='float32')
+        for i, f in enumerate(batch):
+            inputs[i, :f.shape[0]] = f
+
+        with graph.as_default():
+            predictions = model.predict([inputs, inputs_length],
+                                        batch_size=len(batch))
+
+        # The decoded labels are padded with -1 (an empty hypothesis is all
+        # padding)
+        return [label_parser.imap(p[p != -1]) for p in predictions]
+
+    return batch_fn
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serving an ASR system.')
+
+    parser.add_argument('--model', required=True, type=str)
+
+    # Server settings
+    parser.add_argument('--host', default='127.0.0.1', type=str)
+    parser.add_argument('--port', default=8000, type=int)
+    parser.add_argument('--unix_socket', default=None, type=str)
+    parser.add_argument('--timeout', default=60., type=float)
+
+    # Batching settings
+    parser.add_argument('--max_batch_size', default=32, type=int)
+    parser.add_argument('--max_wait', default=0.01, type=float)
+    parser.add_argument('--num_workers', default=4, type=int)
+
+    # Features generation (if necessary)
+    parser.add_argument('--input_parser', type=str, default=None)
+    parser.add_argument('--input_parser_params', nargs='+', default=[])
+
+    # Label generation (if necessary)
+    parser.add_argument('--label_parser', type=str,
+                        default='simple_char_parser')
+    parser.add_argument('--label_parser_params', nargs='+', default=[])
+
+    # Decoder settings
+    parser.add_argument('--beam_width', default=400, type=int)
+    parser.add_argument('--greedy', default=False, action='store_true')
+
+    # Other configs
+    parser.add_argument('--gpu', default='0', type=str)
+    parser.add_argument('--allow_growth', default=False, action='store_true')
+
+    args = parser.parse_args()
+    args_nondefault = utils.parse_nondefault_args(
+        args, parser.parse_args(['--model', args.model]))
+
+    utils.setup_logging()
+
+    # GPU configuration
+    setup_gpu(args.gpu, args.allow_growth)
+
+    # Loading model
+    model, meta = load_model(args.model, return_meta=True, mode='predict',
+                             is_greedy=args.greedy,
+                             beam_width=args.beam_width)
+
+    # The server and batching settings are not training args (and the
+    # defaults are not in args_nondefault)
+    server_args = args
+    args = HParams(**meta['training_args']).update(vars(args_nondefault))
+
+    # Features extractor
+    input_parser = FEATURES.get(args.input_parser,
+                                params=args.input_parser_params)
+
+    # Recovering text parser
+    label_parser = PARSERS.get(args.label_parser,
+                               params=args.label_parser_params)
+
+    coalescer = BatchCoalescer(make_batch_fn(model, label_parser),
+                               max_batch_size=server_args.max_batch_size,
+                               max_wait=server_args.max_wait).start()
+
+    if server_args.unix_socket:
+        if os.path.exists(server_args.unix_socket):
+            os.remove(server_args.unix_socket)
+        server = UnixHTTPServer(server_args.unix_socket, RecognizerHandler)
+        address = server_args.unix_socket
+    else:
+        server = HTTPServer((server_args.host, server_args.port),
+                            RecognizerHandler)
+        address = 'http://%s:%d' % (server_args.host, server_args.port)
+
+    server.coalescer = coalescer
+    server.input_parser = input_parser
+    server.pool = ThreadPool(server_args.num_workers)
+    server.request_timeout = server_args.timeout
+
+    print('Serving %s at %s' % (server_args.model, address))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        server.pool.close()
+        coalescer.stop()
+
+        from keras import backend as K
+        K.clear_session()
@@ -13,33 +13,15 @@ import json
 import datetime
 import inspect
 import codecs
+import multiprocessing
 
 import logging
-try:
-    import warpctc_tensorflow
-except ImportError:
-    logging.warning('warpctc binding for tensorflow not found. :(')
-import tensorflow as tf
 
-import keras
-
-import keras.backend as K
-from keras.optimizers import SGD, Adam
-from keras.callbacks import ReduceLROnPlateau
-
-from core import metrics
-from core.ctc_utils import ctc_dummy_loss, decoder_dummy_loss
-from core.callbacks import MetaCheckpoint, ProgbarLogger
-from utils.core_utils import setup_gpu
-
-from preprocessing import audio, text
-
-from datasets.dataset_generator import DatasetGenerator
+from utils import distributed_utils
 from utils.hparams import HParams
 
 import utils.generic_utils as utils
-
-from utils.core_utils import load_model
+from utils.registry import MODELS, FEATURES, PARSERS, CALLBACKS
 
 if __name__ == '__main__':
 
@@ -58,6 +40,12 @@ if __name__ == '__main__':
     parser.add_argument('--momentum', default=0.9, type=float)
     parser.add_argument('--clipnorm', default=400, type=float)
     parser.add_argument('--batch_size', default=32, type=int)
+    # Number of micro-batches (of batch_size) per optimizer step
+    parser.add_argument('--accum_steps', default=1, type=int)
+    # Number of epochs sorted by duration (SortaGrad) and, after them,
+    # whether the batches have samples of similar durations
+    parser.add_argument('--sortagrad', default=0, type=int)
+    parser.add_argument('--bucketing', default=False, action='store_true')
     parser.add_argument('--opt', default='adam', type=str,
                         choices=['sgd', 'adam'])
     # End of hyper parameters
@@ -74,7 +62,19 @@ if __name__ == '__main__':
                         default='simple_char_parser')
     parser.add_argument('--label_parser_params', nargs='+', default=[])
 
+    # Validation
+    # Caches the padded, length-sorted validation batches (in cache_dir if
+    # set) and reuses them every epoch
+    parser.add_argument('--val_cache', default=False, action='store_true')
+    parser.add_argument('--val_cache_dir', default=None, type=str)
+    # Fixed subsample of the validation set (implies --val_cache)
+    parser.add_argument('--val_samples', default=None, type=int)
+    # Also validates on the cached batches every N training batches
+    parser.add_argument('--val_every', default=None, type=int)
+
     # Callbacks
+    # Saves model.h5 (and the iterator state) every N batches
+    parser.add_argument('--checkpoint_every', default=None, type=int)
     parser.add_argument('--lr_schedule', default=None)
     parser.add_argument('--lr_params', nargs='+', default=[])
 
@@ -82,11 +82,65 @@ if __name__ == '__main__':
     parser.add_argument('--save', default=None, type=str)
     parser.add_argument('--gpu', default='0', type=str)
     parser.add_argument('--allow_growth', default=False, action='store_true')
+    # CPU threads and affinity (e.g. --cpus 0-11 --loader_cpus 12-15)
+    parser.add_argument('--intra_op', default=None, type=int)
+    parser.add_argument('--inter_op', default=None, type=int)
+    parser.add_argument('--cpus', default=None, type=str)
+    parser.add_argument('--loader_cpus', default=None, type=str)
     parser.add_argument('--verbose', default=0, type=int)
     parser.add_argument('--seed', default=None, type=float)
 
+    # Data-parallel training (local worker processes)
+    parser.add_argument('--num_workers', default=1, type=int)
+    # Set by the launcher on each worker
+    parser.add_argument('--rank', default=None, type=int)
+    parser.add_argument('--port', default=None, type=int)
+    # Seconds a worker waits for the others (e.g. while rank 0 validates)
+    # before giving up. By default it waits forever
+    parser.add_argument('--sync_timeout', default=None, type=float)
+
     args = parser.parse_args()
 
+    if args.num_workers > 1 and args.rank is None:
+        sys.exit(distributed_utils.launch(args.num_workers, sys.argv[1:]))
+
+    # TensorFlow and keras are only imported from here on, so `--help` and
+    # the launcher of the workers (which never builds a model) start fast
+    try:
+        import warpctc_tensorflow
+    except ImportError:
+        logging.warning('warpctc binding for tensorflow not found. :(')
+    import tensorflow as tf
+
+    import keras
+
+    import keras.backend as K
+    from keras.optimizers import SGD, Adam
+    from keras.callbacks import ReduceLROnPlateau
+
+    from core import metrics
+    from core.ctc_utils import ctc_dummy_loss, decoder_dummy_loss
+    from core.callbacks import MetaCheckpoint, ProgbarLogger, StepValidation
+    from core.callbacks import SyncStopTraining
+    from utils.core_utils import setup_gpu, AccumulatedTrainFunction
+    from utils.core_utils import DataParallelTrainFunction
+
+    from datasets.dataset_generator import DatasetGenerator, limit_generator
+
+    from utils.core_utils import load_model
+
+    if args.num_workers > 1 and (args.accum_steps or 1) > 1:
+        raise ValueError('accum_steps can not be used with num_workers > 1')
+
+    if args.checkpoint_every and \
+            args.checkpoint_every % (args.accum_steps or 1):
+        raise ValueError('checkpoint_every must be a multiple of accum_steps')
+
+    distributed = {'num_workers': args.num_workers,
+                   'rank': args.rank or 0,
+                   'port': args.port}
+    is_chief = distributed['rank'] == 0
+
     # Setup logging
     utils.setup_logging()
     logger = logging.getLogger(__name__)
@@ -97,12 +151,25 @@ if __name__ == '__main__':
         show_metrics=['loss', 'decoder_ler', 'val_loss', 'val_decoder_ler'])
 
     # GPU configuration
+    # Not restored from the training args on --load
+    loader_cpus = utils.parse_cpus(args.loader_cpus)
+    cpus = utils.parse_cpus(args.cpus)
+    if args.num_workers > 1:
+        # Each worker gets its own (disjoint) share of the compute cores
+        if cpus is None:
+            cpus = [c for c in range(multiprocessing.cpu_count())
+                    if c not in (loader_cpus or [])]
+        share = len(cpus) // args.num_workers
+        cpus = cpus[distributed['rank'] * share:
+                    (distributed['rank'] + 1) * share] or cpus
     setup_gpu(args.gpu, args.allow_growth,
-              log_device_placement=args.verbose > 1)
+              log_device_placement=args.verbose > 1,
+              intra_op=args.intra_op, inter_op=args.inter_op, cpus=cpus)
 
     # Initial configuration
     epoch_offset = 0
     meta = None
+    iterator_state = None
 
     if args.load:
         args_nondefault = utils.parse_nondefault_args(args,
@@ -113,10 +180,14 @@ if __name__ == '__main__':
 
         logger.info('Loading parameters...')
         args = HParams(**meta['training_args']).update(vars(args_nondefault))
+        # The workers of the saved model may differ from the current ones
+        args.update(distributed)
 
         epoch_offset = len(meta['epochs'])
         logger.info('Current epoch: %d' % epoch_offset)
 
+        iterator_state = utils.load_iterator_state(args.load)
+
         if args_nondefault.lr:
             logger.info('Setting current learning rate to %f...' % args.lr)
             K.set_value(model.optimizer.lr, args.lr)
@@ -124,7 +195,7 @@ if __name__ == '__main__':
     else:
         logger.info('Creating model...')
         # Recovering all valid models
-        model_fn = utils.get_from_module('core.models', args.model)
+        model_fn = MODELS.get(args.model)
         # Loading model
         model = model_fn(**(HParams().parse(args.model_params).values()))
 
@@ -142,63 +213,70 @@ if __name__ == '__main__':
                       optimizer=opt, metrics={'decoder': metrics.ler},
                       loss_weights=[1, 0])
 
-    logger.info('Creating results folder...')
-    # Creating the results folder
-    output_dir = args.save
-    if output_dir is None:
-        output_dir = os.path.join('results',
-                                  '%s_%s' % (args.model,
-                                             datetime.datetime.now()))
-    if not os.path.isdir(output_dir):
-        os.makedirs(output_dir)
-
-    logger.info('Adding callbacks')
-    # Callbacks
-    model_ckpt = MetaCheckpoint(os.path.join(output_dir, 'model.h5'),
-                                training_args=args, meta=meta)
-    best_ckpt = MetaCheckpoint(
-        os.path.join(output_dir, 'best.h5'), monitor='val_decoder_ler',
-        save_best_only=True, mode='min', training_args=args, meta=meta)
-    callback_list = [model_ckpt, best_ckpt]
-
-    # LR schedules
-    if args.lr_schedule:
-        lr_schedule_fn = utils.get_from_module('keras.callbacks',
-                                               args.lr_schedule)
-        if lr_schedule_fn:
-            lr_schedule = lr_schedule_fn(**HParams().parse(args.lr_params).values())
-            callback_list.append(lr_schedule)
-        else:
-            raise ValueError('Learning rate schedule unrecognized')
+    allreduce = None
+    if args.num_workers > 1:
+        logger.info('Connecting worker %d of %d...' % (
+            distributed['rank'], args.num_workers))
+        allreduce = distributed_utils.Allreduce(
+            distributed['rank'], args.num_workers, args.port,
+            recv_timeout=args.sync_timeout)
+
+    callback_list = []
+
+    # Only the chief (rank 0) writes the results, validates and runs the
+    # callbacks. The learning rate is synced by DataParallelTrainFunction
+    if is_chief:
+        logger.info('Creating results folder...')
+        # Creating the results folder
+        output_dir = args.save
+        if output_dir is None:
+            output_dir = os.path.join('results',
+                                      '%s_%s' % (args.model,
+                                                 datetime.datetime.now()))
+        if not os.path.isdir(output_dir):
+            os.makedirs(output_dir)
 
     logger.info('Getting the feature extractor...')
     # Features extractor
-    input_parser = utils.get_from_module('preprocessing.audio',
-                                         args.input_parser,
-                                         params=args.input_parser_params)
+    input_parser = FEATURES.get(args.input_parser,
+                                params=args.input_parser_params)
 
     logger.info('Getting the text parser...')
     # Recovering text parser
-    label_parser = utils.get_from_module('preprocessing.text',
-                                         args.label_parser,
-                                         params=args.label_parser_params)
+    label_parser = PARSERS.get(args.label_parser,
+                               params=args.label_parser_params)
 
     logger.info('Getting the data generator...')
     # Data generator
+    seed, shard = args.seed, None
+    if args.num_workers > 1:
+        shard = (distributed['rank'], args.num_workers)
+        if seed is not None:  # each worker shuffles its shard differently
+            seed += distributed['rank']
+
     data_gen = DatasetGenerator(input_parser, label_parser,
                                 batch_size=args.batch_size,
-                                seed=args.seed)
+                                seed=seed, loader_cpus=loader_cpus)
+    # Only the training set is sharded and follows the curriculum
+    train_gen = DatasetGenerator(input_parser, label_parser,
+                                 batch_size=args.batch_size,
+                                 seed=seed, loader_cpus=loader_cpus,
+                                 shard=shard, sortagrad=args.sortagrad,
+                                 bucketing=args.bucketing,
+                                 initial_epoch=epoch_offset)
     # iterators over datasets
     train_flow, valid_flow, test_flow = None, None, None
     num_val_samples = num_test_samples = 0
 
     logger.info('Generating flow...')
     if len(args.dataset) == 1:
-        train_flow, valid_flow, test_flow = data_gen.flow_from_fname(
-            args.dataset[0], datasets=['train', 'valid', 'test'])
+        train_flow = train_gen.flow_from_fname(args.dataset[0],
+                                               datasets='train')
+        valid_flow, test_flow = data_gen.flow_from_fname(
+            args.dataset[0], datasets=['valid', 'test'])
         num_val_samples = valid_flow.len
     else:
-        train_flow = data_gen.flow_from_fname(args.dataset[0])
+        train_flow = train_gen.flow_from_fname(args.dataset[0])
         valid_flow = data_gen.flow_from_fname(args.dataset[1])
 
         num_val_samples = valid_flow.len
@@ -206,15 +284,95 @@ if __name__ == '__main__':
             test_flow = data_gen.flow_from_fname(args.dataset[2])
             num_test_samples = test_flow.len
 
+    if (args.accum_steps or 1) > 1:
+        logger.info('Accumulating the gradients of %d batches (effective '
+                    'batch size: %d)' % (args.accum_steps,
+                                         args.accum_steps * args.batch_size))
+        batches_per_epoch = -(-train_flow.len // args.batch_size)
+        model.train_function = AccumulatedTrainFunction(model,
+                                                        args.accum_steps,
+                                                        batches_per_epoch)
+
+    if allreduce:
+        logger.info('Training on %d samples per worker' % train_flow.len)
+        model.train_function = DataParallelTrainFunction(model, allreduce)
+
+    if not is_chief:
+        valid_flow = test_flow = None
+        num_val_samples = 0
+
+    if valid_flow is not None and (args.val_cache or args.val_cache_dir or
+                                   args.val_samples or args.val_every):
+        logger.info('Caching the validation set...')
+        valid_flow = valid_flow.cache(num_samples=args.val_samples,
+                                      cache_dir=args.val_cache_dir)
+        num_val_samples = valid_flow.len
+
+    # Resuming in the middle of an epoch (see MetaCheckpoint)
+    remaining_samples = 0
+    if iterator_state and args.num_workers > 1:
+        logger.warning('The iterator state can not be restored with '
+                       'num_workers > 1. Restarting epoch %d' % epoch_offset)
+        iterator_state = None
+    elif iterator_state:
+        remaining_samples = train_flow.restore_state(iterator_state)
+        if isinstance(model.train_function, AccumulatedTrainFunction):
+            model.train_function.batch_index = iterator_state['batch_index']
+
+    if is_chief:
+        logger.info('Adding callbacks')
+        # Callbacks
+        # model.h5 is the latest model and best.h5 the one with the lowest
+        # validation LER. Both are written in background
+        model_ckpt = MetaCheckpoint(os.path.join(output_dir, 'model.h5'),
+                                    monitor='val_decoder_ler', mode='min',
+                                    best_filepath=os.path.join(output_dir,
+                                                               'best.h5'),
+                                    training_args=args, meta=meta,
+                                    iterator=train_flow,
+                                    save_every=args.checkpoint_every,
+                                    iterator_state=iterator_state)
+        callback_list = [model_ckpt]
+
+        if args.val_every:
+            callback_list.append(StepValidation(valid_flow, args.val_every))
+
+    # LR schedules
+    if args.lr_schedule and is_chief:
+        lr_schedule = CALLBACKS.get(args.lr_schedule, params=args.lr_params)
+        if lr_schedule:
+            callback_list.append(lr_schedule)
+        else:
+            raise ValueError('Learning rate schedule unrecognized')
+
+    if allreduce:
+        # The other workers stop with rank 0 instead of waiting for it
+        callback_list.append(SyncStopTraining(allreduce))
+
     logger.info(str(vars(args)))
     print(str(vars(args)))
     logger.info('Initialzing training...')
+    fit_kwargs = {'validation_data': valid_flow,
+                  'nb_val_samples': num_val_samples, 'max_q_size': 10,
+                  'nb_worker': 1, 'callbacks': callback_list,
+                  'verbose': int(is_chief)}
+
+    if iterator_state and iterator_state['batch_index']:
+        logger.info('Resuming epoch %d at batch %d' % (
+            epoch_offset, iterator_state['batch_index']))
+        model.fit_generator(limit_generator(train_flow, remaining_samples),
+                            samples_per_epoch=remaining_samples,
+                            nb_epoch=epoch_offset + 1,
+                            initial_epoch=epoch_offset, **fit_kwargs)
+        epoch_offset += 1
+
     # Fit the model
     model.fit_generator(train_flow, samples_per_epoch=train_flow.len,
-                        nb_epoch=args.num_epochs, validation_data=valid_flow,
-                        nb_val_samples=num_val_samples, max_q_size=10,
-                        nb_worker=1, callbacks=callback_list, verbose=1,
-                        initial_epoch=epoch_offset)
+                        nb_epoch=args.num_epochs, initial_epoch=epoch_offset,
+                        **fit_kwargs)
+
+    if allreduce:
+        allreduce.close()
 
     if test_flow:
         del model
@@ -0,0 +1,168 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import threading
+import time
+import collections
+import Queue
+
+import numpy as np
+
+import logging
+
+
+class LatencyMonitor(object):
+    """ Keeps track of the latency of the last requests served
+
+    # Arguments
+        window: number of latest requests used to compute the percentiles
+    """
+
+    def __init__(self, window=10000):
+        self._latencies = collections.deque(maxlen=window)
+        self._batch_sizes = collections.deque(maxlen=window)
+        self._lock = threading.Lock()
+        self.num_requests = 0
+        self.num_batches = 0
+
+    def add_request(self, latency):
+        with self._lock:
+            self._latencies.append(latency)
+            self.num_requests += 1
+
+    def add_batch(self, batch_size):
+        with self._lock:
+            self._batch_sizes.append(batch_size)
+            self.num_batches += 1
+
+    def percentile(self, q):
+        with self._lock:
+            if not len(self._latencies):
+                return 0.
+            return float(np.percentile(self._latencies, q))
+
+    def summary(self):
+        """ Returns a dictionary with the current latency statistics (in
+        seconds)
+        """
+        with self._lock:
+            mean_batch_size = (float(np.mean(self._batch_sizes))
+                               if len(self._batch_sizes) else 0.)
+
+        return {'num_requests': self.num_requests,
+                'num_batches': self.num_batches,
+                'mean_batch_size': mean_batch_size,
+                'latency_p50': self.percentile(50),
+                'latency_p99': self.percentile(99)}
+
+
+class _Request(object):
+
+    def __init__(self, data):
+        self.data = data
+        self.result = None
+        self.error = None
+        self.arrival = time.time()
+        self.done = threading.Event()
+
+
+class BatchCoalescer(object):
+    """ Coalesces concurrent requests into dynamic micro-batches
+
+    Requests are queued by `submit` (which blocks until the result is ready)
+    and a single worker thread groups them. A batch is dispatched as soon as
+    it reaches `max_batch_size` or when the oldest request in it has waited
+    for `max_wait` seconds.
+
+    # Arguments
+        batch_fn: function that receives a list of requests data and returns a
+        list of results with the same length
+        max_batch_size: maximum number of requests per batch
+        max_wait: maximum time (in seconds) that a request waits in the queue
+        before the batch is dispatched
+        monitor: instance of LatencyMonitor. If None, a new one will be created
+    """
+
+    def __init__(self, batch_fn, max_batch_size=32, max_wait=0.01,
+                 monitor=None):
+        self._logger = logging.getLogger('%s.%s' % (__name__,
+                                                    self.__class__.__name__))
+        self.batch_fn = batch_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.monitor = monitor or LatencyMonitor()
+
+        self._queue = Queue.Queue()
+        self._stop = threading.Event()
+        self._worker = threading.Thread(target=self._loop,
+                                        name='batch_coalescer')
+        self._worker.daemon = True
+
+    @property
+    def queue_depth(self):
+        return self._queue.qsize()
+
+    def start(self):
+        self._worker.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._worker.join()
+
+    def submit(self, data, timeout=None):
+        """ Enqueues `data` and waits for the result of its batch
+        """
+        request = _Request(data)
+        self._queue.put(request)
+
+        if not request.done.wait(timeout):
+            raise RuntimeError('Request timed out after %s seconds' % timeout)
+
+        self.monitor.add_request(time.time() - request.arrival)
+
+        if request.error is not None:
+            raise request.error
+
+        return request.result
+
+    def _next_batch(self):
+        try:
+            batch = [self._queue.get(timeout=.1)]
+        except Queue.Empty:
+            return []
+
+        deadline = batch[0].arrival + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.time()
+            try:
+                if remaining > 0:
+                    batch.append(self._queue.get(timeout=remaining))
+                else:
+                    # Deadline reached: only take what is already queued
+                    batch.append(self._queue.get_nowait())
+            except Queue.Empty:
+                break
+
+        return batch
+
+    def _loop(self):
+        while not self._stop.is_set():
+            batch = self._next_batch()
+            if not batch:
+                continue
+
+            self.monitor.add_batch(len(batch))
+
+            try:
+                results = self.batch_fn([r.data for r in batch])
+                for request, result in zip(batch, results):
+                    request.result = result
+            except Exception as e:
+                self._logger.exception('Batch of size %d failed', len(batch))
+                for request in batch:
+                    request.error = e
+
+            for request in batch:
+                request.done.set()
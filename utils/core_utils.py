@@ -2,24 +2,53 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import os
+import json
 import h5py
 import yaml
 
-import keras
-import keras.backend as K
-from keras.models import Model
-from keras.layers import Lambda
-import tensorflow as tf
+import logging
 
-import core
-from core import layers_utils
-from core import ctc_utils
-from core import metrics
+from utils.generic_utils import LazyModule
+from utils.generic_utils import load_meta
+from utils.generic_utils import parse_cpus, set_cpu_affinity
+from utils import quantization_utils
+from utils.registry import CUSTOM_OBJECTS
 
-from utils.generic_utils import inspect_module
+# Imported on first use, so importing this module (e.g. for load_meta or
+# before parsing the command line) does not load tensorflow
+keras = LazyModule('keras')
+K = LazyModule('keras.backend')
+tf = LazyModule('tensorflow')
 
+layers_utils = LazyModule('core.layers_utils')
+ctc_utils = LazyModule('core.ctc_utils')
+metrics = LazyModule('core.metrics')
+
+
+def setup_gpu(gpu, allow_growth=False, log_device_placement=False,
+              intra_op=None, inter_op=None, cpus=None):
+    """ Creates the keras session
+
+    # Arguments
+        gpu: visible gpus ('-1' for cpu only and 'all' for all gpus)
+        allow_growth: dynamic gpu memory allocation
+        log_device_placement: logs the device of each op
+        intra_op: number of threads of each op (e.g. a matmul). Defaults to
+        the number of cores in cpus or, if cpus is None, to tensorflow's
+        default (all cores)
+        inter_op: number of ops run in parallel. Defaults to tensorflow's
+        default (all cores)
+        cpus: cores (list or taskset string, e.g. '0-7') where the process
+        is pinned to. Keep them disjoint from the data loader cores (see
+        DatasetGenerator loader_cpus)
+    """
+    cpus = parse_cpus(cpus)
+    if cpus:
+        # Before creating the session, so its thread pools inherit it
+        set_cpu_affinity(cpus)
+        intra_op = intra_op or len(cpus)
 
-def setup_gpu(gpu, allow_growth=False, log_device_placement=False):
     # Choosing gpu
     if gpu == '-1':
         config = tf.ConfigProto(device_count={'GPU': 0},
@@ -31,20 +60,192 @@ def setup_gpu(gpu, allow_growth=False, log_device_placement=False):
         config.gpu_options.visible_device_list = gpu
     if allow_growth:  # dynamic gpu memory allocation
         config.gpu_options.allow_growth = True
+    if intra_op:
+        config.intra_op_parallelism_threads = intra_op
+    if inter_op:
+        config.inter_op_parallelism_threads = inter_op
+    # The inter-op pool is global by default, so a new session (e.g. after
+    # K.clear_session) would ignore inter_op
+    config.use_per_session_threads = bool(intra_op or inter_op)
     session = tf.Session(config=config)
     K.set_session(session)
 
 
-def get_custom_objects():
-    """ Verify all custom object that may be used to load a keras model
+def _clip_gradients(optimizer, grads):
+    """ Applies the clipnorm and clipvalue of a keras optimizer to grads
+    """
+    if getattr(optimizer, 'clipnorm', 0) > 0:
+        norm = K.sqrt(sum([K.sum(K.square(g)) for g in grads]))
+        grads = [keras.optimizers.clip_norm(g, optimizer.clipnorm, norm)
+                 for g in grads]
+    if getattr(optimizer, 'clipvalue', 0) > 0:
+        grads = [K.clip(g, -optimizer.clipvalue, optimizer.clipvalue)
+                 for g in grads]
+    return grads
+
+
+def _rebuild_training_updates(model, params):
+    """ Builds the optimizer updates of params again (the train functions
+    below replace its gradients). get_updates creates new state variables
+    (e.g. the Adam moments), so the state of the previous updates, such as
+    the one restored by load_model, is copied to them
+    """
+    optimizer = model.optimizer
+    weights = optimizer.get_weights()
+
+    updates = optimizer.get_updates(params, model.constraints,
+                                    model.total_loss)
+    if weights:
+        optimizer.set_weights(weights)
+
+    return updates
+
+
+class AccumulatedTrainFunction(object):
+    """ Train function of a compiled model that accumulates the gradients of
+    accum_steps micro-batches before each optimizer step.
+
+    The optimizer sees the mean gradient (clipnorm and clipvalue are applied
+    to it) and its state (e.g. Adam moments and iterations) is only updated
+    once per step, so accum_steps micro-batches of size B behave as a batch
+    of accum_steps * B. The remaining micro-batches are applied at the end
+    of each epoch, so no gradient is carried over to the next epoch (and the
+    checkpoints are consistent).
+
+    # Arguments
+        model: compiled model
+        accum_steps: number of micro-batches per optimizer step
+        batches_per_epoch: number of micro-batches in each epoch
+
+    # Example
+        model.train_function = AccumulatedTrainFunction(model, 4, 100)
+    """
+
+    def __init__(self, model, accum_steps, batches_per_epoch):
+        self.accum_steps = accum_steps
+        self.batches_per_epoch = batches_per_epoch
+        self.num_accumulated = 0
+        self.batch_index = 0
+
+        inputs = model.inputs + model.targets + model.sample_weights
+        if model.uses_learning_phase and \
+                not isinstance(K.learning_phase(), int):
+            inputs += [K.learning_phase()]
+        outputs = [model.total_loss] + model.metrics_tensors
+
+        params = getattr(model, '_collected_trainable_weights',
+                         model.trainable_weights)
+        grads = K.gradients(model.total_loss, params)
+
+        accumulators = [K.zeros(K.int_shape(p)) for p in params]
+        num_accumulated = K.placeholder(ndim=0, name='num_accumulated')
+        mean_grads = [(a + g) / num_accumulated
+                      for a, g in zip(accumulators, grads)]
+
+        optimizer = model.optimizer
+        optimizer.get_gradients = lambda loss, params: _clip_gradients(
+            optimizer, mean_grads)
+        training_updates = _rebuild_training_updates(model, params)
+
+        apply_ops = [tf.assign(*u) if isinstance(u, (tuple, list)) else u
+                     for u in model.updates + training_updates]
+        with tf.control_dependencies(apply_ops):
+            reset_ops = [tf.assign(a, tf.zeros_like(a)) for a in accumulators]
+
+        accumulate_ops = [tf.assign_add(a, g)
+                          for a, g in zip(accumulators, grads)]
+
+        kwargs = getattr(model, '_function_kwargs', {})
+        self.accumulate_fn = K.function(inputs, outputs,
+                                        updates=model.updates +
+                                        accumulate_ops, **kwargs)
+        self.apply_fn = K.function(inputs + [num_accumulated], outputs,
+                                   updates=apply_ops + reset_ops, **kwargs)
+
+    def __call__(self, inputs):
+        self.num_accumulated += 1
+        self.batch_index += 1
+
+        end_of_epoch = self.batch_index == self.batches_per_epoch
+
+        if self.num_accumulated == self.accum_steps or end_of_epoch:
+            outputs = self.apply_fn(inputs + [self.num_accumulated])
+            self.num_accumulated = 0
+        else:
+            outputs = self.accumulate_fn(inputs)
+
+        if end_of_epoch:
+            self.batch_index = 0
+
+        return outputs
+
+
+class DataParallelTrainFunction(object):
+    """ Train function of a compiled model replica for synchronous
+    data-parallel training.
+
+    Each worker computes the gradients of its own batch, the gradients (and
+    the losses and metrics) are averaged over all workers by `allreduce` and
+    every replica applies the same optimizer step. The weights are copied
+    from rank 0 on creation and the learning rate of rank 0 is broadcast
+    on every step, so the replicas remain identical even if only rank 0
+    runs the callbacks (e.g. ReduceLROnPlateau).
+
+    # Arguments
+        model: compiled model
+        allreduce: instance of utils.distributed_utils.Allreduce
+
+    # Example
+        model.train_function = DataParallelTrainFunction(model, allreduce)
     """
-    all_custom_objects = []
-    for module in ['core.layers', 'core.layers_utils',
-                   'core.metrics', 'core.ctc_utils',
-                   'core.initializers']:
-        all_custom_objects.extend(inspect_module(module, to_dict=False))
 
-    return dict(all_custom_objects)
+    def __init__(self, model, allreduce):
+        self.allreduce = allreduce
+
+        inputs = model.inputs + model.targets + model.sample_weights
+        if model.uses_learning_phase and \
+                not isinstance(K.learning_phase(), int):
+            inputs += [K.learning_phase()]
+        outputs = [model.total_loss] + model.metrics_tensors
+
+        params = getattr(model, '_collected_trainable_weights',
+                         model.trainable_weights)
+        grads = K.gradients(model.total_loss, params)
+
+        mean_grads = [K.placeholder(shape=K.int_shape(p)) for p in params]
+
+        optimizer = model.optimizer
+        optimizer.get_gradients = lambda loss, params: _clip_gradients(
+            optimizer, mean_grads)
+        training_updates = _rebuild_training_updates(model, params)
+
+        kwargs = getattr(model, '_function_kwargs', {})
+        self.grads_fn = K.function(inputs, outputs + grads,
+                                   updates=model.updates, **kwargs)
+        self.apply_fn = K.function(mean_grads, [], updates=training_updates,
+                                   **kwargs)
+
+        self.num_outputs = len(outputs)
+        self.lr = optimizer.lr
+
+        model.set_weights(allreduce.broadcast(model.get_weights()))
+
+    def __call__(self, inputs):
+        values = self.grads_fn(inputs)
+        outputs = values[:self.num_outputs]
+        grads = values[self.num_outputs:]
+
+        values = self.allreduce.mean(grads + outputs)
+        grads = values[:len(grads)]
+        outputs = values[len(grads):]
+
+        lr, = self.allreduce.broadcast([K.get_value(self.lr)])
+        K.set_value(self.lr, lr)
+
+        self.apply_fn(grads)
+
+        return [float(o) for o in outputs]
+
 
 def load_model(model_fname, return_meta=False, mode='train', **kwargs):
     """ Loading keras model with custom objects
@@ -60,43 +261,51 @@ def load_model(model_fname, return_meta=False, mode='train', **kwargs):
     if mode not in ('train', 'predict', 'eval'):
         raise ValueError('mode must be one of (train, predict, eval)')
 
-    model = keras.models.load_model(model_fname,
-                                    custom_objects=get_custom_objects())
+    if quantization_utils.is_quantized(model_fname):
+        if mode == 'train':
+            raise ValueError('quantized models can only be used for inference')
+        model = load_quantized_model(model_fname)
+    else:
+        model = keras.models.load_model(
+            model_fname, custom_objects=CUSTOM_OBJECTS.members())
 
     # Define the new decoder and the to_dense layer
     if kwargs.get('decoder', True):
-        dec = Lambda(ctc_utils.decode,
-                     output_shape=ctc_utils.decode_output_shape,
-                     arguments={'is_greedy': kwargs.get('is_greedy', False),
-                                'beam_width': kwargs.get('beam_width', 400)},
-                     name='beam_search')
+        dec = keras.layers.Lambda(
+            ctc_utils.decode, output_shape=ctc_utils.decode_output_shape,
+            arguments={'is_greedy': kwargs.get('is_greedy', False),
+                       'beam_width': kwargs.get('beam_width', 400)},
+            name='beam_search')
     else:
-        dec = Lambda(lambda x: x[0])
+        dec = keras.layers.Lambda(lambda x: x[0])
 
     if mode == 'predict':
         y_pred = (model.get_layer('y_pred') or
                   model.get_layer('decoder').input[0])
+        # Length of the outputs (which is reduced by time-reduction models)
+        output_length = model.get_layer('decoder').input[1]
 
         input_ = model.get_layer('inputs').input
         inputs_length = model.get_layer('inputs_length').input
 
-        to_dense_layer = Lambda(
+        to_dense_layer = keras.layers.Lambda(
             layers_utils.to_dense,
             output_shape=layers_utils.to_dense_output_shape,
             name="to_dense")
 
-        y_pred = dec([y_pred, inputs_length])
+        y_pred = dec([y_pred, output_length])
 
         y_pred = to_dense_layer(y_pred)
 
-        model = Model(input=[input_, inputs_length],
-                      output=[y_pred])
+        model = keras.models.Model(input=[input_, inputs_length],
+                                   output=[y_pred])
     elif mode == 'eval':
         dec_layer = model.get_layer('decoder')
 
         y_pred_bs = dec(dec_layer.input)
 
-        model = Model(input=model.inputs, output=[model.outputs[0], y_pred_bs])
+        model = keras.models.Model(input=model.inputs,
+                                   output=[model.outputs[0], y_pred_bs])
 
         # Freezing layers
         for l in model.layers:
@@ -115,17 +324,78 @@ def load_model(model_fname, return_meta=False, mode='train', **kwargs):
     return model
 
 
-def load_meta(model_fname):
-    ''' Load meta configuration
-    '''
-    meta = {}
-
+def load_quantized_model(model_fname):
+    """ Loads a model saved by `quantization_utils.quantize_model`. The int8
+    weights are dequantized to float32 (so it runs as the float32 model; the
+    numpy engine keeps them in int8) and the model is not compiled
+    """
     with h5py.File(model_fname, 'r') as f:
-        meta_group = f['meta']
+        model_config = json.loads(f.attrs['model_config'].decode('utf-8'))
+        model = keras.models.model_from_config(
+            model_config, custom_objects=CUSTOM_OBJECTS.members())
+
+        weights = quantization_utils.load_weights(f['model_weights'])
+
+    for layer_name, layer_weights in weights.items():
+        model.get_layer(layer_name).set_weights(layer_weights)
+
+    return model
+
+
+def export_frozen_model(model_fname, export_dir, decoder=True, **kwargs):
+    """ Exports an inference-only frozen graph of the model
+
+    The model is rebuilt in test phase, so dropout, zoneout and gaussian noise
+    branches are never created; variables are converted to constants and the
+    training branches (labels input and ctc loss) are pruned.
+
+    # Arguments
+        model_fname: path to the keras model
+        export_dir: directory where `graph.pb` and `meta.yaml` will be saved
+        decoder: if False, the graph outputs the network activations instead
+        of the decoded sequence
+        kwargs: decoder arguments (see load_model)
+
+    # Outputs
+        path to the exported graph
+    """
+    from tensorflow.python.framework import graph_util
+
+    K.set_learning_phase(0)
+
+    model, meta = load_model(model_fname, return_meta=True, mode='predict',
+                             decoder=decoder, **kwargs)
+
+    input_names = [i.op.name for i in model.inputs]
+    output_names = [o.op.name for o in model.outputs]
+
+    graph_def = K.get_session().graph.as_graph_def()
+    graph_def = graph_util.remove_training_nodes(graph_def)
+    graph_def = graph_util.convert_variables_to_constants(
+        K.get_session(), graph_def, output_names)
+
+    try:
+        from tensorflow.tools.graph_transforms import TransformGraph
+        graph_def = TransformGraph(graph_def, input_names, output_names,
+                                   ['fold_constants(ignore_errors=true)',
+                                    'strip_unused_nodes'])
+    except ImportError:
+        logging.getLogger(__name__).warning(
+            'graph_transforms not found. Skipping constant folding')
+
+    if not os.path.isdir(export_dir):
+        os.makedirs(export_dir)
+
+    graph_fname = os.path.join(export_dir, 'graph.pb')
+    with tf.gfile.GFile(graph_fname, 'wb') as f:
+        f.write(graph_def.SerializeToString())
+
+    with open(os.path.join(export_dir, 'meta.yaml'), 'w') as f:
+        yaml.dump({'inputs': input_names,
+                   'outputs': output_names,
+                   'decoder': decoder,
+                   'training_args': meta['training_args']}, f)
 
-        meta['training_args'] = yaml.load(
-            meta_group.attrs['training_args'])
-        for k in meta_group.keys():
-            meta[k] = list(meta_group[k])
+    K.clear_session()
 
-    return meta
+    return graph_fname
@@ -0,0 +1,160 @@
+""" Local (single machine) data-parallel training helpers. Only numpy and the
+standard library are used, so the workers can be launched before tensorflow
+is imported.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import socket
+import subprocess
+import sys
+import time
+
+from multiprocessing.connection import Listener, Client
+
+import numpy as np
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+AUTHKEY = b'asr-study'
+
+
+def find_free_port():
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.bind(('localhost', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+def launch(num_workers, argv, module=None):
+    """ Runs num_workers copies of the current script (or module) with the
+    extra arguments `--rank i --port PORT` and waits for them
+
+    # Outputs
+        the first non-zero return code (or 0)
+    """
+    cmd = [sys.executable]
+    cmd += ['-m', module] if module else [sys.argv[0]]
+
+    port = str(find_free_port())
+
+    workers = [subprocess.Popen(cmd + argv + ['--rank', str(rank),
+                                             '--port', port])
+               for rank in range(num_workers)]
+
+    return_codes = [w.wait() for w in workers]
+    return next((c for c in return_codes if c), 0)
+
+
+class Allreduce(object):
+    """ Averages (and broadcasts) numpy arrays over the local workers.
+
+    The workers connect to rank 0 through sockets on localhost; rank 0 sums
+    the arrays and sends back the mean.
+
+    # Arguments
+        rank: rank of this worker (0 <= rank < world_size)
+        world_size: number of workers
+        port: port where rank 0 listens
+        timeout: seconds waiting for rank 0
+        recv_timeout: seconds waiting for the arrays of the other workers
+        (e.g. while rank 0 validates) before giving up. If None, it waits
+        forever (a worker that dies still closes its socket, which raises
+        EOFError on its peers)
+    """
+
+    def __init__(self, rank, world_size, port, timeout=60.,
+                 recv_timeout=None):
+        self.rank = rank
+        self.world_size = world_size
+        self.recv_timeout = recv_timeout
+        self.conns = []
+
+        address = ('localhost', port)
+
+        if rank == 0:
+            listener = Listener(address, authkey=AUTHKEY)
+            conns = {}
+            for _ in range(world_size - 1):
+                conn = listener.accept()
+                conns[conn.recv()] = conn
+            listener.close()
+            self.conns = [conns[r] for r in sorted(conns)]
+        else:
+            start = time.time()
+            while True:
+                try:
+                    conn = Client(address, authkey=AUTHKEY)
+                    break
+                except socket.error:
+                    if time.time() - start > timeout:
+                        raise
+                    time.sleep(.1)
+            conn.send(rank)
+            self.conns = [conn]
+
+        logger.info('Worker %d/%d connected' % (rank, world_size))
+
+    def _recv(self, conn):
+        if self.recv_timeout is not None and \
+                not conn.poll(self.recv_timeout):
+            raise RuntimeError('Worker %d got nothing from its peers in %d '
+                               'seconds' % (self.rank, self.recv_timeout))
+        return np.frombuffer(conn.recv_bytes(), dtype='float32')
+
+    def _flatten(self, arrays):
+        return np.concatenate([np.asarray(a, dtype='float32').ravel()
+                               for a in arrays])
+
+    def _unflatten(self, buf, arrays):
+        outputs, offset = [], 0
+        for a in arrays:
+            shape = np.shape(a)
+            size = int(np.prod(shape))
+            outputs.append(buf[offset: offset + size].reshape(shape))
+            offset += size
+        return outputs
+
+    def mean(self, arrays):
+        """ Returns the mean of each array over all workers
+        """
+        if self.world_size == 1:
+            return arrays
+
+        buf = self._flatten(arrays)
+
+        if self.rank == 0:
+            for conn in self.conns:
+                buf += self._recv(conn)
+            buf /= self.world_size
+            for conn in self.conns:
+                conn.send_bytes(buf.tobytes())
+        else:
+            self.conns[0].send_bytes(buf.tobytes())
+            buf = self._recv(self.conns[0])
+
+        return self._unflatten(buf, arrays)
+
+    def broadcast(self, arrays):
+        """ Returns the arrays of rank 0
+        """
+        if self.world_size == 1:
+            return arrays
+
+        if self.rank == 0:
+            buf = self._flatten(arrays)
+            for conn in self.conns:
+                conn.send_bytes(buf.tobytes())
+        else:
+            buf = self._recv(self.conns[0])
+
+        return self._unflatten(buf, arrays)
+
+    def close(self):
+        for conn in self.conns:
+            conn.close()
+        self.conns = []
@@ -0,0 +1,70 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import yaml
+
+import numpy as np
+import tensorflow as tf
+
+
+class FrozenModel(object):
+    """ Inference-only model loaded from a graph exported by
+    `utils.core_utils.export_frozen_model`. Keras and the custom objects are
+    not needed.
+
+    # Arguments
+        export_dir: directory with `graph.pb` and `meta.yaml`
+        config: instance of tf.ConfigProto used to create the session
+    """
+
+    def __init__(self, export_dir, config=None):
+        with open(os.path.join(export_dir, 'meta.yaml'), 'r') as f:
+            self.meta = yaml.load(f)
+
+        graph_def = tf.GraphDef()
+        with tf.gfile.GFile(os.path.join(export_dir, 'graph.pb'), 'rb') as f:
+            graph_def.ParseFromString(f.read())
+
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            tf.import_graph_def(graph_def, name='')
+
+        self.inputs = [self.graph.get_tensor_by_name('%s:0' % name)
+                       for name in self.meta['inputs']]
+        self.outputs = [self.graph.get_tensor_by_name('%s:0' % name)
+                        for name in self.meta['outputs']]
+
+        self.session = tf.Session(graph=self.graph, config=config)
+
+    def predict(self, x, batch_size=None):
+        """ Same interface as keras Model.predict for the `predict` mode
+
+        # Inputs
+            x: list [inputs, inputs_length]
+        """
+        inputs, inputs_length = x
+        inputs_length = np.reshape(inputs_length, (-1, 1))
+
+        return self.session.run(self.outputs[0],
+                                feed_dict={self.inputs[0]: inputs,
+                                           self.inputs[1]: inputs_length})
+
+    def close(self):
+        self.session.close()
+
+
+def load_frozen_model(export_dir, return_meta=False, config=None):
+    """ Loads an exported inference-only model
+
+    # Outputs
+        FrozenModel and, if return_meta is True, its meta configuration (with
+        the same `training_args` key returned by `load_meta`)
+    """
+    model = FrozenModel(export_dir, config=config)
+
+    if return_meta:
+        return model, model.meta
+
+    return model
@@ -2,24 +2,24 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
-import h5py
 import sys
 import os
+import importlib
+import platform
+import subprocess
+import threading
+import types
 
 import logging
 import logging.config
 import yaml
 
 import numpy as np
-from scipy import sparse
 
-import inspect
 import yaml
 
 from .hparams import HParams
 
-import re
-
 logger = logging.getLogger(__name__)
 
 
@@ -40,48 +40,57 @@ def safe_mkdirs(path):
     return path
 
 
-def get_from_module(module, name, params=None, regex=False):
-    """ Get a class or method from a module given its name
+class LazyModule(types.ModuleType):
+    """ Stands for a module that is only imported on its first attribute
+    access, e.g. `tf = LazyModule('tensorflow')`. Heavy dependencies (such
+    as tensorflow) are then only loaded if they are used
     """
-    members = inspect_module(module, regex=regex)
 
-    if name is None or name.lower() == 'none':
-        return None
+    def __init__(self, name):
+        super(LazyModule, self).__init__(name)
+        self._module = None
 
-    members = {k.lower().strip(): v for k, v in members.items()}
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self.__name__)
+        return getattr(self._module, attr)
 
-    try:
-        member = members[name.lower().strip()]
-        # is a class and must be instantiate if params is not none
-        if (member and params is not None) and inspect.isclass(member):
-            return member(**HParams().parse(params).values())
-
-        return member
-    except KeyError, e:
-        raise KeyError("%s not found in %s.\n Valid values are: %s" %
-                       (name, module, ', '.join(members.keys())))
-
-
-def inspect_module(module, to_dict=True, regex=False):
-    modules = {}
-    if regex:
-        pattern = re.compile(module)
-        for key, value in sys.modules.items():
-            if pattern.match(key):
-                modules[key] = value
-    else:
-        modules = {module: sys.modules[module]}
 
-    members = []
-    for key, value in modules.items():
-        members.extend(inspect.getmembers(value, lambda member:
-                                          hasattr(member, '__module__') and
-                                          member.__module__ == key))
+def load_meta(model_fname):
+    ''' Load meta configuration
+    '''
+    import h5py
 
-    if to_dict:
-        return dict(members)
+    meta = {}
 
-    return members
+    with h5py.File(model_fname, 'r') as f:
+        meta_group = f['meta']
+
+        meta['training_args'] = yaml.load(
+            meta_group.attrs['training_args'])
+        for k in meta_group.keys():
+            meta[k] = list(meta_group[k])
+
+    return meta
+
+
+def load_iterator_state(model_fname):
+    ''' Load the iterator state saved by MetaCheckpoint (see
+    DatasetIterator.get_state). Returns None if it was not saved
+    '''
+    import h5py
+
+    with h5py.File(model_fname, 'r') as f:
+        if 'iterator_state' not in f:
+            return None
+
+        group = f['iterator_state']
+        state = {k: v.item() for k, v in group.attrs.items()}
+        state['permutation'] = None
+        if 'permutation' in group:
+            state['permutation'] = group['permutation'][:]
+
+    return state
 
 
 def ld2dl(ld):
@@ -130,3 +139,66 @@ def setup_logging(default_path='logging.yaml', default_level=logging.INFO,
         logging.config.dictConfig(config)
     else:
         logging.basicConfig(level=default_level)
+
+
+def parse_cpus(cpus):
+    """ Parses a list of cores in the taskset format, e.g. '0-3,8,10-11'
+
+    # Outputs
+        sorted list of ints or None if cpus is empty
+    """
+    if not cpus:
+        return None
+
+    if not isinstance(cpus, str):
+        return sorted(set(int(c) for c in cpus))
+
+    out = set()
+    for part in cpus.split(','):
+        if '-' in part:
+            start, end = part.split('-')
+            out.update(range(int(start), int(end) + 1))
+        else:
+            out.add(int(part))
+    return sorted(out)
+
+
+# gettid syscall numbers (python 2 has no threading.get_native_id)
+_SYS_GETTID = {'x86_64': 186, 'aarch64': 178, 'i386': 224, 'i686': 224,
+               'ppc64le': 207}
+
+
+def _gettid():
+    if hasattr(threading, 'get_native_id'):
+        return threading.get_native_id()
+
+    import ctypes
+    return ctypes.CDLL(None).syscall(_SYS_GETTID[platform.machine()])
+
+
+def set_cpu_affinity(cpus, current_thread=False):
+    """ Pins the calling process (or only the calling thread) to the given
+    cores. Threads created afterwards (e.g. the tensorflow thread pools)
+    inherit the affinity, so call it before creating the session. Only
+    Linux is supported
+
+    # Arguments
+        cpus: list of cores or a string in the taskset format (e.g. '0-3')
+        current_thread: if True, only the calling thread is pinned
+    """
+    cpus = parse_cpus(cpus)
+    if not cpus:
+        return
+
+    pid = _gettid() if current_thread else os.getpid()
+
+    if hasattr(os, 'sched_setaffinity'):
+        # pid 0 is the calling thread
+        os.sched_setaffinity(0 if current_thread else pid, cpus)
+    else:
+        with open(os.devnull, 'w') as devnull:
+            subprocess.check_call(['taskset', '-p', '-c',
+                                   ','.join(str(c) for c in cpus), str(pid)],
+                                  stdout=devnull)
+
+    logger.debug('Thread %d pinned to cores %s' % (pid, cpus))
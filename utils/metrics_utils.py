@@ -0,0 +1,249 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+
+# Edit operations of the alignment
+MATCH, SUBSTITUTION, INSERTION, DELETION = '=', 'S', 'I', 'D'
+
+
+def _encode(hyp, ref):
+    """ Maps the tokens of both sequences to ints, so they can be compared
+    by numpy
+    """
+    vocab = {}
+    hyp = np.array([vocab.setdefault(t, len(vocab)) for t in hyp],
+                   dtype='int64')
+    ref = np.array([vocab.setdefault(t, len(vocab)) for t in ref],
+                   dtype='int64')
+    return hyp, ref
+
+
+def _dp_rows(hyp, ref):
+    """ Yields the rows of the Levenshtein matrix (hyp on the rows, ref on the
+    columns). Each row is computed with numpy: the substitutions and
+    insertions only depend on the previous row and the deletions (a running
+    minimum along the row) are a minimum.accumulate
+    """
+    cols = np.arange(len(ref) + 1)
+    row = cols.copy()
+    yield row
+
+    for i, h in enumerate(hyp, 1):
+        candidates = np.empty_like(row)
+        candidates[0] = i
+        candidates[1:] = np.minimum(row[1:] + 1, row[:-1] + (ref != h))
+        row = np.minimum.accumulate(candidates - cols) + cols
+        yield row
+
+
+def edit_distance(hyp, ref):
+    """ Levenshtein distance between two sequences
+    """
+    hyp, ref = _encode(hyp, ref)
+
+    for row in _dp_rows(hyp, ref):
+        pass
+
+    return int(row[-1])
+
+
+def align(hyp, ref):
+    """ Minimum edit alignment between two sequences
+
+    # Outputs
+        list of operations (MATCH, SUBSTITUTION, INSERTION or DELETION)
+        that transform ref into hyp
+    """
+    hyp, ref = _encode(hyp, ref)
+    d = np.array(list(_dp_rows(hyp, ref)))
+
+    ops = []
+    i, j = len(hyp), len(ref)
+    while i > 0 or j > 0:
+        if i > 0 and j > 0 and \
+                d[i, j] == d[i - 1, j - 1] + (hyp[i - 1] != ref[j - 1]):
+            ops.append(MATCH if hyp[i - 1] == ref[j - 1] else SUBSTITUTION)
+            i, j = i - 1, j - 1
+        elif i > 0 and d[i, j] == d[i - 1, j] + 1:
+            ops.append(INSERTION)
+            i -= 1
+        else:
+            ops.append(DELETION)
+            j -= 1
+
+    return ops[::-1]
+
+
+# Maximum number of cells of the Levenshtein matrices aligned at once by
+# _batch_counts (int32, so 64MB)
+MAX_BATCH_CELLS = 2 ** 24
+
+
+def _batch_counts(hyps, refs):
+    """ Substitutions, deletions and insertions of pairs of int sequences.
+    The Levenshtein matrices of all pairs are filled at once (row by row, as
+    in _dp_rows) and backtracked at once, with the same choices as align
+
+    # Outputs
+        int ndarray of shape (len(refs), 3)
+    """
+    n = len(refs)
+    hyp_lens = np.array([len(h) for h in hyps], dtype='int64')
+    ref_lens = np.array([len(r) for r in refs], dtype='int64')
+
+    # The padding (-1 and -2) is never reached by the backtrace
+    hyp = np.full((n, max(hyp_lens.max(), 1)), -1, dtype='int64')
+    ref = np.full((n, max(ref_lens.max(), 1)), -2, dtype='int64')
+    for k in range(n):
+        hyp[k, :hyp_lens[k]] = hyps[k]
+        ref[k, :ref_lens[k]] = refs[k]
+
+    cols = np.arange(ref.shape[1] + 1)
+    d = np.empty((n, hyp.shape[1] + 1, ref.shape[1] + 1), dtype='int32')
+    d[:, 0] = cols
+    for i in range(1, hyp_lens.max() + 1):
+        candidates = np.empty_like(d[:, i])
+        candidates[:, 0] = i
+        candidates[:, 1:] = np.minimum(
+            d[:, i - 1, 1:] + 1,
+            d[:, i - 1, :-1] + (ref != hyp[:, i - 1: i]))
+        d[:, i] = np.minimum.accumulate(candidates - cols, axis=1) + cols
+
+    counts = np.zeros((n, 3), dtype='int64')
+    rows = np.arange(n)
+    i, j = hyp_lens, ref_lens
+    active = (i > 0) | (j > 0)
+    while active.any():
+        i_1, j_1 = np.maximum(i - 1, 0), np.maximum(j - 1, 0)
+        current = d[rows, i, j]
+        mismatch = hyp[rows, i_1] != ref[rows, j_1]
+
+        diagonal = active & (i > 0) & (j > 0) & \
+            (current == d[rows, i_1, j_1] + mismatch)
+        insertion = active & ~diagonal & (i > 0) & \
+            (current == d[rows, i_1, j] + 1)
+        deletion = active & ~diagonal & ~insertion
+
+        counts[:, 0] += diagonal & mismatch
+        counts[:, 1] += deletion
+        counts[:, 2] += insertion
+
+        i = i - (diagonal | insertion)
+        j = j - (diagonal | deletion)
+        active = (i > 0) | (j > 0)
+
+    return counts
+
+
+def error_counts(hyps, refs, unit='char'):
+    """ Substitutions, deletions and insertions of each pair of sequences.
+    The pairs are aligned in batches (see _batch_counts) of similar sizes
+
+    # Arguments
+        hyps: list of hypotheses (str or sequences of labels)
+        refs: list of references
+        unit: 'char' or 'word' (strings are split on whitespaces)
+
+    # Outputs
+        int ndarray of shape (len(refs), 4) with the number of
+        substitutions, deletions, insertions and reference tokens
+    """
+    if unit not in ('char', 'word'):
+        raise ValueError('unit must be one of (char, word)')
+
+    if unit == 'word':
+        hyps = [h.split() for h in hyps]
+        refs = [r.split() for r in refs]
+
+    # Same ints for the same tokens in every pair
+    vocab = {}
+    hyps = [[vocab.setdefault(t, len(vocab)) for t in h] for h in hyps]
+    refs = [[vocab.setdefault(t, len(vocab)) for t in r] for r in refs]
+
+    counts = np.zeros((len(refs), 4), dtype='int64')
+    counts[:, 3] = [len(r) for r in refs]
+
+    # Pairs sorted by size, so each batch has little padding
+    order = sorted(range(len(refs)),
+                   key=lambda k: (len(hyps[k]) + 1) * (len(refs[k]) + 1))
+    start = 0
+    while start < len(order):
+        end, max_hyp, max_ref = start, 0, 0
+        while end < len(order):
+            k = order[end]
+            new_hyp = max(max_hyp, len(hyps[k]))
+            new_ref = max(max_ref, len(refs[k]))
+            if end > start and (end - start + 1) * (new_hyp + 1) * \
+                    (new_ref + 1) > MAX_BATCH_CELLS:
+                break
+            max_hyp, max_ref = new_hyp, new_ref
+            end += 1
+
+        batch = order[start: end]
+        counts[batch, :3] = _batch_counts([hyps[k] for k in batch],
+                                          [refs[k] for k in batch])
+        start = end
+
+    return counts
+
+
+def error_rate(counts):
+    """ (S + D + I) / N of the summed counts (see error_counts)
+    """
+    counts = np.asarray(counts).reshape((-1, 4)).sum(axis=0)
+    return counts[:3].sum() / max(counts[3], 1)
+
+
+def group_counts(counts, groups):
+    """ Sums the error counts of each group (e.g. speaker or dataset)
+
+    # Outputs
+        dictionary mapping each group to its summed counts
+    """
+    counts = np.asarray(counts)
+    groups = np.asarray(groups)
+    return {g: counts[groups == g].sum(axis=0)
+            for g in set(groups.tolist())}
+
+
+def cer(hyps, refs):
+    """ Character error rate over all pairs
+    """
+    return error_rate(error_counts(hyps, refs, unit='char'))
+
+
+def wer(hyps, refs):
+    """ Word error rate over all pairs
+    """
+    return error_rate(error_counts(hyps, refs, unit='word'))
+
+
+def ler(y_true, y_pred):
+    """ Label error rate of each sequence, normalized by the true length as in
+    tf.edit_distance
+
+    # Arguments
+        y_true: list of sequences of labels
+        y_pred: list of sequences of labels
+
+    # Outputs
+        ndarray with the label error rate of each sequence
+    """
+    counts = error_counts([list(p) for p in y_pred],
+                          [list(t) for t in y_true])
+    return counts[:, :3].sum(axis=1) / np.maximum(counts[:, 3], 1)
+
+
+def sparse_to_list(sparse):
+    """ Converts the scipy sparse labels generated by DatasetIterator to a
+    list of sequences
+    """
+    sparse = sparse.tocoo()
+    sequences = [[] for _ in range(sparse.shape[0])]
+
+    for row, col, value in sorted(zip(sparse.row, sparse.col, sparse.data)):
+        sequences[row].append(value)
+
+    return sequences
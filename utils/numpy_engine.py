@@ -0,0 +1,871 @@
+""" Lightweight numpy-only forward engine for the models in core.models
+
+Only numpy and h5py are needed, so neither tensorflow nor keras are loaded.
+The weights are read from the keras model files (e.g. `model.h5` and
+`best.h5` written by MetaCheckpoint, or a quantized model). At inference time
+dropout, zoneout and gaussian noise are identities.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import heapq
+import json
+import math
+
+import h5py
+import numpy as np
+
+from utils.generic_utils import load_meta
+from utils.quantization_utils import load_weights
+from utils.quantization_utils import QuantizedMatrix, int8_dot
+
+
+def softmax(x):
+    e = np.exp(x - np.max(x, axis=-1, keepdims=True))
+    return e / np.sum(e, axis=-1, keepdims=True)
+
+
+ACTIVATIONS = {
+    'linear': lambda x: x,
+    'tanh': np.tanh,
+    'sigmoid': lambda x: 1. / (1. + np.exp(-x)),
+    'hard_sigmoid': lambda x: np.clip(.2 * x + .5, 0., 1.),
+    'relu': lambda x: np.maximum(x, 0.),
+    'softmax': softmax,
+    # models.maas and models.deep_speech default max_value
+    'clipped_relu': lambda x: np.clip(x, 0., 20.),
+}
+
+
+def get_activation(name):
+    try:
+        return ACTIVATIONS[name]
+    except KeyError:
+        raise ValueError('Activation %s is not supported. Valid values are: '
+                         '%s' % (name, ', '.join(ACTIVATIONS.keys())))
+
+
+def normalize(x, epsilon=1e-5):
+    """ Same as core.layers_utils.normalize over the last axis
+    """
+    mean = np.mean(x, axis=-1, keepdims=True)
+    var = np.var(x, axis=-1, keepdims=True)
+    return (x - mean) / np.sqrt(var + epsilon)
+
+
+def layer_normalization(x, gain, bias, epsilon=1e-5):
+    return normalize(x, epsilon) * gain + bias
+
+
+def dot(x, W):
+    """ Single GEMM over all leading axes of x. float16 inputs are multiplied
+    in float32, since numpy has no float16 BLAS (NumpyModel keeps the
+    matrices in float32 for that), and int8 weights (QuantizedMatrix) in int8
+    arithmetic (see int8_dot)
+    """
+    shape = x.shape
+    x = x.reshape((-1, shape[-1]))
+
+    if isinstance(W, QuantizedMatrix):
+        out = int8_dot(x, W)
+    elif x.dtype == np.float16:
+        out = np.dot(x.astype('float32'), W).astype('float16')
+    else:
+        out = np.dot(x, W)
+
+    return out.reshape(shape[:-1] + (W.shape[-1],))
+
+
+class LayerWeights(object):
+    """ Finds the weights of a layer given its name (e.g. `lstm_1`) and the
+    weight key (e.g. `W`)
+    """
+
+    def __init__(self, named_weights):
+        self._weights = [(name.split(':')[0], value)
+                         for name, value in named_weights]
+
+    def get(self, layer_name, key, default=None):
+        suffix = '%s_%s' % (layer_name, key)
+        for name, value in self._weights:
+            if name == suffix or name.endswith('/' + suffix) or \
+                    name.endswith('_' + suffix):
+                return value
+        if default is not None:
+            return default
+        raise KeyError('Weight %s not found' % suffix)
+
+
+class Layer(object):
+
+    def __init__(self, config, weights, name=None):
+        self.config = config
+        self.name = name or config['name']
+
+    def __call__(self, x):
+        raise NotImplementedError('__call__ must be implemented')
+
+    def reduce_length(self, lengths):
+        """ Lengths of the output sequences (given the input lengths)
+        """
+        return lengths
+
+
+class Identity(Layer):
+    """ GaussianNoise, Dropout and Masking at test time
+    """
+
+    def __call__(self, x):
+        return x
+
+
+class Activation(Layer):
+
+    def __init__(self, config, weights, name=None):
+        super(Activation, self).__init__(config, weights, name)
+        self.activation = get_activation(config['activation'])
+
+    def __call__(self, x):
+        return self.activation(x)
+
+
+class Dense(Layer):
+
+    def __init__(self, config, weights, name=None):
+        super(Dense, self).__init__(config, weights, name)
+        self.W = weights.get(self.name, 'W')
+        self.b = weights.get(self.name, 'b') if config.get('bias', True) \
+            else 0.
+        self.activation = get_activation(config.get('activation', 'linear'))
+
+    def __call__(self, x):
+        return self.activation(dot(x, self.W) + self.b)
+
+
+class FusedDense(Layer):
+    """ Dense with clipped relu (dropout is an identity at test time)
+    """
+
+    def __init__(self, config, weights, name=None):
+        super(FusedDense, self).__init__(config, weights, name)
+        self.W = weights.get(self.name, 'W')
+        self.b = weights.get(self.name, 'b')
+        self.max_value = config.get('max_value')
+
+    def __call__(self, x):
+        out = np.maximum(dot(x, self.W) + self.b, 0.)
+        if self.max_value is not None:
+            out = np.minimum(out, self.max_value)
+        return out
+
+
+class Convolution1D(Layer):
+    """ Strided 1-D convolution as a single GEMM over the stacked patches
+    """
+
+    def __init__(self, config, weights, name=None):
+        super(Convolution1D, self).__init__(config, weights, name)
+        W = weights.get(self.name, 'W')
+        # (filter_length, 1, input_dim, nb_filter)
+        self.W = W.reshape((W.shape[0] * W.shape[2], W.shape[3]))
+        self.b = weights.get(self.name, 'b') if config.get('bias', True) \
+            else 0.
+        self.filter_length = config['filter_length']
+        self.stride = config.get('subsample_length', 1)
+        self.border_mode = config.get('border_mode', 'valid')
+        self.activation = get_activation(config.get('activation', 'linear'))
+
+    def patches(self, x):
+        """ (N, T', filter_length, input_dim) windows of each output step
+        """
+        k, s = self.filter_length, self.stride
+        timesteps = x.shape[1]
+
+        if self.border_mode == 'same':
+            # Same padding as tensorflow
+            out_len = (timesteps + s - 1) // s
+            pad = max((out_len - 1) * s + k - timesteps, 0)
+            x = np.pad(x, ((0, 0), (pad // 2, pad - pad // 2), (0, 0)),
+                       'constant')
+        else:
+            out_len = (timesteps - k) // s + 1
+
+        return np.stack(
+            [x[:, j: j + (out_len - 1) * s + 1: s] for j in range(k)], axis=2)
+
+    def __call__(self, x):
+        patches = self.patches(x)
+        patches = patches.reshape(patches.shape[:2] + (-1,))
+        return self.activation(dot(patches, self.W) + self.b)
+
+    def reduce_length(self, lengths):
+        if self.border_mode == 'same':
+            return reduced_length(lengths, self.stride)
+        return (lengths - self.filter_length) // self.stride + 1
+
+
+class SeparableConvolution1D(Convolution1D):
+
+    def __init__(self, config, weights, name=None):
+        Layer.__init__(self, config, weights, name)
+        # Multiplied elementwise, so it is never kept in int8
+        self.depthwise_W = np.asarray(weights.get(self.name, 'depthwise_W'),
+                                      dtype='float32')
+        self.pointwise_W = weights.get(self.name, 'pointwise_W')
+        self.b = weights.get(self.name, 'b') if config.get('bias', True) \
+            else 0.
+        self.filter_length = config['filter_length']
+        self.stride = config.get('subsample_length', 1)
+        self.border_mode = config.get('border_mode', 'same')
+        self.activation = get_activation(config.get('activation', 'linear'))
+
+    def __call__(self, x):
+        depthwise = np.sum(self.patches(x) * self.depthwise_W,
+                           axis=2).astype(x.dtype, copy=False)
+        return self.activation(dot(depthwise, self.pointwise_W) + self.b)
+
+
+class FrameStack(Layer):
+
+    def __init__(self, config, weights, name=None):
+        super(FrameStack, self).__init__(config, weights, name)
+        self.factor = config.get('factor', 2)
+
+    def __call__(self, x):
+        pad = -x.shape[1] % self.factor
+        x = np.pad(x, ((0, 0), (0, pad), (0, 0)), 'constant')
+        return x.reshape((x.shape[0], -1, self.factor * x.shape[2]))
+
+    def reduce_length(self, lengths):
+        return reduced_length(lengths, self.factor)
+
+
+class LengthReduction(Layer):
+
+    def __init__(self, config, weights, name=None):
+        super(LengthReduction, self).__init__(config, weights, name)
+        self.factor = config.get('factor', 2)
+
+    def __call__(self, x):
+        return reduced_length(x, self.factor)
+
+
+class TimeDistributed(Layer):
+    """ Dense is already applied over all timesteps
+    """
+
+    def __init__(self, config, weights, name=None):
+        super(TimeDistributed, self).__init__(config, weights, name)
+        self.layer = make_layer(config['layer'], weights)
+
+    def __call__(self, x):
+        return self.layer(x)
+
+
+class Recurrent(Layer):
+    """ Base class of the recurrent layers. The input projection of all
+    timesteps is done with a single GEMM, so only the recurrent term is
+    computed inside the loop
+    """
+
+    def __init__(self, config, weights, name=None):
+        super(Recurrent, self).__init__(config, weights, name)
+        self.output_dim = config['output_dim']
+        self.return_sequences = config.get('return_sequences', False)
+        self.go_backwards = config.get('go_backwards', False)
+        self.activation = get_activation(config.get('activation', 'tanh'))
+        self.inner_activation = get_activation(
+            config.get('inner_activation', 'hard_sigmoid'))
+
+    def input_projection(self, x):
+        raise NotImplementedError('input_projection must be implemented')
+
+    def initial_states(self, x):
+        return [np.zeros((x.shape[0], self.output_dim), dtype=x.dtype)]
+
+    def step(self, x_proj, states):
+        raise NotImplementedError('step must be implemented')
+
+    def __call__(self, x, lengths=None):
+        if lengths is not None:
+            return self._call_with_lengths(x, lengths)
+
+        if self.go_backwards:
+            x = x[:, ::-1]
+
+        x_proj = self.input_projection(x)
+        states = self.initial_states(x)
+
+        outputs = []
+        for t in range(x.shape[1]):
+            h, states = self.step(x_proj[:, t], states)
+            outputs.append(h)
+
+        if self.return_sequences:
+            return np.stack(outputs, axis=1)
+        return outputs[-1]
+
+    def _call_with_lengths(self, x, lengths):
+        """ Length-aware recurrence, as `core.layers_utils.length_aware_rnn`
+        """
+        if self.go_backwards:
+            x = reverse_sequence(x, lengths)
+
+        x_proj = self.input_projection(x)
+        # Updated in place
+        states = [s.copy() for s in self.initial_states(x)]
+
+        outputs = np.zeros(x.shape[:2] + (self.output_dim,), dtype=x.dtype)
+        for t in range(np.max(lengths)):
+            active = lengths > t
+            h, new_states = self.step(x_proj[active, t],
+                                      [s[active] for s in states])
+            for s, new_s in zip(states, new_states):
+                s[active] = new_s
+            outputs[active, t] = h
+
+        if not self.return_sequences:
+            return states[0]
+
+        if self.go_backwards:
+            outputs = reverse_sequence(outputs, lengths)[:, ::-1]
+        return outputs
+
+
+class SimpleRNN(Recurrent):
+
+    def __init__(self, config, weights, name=None):
+        super(SimpleRNN, self).__init__(config, weights, name)
+        self.W = weights.get(self.name, 'W')
+        self.U = weights.get(self.name, 'U')
+        self.b = weights.get(self.name, 'b')
+
+    def input_projection(self, x):
+        return dot(x, self.W) + self.b
+
+    def step(self, x_proj, states):
+        h = self.activation(x_proj + dot(states[0], self.U))
+        return h, [h]
+
+
+class GRU(Recurrent):
+
+    def __init__(self, config, weights, name=None):
+        super(GRU, self).__init__(config, weights, name)
+        self.W = weights.get(self.name, 'W')
+        U = weights.get(self.name, 'U')
+        # Split once, not at every step
+        self.U_zr = U[:, :2 * self.output_dim]
+        self.U_h = U[:, 2 * self.output_dim:]
+        self.b = weights.get(self.name, 'b')
+
+    def input_projection(self, x):
+        return dot(x, self.W) + self.b
+
+    def step(self, x_proj, states):
+        h_tm1 = states[0]
+        dim = self.output_dim
+
+        inner = dot(h_tm1, self.U_zr)
+        z = self.inner_activation(x_proj[:, :dim] + inner[:, :dim])
+        r = self.inner_activation(x_proj[:, dim: 2 * dim] +
+                                  inner[:, dim: 2 * dim])
+        hh = self.activation(x_proj[:, 2 * dim:] +
+                             dot(r * h_tm1, self.U_h))
+        h = z * h_tm1 + (1 - z) * hh
+        return h, [h]
+
+
+class LSTM(Recurrent):
+    """ Keras LSTM and core.layers.LSTM (with the optional layer
+    normalization and multiplicative integration)
+    """
+
+    def __init__(self, config, weights, name=None):
+        super(LSTM, self).__init__(config, weights, name)
+        self.W = weights.get(self.name, 'W')
+        self.U = weights.get(self.name, 'U')
+        self.b = weights.get(self.name, 'b')
+
+        self.layer_norm = config.get('layer_norm') is not None
+        if self.layer_norm:
+            self.ln = {k: (weights.get(self.name, 'ln_gain_%s' % k),
+                           weights.get(self.name, 'ln_bias_%s' % k))
+                       for k in ('Uh', 'Wx', 'new_c')}
+
+        self.mi = config.get('mi') is not None
+        if self.mi:
+            self.mi_alpha = weights.get(self.name, 'mi_alpha')
+            self.mi_beta1 = weights.get(self.name, 'mi_beta1')
+            self.mi_beta2 = weights.get(self.name, 'mi_beta2')
+
+    def _layer_norm(self, x, key):
+        if not self.layer_norm:
+            return x
+        return layer_normalization(x, *self.ln[key])
+
+    def input_projection(self, x):
+        """ As core.layers.LSTM, the Uh layer normalization gain and bias are
+        merged into the input projection
+        """
+        Wx = self._layer_norm(dot(x, self.W), 'Wx')
+
+        if self.mi:
+            # (alpha * Wx + beta1) * Uh + (beta2 * Wx + b)
+            scale = self.mi_alpha * Wx + self.mi_beta1
+            shift = self.mi_beta2 * Wx + self.b
+
+            if self.layer_norm:
+                gain, bias = self.ln['Uh']
+                shift += scale * bias
+                scale *= gain
+
+            return np.concatenate([scale, shift], axis=-1)
+
+        if self.layer_norm:
+            return Wx + self.b + self.ln['Uh'][1]
+        return Wx + self.b
+
+    def initial_states(self, x):
+        zeros = np.zeros((x.shape[0], self.output_dim), dtype=x.dtype)
+        return [zeros, zeros]
+
+    def step(self, x_proj, states):
+        h_tm1, c_tm1 = states
+        dim = self.output_dim
+
+        Uh = dot(h_tm1, self.U)
+
+        if self.layer_norm:
+            Uh = normalize(Uh)
+            if not self.mi:
+                Uh *= self.ln['Uh'][0]
+
+        if self.mi:
+            z = x_proj[:, :4 * dim] * Uh + x_proj[:, 4 * dim:]
+        else:
+            z = x_proj + Uh
+
+        i = self.inner_activation(z[:, :dim])
+        f = self.inner_activation(z[:, dim: 2 * dim])
+        c = f * c_tm1 + i * self.activation(z[:, 2 * dim: 3 * dim])
+        o = self.inner_activation(z[:, 3 * dim:])
+
+        h = o * self.activation(self._layer_norm(c, 'new_c'))
+
+        return h, [h, c]
+
+
+class RHN(Recurrent):
+
+    def __init__(self, config, weights, name=None):
+        super(RHN, self).__init__(config, weights, name)
+        self.depth = config.get('depth', 1)
+        self.coupling = config.get('coupling', True)
+        self.layer_norm = config.get('layer_norm', False)
+        self.mi = config.get('mi', False)
+
+        self.W = weights.get(self.name, 'W')
+        self.Us = [weights.get(self.name, '%d_U' % l)
+                   for l in range(self.depth)]
+        self.bs = [weights.get(self.name, '%d_b' % l)
+                   for l in range(self.depth)]
+
+        if self.mi:
+            self.mi_params = [
+                [weights.get(self.name, '%d_%s' % (l, p))
+                 for p in (('alpha', 'beta1', 'beta2') if l == 0
+                           else ('beta1',))]
+                for l in range(self.depth)]
+
+        if self.layer_norm:
+            self.ln = [(weights.get(self.name, '%d_ln_gain_h' % l),
+                        weights.get(self.name, '%d_ln_bias_h' % l))
+                       for l in range(self.depth)]
+
+    def input_projection(self, x):
+        return dot(x, self.W)
+
+    def step(self, x_proj, states):
+        s_tm1 = states[0]
+        dim = self.output_dim
+
+        for l in range(self.depth):
+            Us = dot(s_tm1, self.Us[l])
+
+            if self.mi and l == 0:
+                alpha, beta1, beta2 = self.mi_params[l]
+                a = alpha * x_proj * Us + beta1 * Us + beta2 * x_proj
+            elif self.mi:
+                a = self.mi_params[l][0] * Us
+            elif l == 0:
+                a = x_proj + Us
+            else:
+                a = Us
+            a = a + self.bs[l]
+
+            a0 = a[:, :dim]
+            if self.layer_norm:
+                a0 = layer_normalization(a0, *self.ln[l])
+
+            h = self.activation(a0)
+            t = self.inner_activation(a[:, dim: 2 * dim])
+            if self.coupling:
+                c = 1 - t
+            else:
+                c = self.inner_activation(a[:, 2 * dim:])
+
+            s_tm1 = h * t + s_tm1 * c
+
+        return s_tm1, [s_tm1]
+
+
+class Bidirectional(Layer):
+
+    def __init__(self, config, weights, name=None):
+        super(Bidirectional, self).__init__(config, weights, name)
+        layer_config = config['layer']
+        inner_name = layer_config['config']['name']
+
+        self.merge_mode = config.get('merge_mode', 'concat')
+        self.forward_layer = make_layer(layer_config, weights,
+                                        name='forward_%s' % inner_name)
+
+        backward_config = {'class_name': layer_config['class_name'],
+                           'config': dict(layer_config['config'],
+                                          go_backwards=True)}
+        self.backward_layer = make_layer(backward_config, weights,
+                                         name='backward_%s' % inner_name)
+
+    def __call__(self, x, lengths=None):
+        y = self.forward_layer(x, lengths=lengths)
+        y_rev = self.backward_layer(x, lengths=lengths)
+
+        if self.forward_layer.return_sequences:
+            y_rev = y_rev[:, ::-1]
+
+        return merge([y, y_rev], self.merge_mode)
+
+
+class LengthMasking(Layer):
+    """ The lengths are fed to the recurrent layers by NumpyModel
+    """
+
+    def __call__(self, x):
+        return x[0]
+
+
+class Merge(Layer):
+
+    def __init__(self, config, weights, name=None):
+        super(Merge, self).__init__(config, weights, name)
+        self.mode = config.get('mode', 'sum')
+        self.concat_axis = config.get('concat_axis', -1)
+
+    def __call__(self, x):
+        return merge(x, self.mode, self.concat_axis)
+
+
+def reduced_length(lengths, factor):
+    return (lengths + factor - 1) // factor
+
+
+def reverse_sequence(x, lengths):
+    """ Reverses only the first lengths[i] timesteps of each sequence
+    """
+    x = x.copy()
+    for i, length in enumerate(lengths):
+        x[i, :length] = x[i, :length][::-1]
+    return x
+
+
+def merge(inputs, mode, concat_axis=-1):
+    if mode == 'concat':
+        return np.concatenate(inputs, axis=concat_axis)
+    if mode == 'sum':
+        return sum(inputs)
+    if mode == 'ave':
+        return sum(inputs) / len(inputs)
+    if mode == 'mul':
+        out = inputs[0]
+        for i in inputs[1:]:
+            out = out * i
+        return out
+    raise ValueError('Merge mode %s is not supported' % mode)
+
+
+LAYERS = {'GaussianNoise': Identity,
+          'Dropout': Identity,
+          'Masking': Identity,
+          'ClearMask': Identity,
+          'LengthMasking': LengthMasking,
+          'Activation': Activation,
+          'Dense': Dense,
+          'FusedDense': FusedDense,
+          'Convolution1D': Convolution1D,
+          'SeparableConvolution1D': SeparableConvolution1D,
+          'FrameStack': FrameStack,
+          'LengthReduction': LengthReduction,
+          'TimeDistributed': TimeDistributed,
+          'SimpleRNN': SimpleRNN,
+          'GRU': GRU,
+          'LSTM': LSTM,
+          'RHN': RHN,
+          'Bidirectional': Bidirectional,
+          'Merge': Merge}
+
+
+def make_layer(layer_config, weights, name=None):
+    class_name = layer_config['class_name']
+    if class_name not in LAYERS:
+        raise NotImplementedError('Layer %s is not supported by the numpy '
+                                  'engine' % class_name)
+
+    return LAYERS[class_name](layer_config['config'], weights, name=name)
+
+
+def ctc_greedy_decode(y_pred, inputs_length):
+    """ Greedy (best path) CTC decoder. The blank label is the last class, as
+    in tf.nn.ctc_greedy_decoder
+
+    # Outputs
+        list of ndarray with the decoded labels of each sequence
+    """
+    blank = y_pred.shape[-1] - 1
+    best_path = np.argmax(y_pred, axis=-1)
+
+    decoded = []
+    for path, length in zip(best_path, inputs_length):
+        path = path[:length]
+        keep = np.ones(len(path), dtype=bool)
+        keep[1:] = path[1:] != path[:-1]
+        path = path[keep]
+        decoded.append(path[path != blank])
+
+    return decoded
+
+
+def log_softmax(x):
+    x = x - np.max(x, axis=-1, keepdims=True)
+    return x - np.log(np.sum(np.exp(x), axis=-1, keepdims=True))
+
+
+def _logsumexp(a, b):
+    if a < b:
+        a, b = b, a
+    if b == -np.inf:
+        return a
+    return a + math.log1p(math.exp(b - a))
+
+
+def ctc_beam_search_decode(y_pred, length, beam_width=100, top_paths=1,
+                           temperature=1., insertion_bonus=0., prune=None):
+    """ CTC prefix beam search over the outputs of a single sequence. The
+    blank label is the last class, as in tf.nn.ctc_beam_search_decoder
+
+    # Arguments
+        y_pred: ndarray (T, C) with the network output (before softmax)
+        length: number of valid timesteps of y_pred
+        beam_width: number of prefixes kept at each timestep
+        top_paths: number of decoded sequences
+        temperature: the outputs are divided by it before the softmax
+        insertion_bonus: log-probability added to each emitted label (e.g.
+        to balance the weight of a language model)
+        prune: if set, labels whose log-probability is lower than the best
+        one of the timestep minus prune are not expanded
+
+    # Outputs
+        list of (labels, log-probability) of the top_paths best sequences
+    """
+    log_probs = log_softmax(np.asarray(y_pred[:length], dtype='float64') /
+                            temperature)
+    blank = log_probs.shape[-1] - 1
+
+    # prefix -> [log p(ending in blank), log p(ending in a label)]
+    beams = {(): [0., -np.inf]}
+
+    for lp in log_probs:
+        labels = range(blank)
+        if prune is not None:
+            keep = lp[:blank] >= lp.max() - prune
+            labels = np.flatnonzero(keep).tolist()
+        lp = lp.tolist()
+
+        next_beams = {}
+        for prefix, (p_b, p_nb) in beams.items():
+            p_total = _logsumexp(p_b, p_nb)
+
+            beam = next_beams.setdefault(prefix, [-np.inf, -np.inf])
+            beam[0] = _logsumexp(beam[0], p_total + lp[blank])
+
+            last = prefix[-1] if prefix else None
+            for label in labels:
+                p = lp[label]
+                new_beam = next_beams.setdefault(prefix + (label,),
+                                                 [-np.inf, -np.inf])
+                if label == last:
+                    # Repeated labels are only emitted after a blank
+                    new_beam[1] = _logsumexp(new_beam[1],
+                                             p_b + p + insertion_bonus)
+                    beam[1] = _logsumexp(beam[1], p_nb + p)
+                else:
+                    new_beam[1] = _logsumexp(new_beam[1],
+                                             p_total + p + insertion_bonus)
+
+        beams = dict(heapq.nlargest(beam_width, next_beams.items(),
+                                    key=lambda b: _logsumexp(*b[1])))
+
+    best = heapq.nlargest(top_paths, beams.items(),
+                          key=lambda b: _logsumexp(*b[1]))
+    return [(np.array(prefix, dtype='int32'), _logsumexp(*probs))
+            for prefix, probs in best]
+
+
+class NumpyModel(object):
+    """ Runs the forward pass of a keras model up to the network output (the
+    input of the CTC decoder)
+
+    # Arguments
+        model_fname: path to a keras model file
+        dtype: dtype of the weights and activations. With float16, the
+        activations and the vectors take half of the memory; the matrices
+        are rounded to float16 but kept in float32, since the products are
+        computed in float32. With int8 (only for the models saved by
+        extras/quantize_model.py), the quantized matrices are multiplied in
+        int8 arithmetic (see int8_dot); the activations are float32
+    """
+
+    def __init__(self, model_fname, dtype='float32'):
+        self.int8 = np.dtype(dtype) == np.int8
+        self.dtype = np.dtype('float32' if self.int8 else dtype)
+
+        with h5py.File(model_fname, 'r') as f:
+            if self.int8 and not f.attrs.get('quantized', False):
+                raise ValueError('int8 needs a model quantized by '
+                                 'extras/quantize_model.py')
+            model_config = json.loads(
+                f.attrs['model_config'].decode('utf-8'))['config']
+            weights = load_weights(f['model_weights'],
+                                   dequantize_weights=not self.int8,
+                                   with_names=True)
+
+        layers_config = {l['name']: l for l in model_config['layers']}
+        self.input_name = model_config['input_layers'][0][0]
+
+        # Models in length-aware mode (see core.layers.LengthMasking)
+        self.length_aware = any(l['class_name'] == 'LengthMasking'
+                                for l in model_config['layers'])
+
+        # The network output is the first input of the decoder and the
+        # output length (reduced by time-reduction models) is the last one
+        self.length_name = 'inputs_length'
+        for decoder_name in ('decoder', 'beam_search', 'ctc'):
+            if decoder_name in layers_config:
+                inbound = layers_config[decoder_name]['inbound_nodes'][0]
+                self.output_name = inbound[0][0]
+                self.length_name = inbound[-1][0]
+                break
+        else:
+            self.output_name = model_config['output_layers'][0][0]
+
+        # Only the layers needed to compute the output, in topological order
+        needed = set()
+        to_visit = [self.output_name]
+        if self.length_name in layers_config:
+            to_visit.append(self.length_name)
+        while to_visit:
+            name = to_visit.pop()
+            if name in needed:
+                continue
+            needed.add(name)
+            for node in layers_config[name]['inbound_nodes'][:1]:
+                to_visit.extend(inbound[0] for inbound in node)
+
+        self.layers = []
+        for layer_config in model_config['layers']:
+            name = layer_config['name']
+            if name not in needed or layer_config['class_name'] == \
+                    'InputLayer':
+                continue
+
+            layer_weights = LayerWeights(
+                [(n, self._cast(w)) for n, w in weights.get(name, [])])
+            inbound = [i[0] for i in layer_config['inbound_nodes'][0]]
+
+            self.layers.append((name, make_layer(layer_config,
+                                                 layer_weights), inbound))
+
+    def _cast(self, w):
+        if isinstance(w, tuple):
+            return QuantizedMatrix(*w)
+        if self.dtype == np.float16 and w.ndim > 1:
+            # Upcast once here, not at every product (see dot)
+            return w.astype('float16').astype('float32')
+        return w.astype(self.dtype)
+
+    def _forward(self, inputs, inputs_length=None):
+        """ Computes the outputs of all layers
+        """
+        outputs = {self.input_name: np.asarray(inputs, dtype=self.dtype)}
+
+        if inputs_length is not None:
+            outputs['inputs_length'] = np.asarray(
+                inputs_length, dtype='int32').ravel()
+        elif self.length_aware:
+            raise ValueError('inputs_length is required by length-aware '
+                             'models')
+
+        # Lengths of the masked outputs (see core.layers.LengthMasking)
+        lengths = {}
+
+        for name, layer, inbound in self.layers:
+            x = [outputs[i] for i in inbound]
+            x = x if len(x) > 1 else x[0]
+
+            if isinstance(layer, LengthMasking):
+                lengths[name] = outputs[inbound[1]]
+            elif inbound[0] in lengths:
+                lengths[name] = layer.reduce_length(lengths[inbound[0]])
+
+            if isinstance(layer, (Recurrent, Bidirectional)):
+                outputs[name] = layer(x, lengths=lengths.get(inbound[0]))
+            else:
+                outputs[name] = layer(x)
+
+        return outputs
+
+    def predict(self, inputs, inputs_length=None):
+        """ Computes the network output
+
+        # Inputs
+            inputs: ndarray (N, T, F) with the padded features
+            inputs_length: ndarray (N,) with the length of each sequence.
+            Required by length-aware models
+
+        # Outputs
+            ndarray (N, T', C) with the network output (before softmax). T'
+            is smaller than T in time-reduction models
+        """
+        return self._forward(inputs, inputs_length)[self.output_name]
+
+    def decode(self, inputs, inputs_length):
+        """ Returns the greedy decoded labels of each sequence
+        """
+        outputs = self._forward(inputs, inputs_length)
+        return ctc_greedy_decode(outputs[self.output_name],
+                                 outputs[self.length_name].ravel())
+
+
+def load_model(model_fname, return_meta=False, dtype='float32'):
+    """ Loads a keras model file in the numpy engine
+
+    # Outputs
+        NumpyModel and, if return_meta is True, its meta configuration
+    """
+    model = NumpyModel(model_fname, dtype=dtype)
+
+    if return_meta:
+        return model, load_meta(model_fname)
+
+    return model
@@ -0,0 +1,209 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import re
+
+import h5py
+import numpy as np
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Input (W) and recurrent (U) matrices of LSTMs, RHNs and Dense layers
+QUANTIZABLE_WEIGHTS = r'.*_(W|U)(:0)?$'
+
+
+def quantize(w, num_bits=8):
+    """ Symmetric per-channel quantization of a 2-D weight matrix
+
+    Each output channel (column) has its own scale, so
+    `w ~= q.astype('float32') * scale`
+
+    # Outputs
+        q: int8 ndarray with the same shape as w
+        scale: float32 ndarray of shape (w.shape[-1],)
+    """
+    q_max = 2 ** (num_bits - 1) - 1
+
+    scale = np.max(np.abs(w), axis=0) / q_max
+    scale[scale == 0] = 1.
+
+    q = np.clip(np.round(w / scale), -q_max, q_max).astype('int8')
+
+    return q, scale.astype('float32')
+
+
+def dequantize(q, scale):
+    return q.astype('float32') * scale
+
+
+class QuantizedMatrix(object):
+    """ int8 weight matrix q with per-column scales (see quantize). It is
+    multiplied by int8_dot; `np.asarray` returns the dequantized matrix (for
+    the weights that are not used in products)
+    """
+
+    def __init__(self, q, scale):
+        self.q = q
+        self.scale = scale
+        self._blocks = None
+
+    @property
+    def blocks(self):
+        """ float32 copies of the blocks of INT8_DOT_BLOCK rows of q, made on
+        the first product and reused by the next ones (e.g. every timestep
+        of a recurrence)
+        """
+        if self._blocks is None:
+            self._blocks = [self.q[i: i + INT8_DOT_BLOCK].astype('float32')
+                            for i in range(0, self.q.shape[0],
+                                           INT8_DOT_BLOCK)]
+        return self._blocks
+
+    @property
+    def shape(self):
+        return self.q.shape
+
+    def __getitem__(self, key):
+        # e.g. W[:, :dim]. The scales follow the columns
+        if not isinstance(key, tuple):
+            key = (key, slice(None))
+        return QuantizedMatrix(self.q[key], self.scale[key[1]])
+
+    def __array__(self, dtype=None):
+        w = dequantize(self.q, self.scale)
+        return w if dtype is None else w.astype(dtype)
+
+
+# Rows of q per float32 product in int8_dot: 1024 * 127 * 127 < 2 ** 24, so
+# every partial sum is an exact integer in float32
+INT8_DOT_BLOCK = 1024
+
+
+def int8_dot(x, w, num_bits=8):
+    """ Product of a 2-D float matrix x and a QuantizedMatrix w in int8
+    arithmetic: each row of x is quantized to int8 (with its own scale) and
+    the int8 products are accumulated exactly.
+
+    numpy has no int8 GEMM, so the integer products run on the float32 BLAS
+    over the cached float32 blocks of w (see QuantizedMatrix.blocks), with
+    the partial sums of the blocks accumulated in int32. The product costs
+    about as much as in float32, plus the quantization of x
+    """
+    q_max = 2 ** (num_bits - 1) - 1
+
+    x_scale = np.max(np.abs(x), axis=1, keepdims=True) / q_max
+    x_scale[x_scale == 0] = 1.
+    x_q = np.clip(np.round(x / x_scale), -q_max, q_max).astype('float32')
+
+    blocks = w.blocks
+    if len(blocks) == 1:
+        acc = np.dot(x_q, blocks[0])
+    else:
+        acc = np.zeros((x.shape[0], w.q.shape[1]), dtype='int32')
+        for i, block in enumerate(blocks):
+            start = i * INT8_DOT_BLOCK
+            acc += np.dot(x_q[:, start: start + INT8_DOT_BLOCK],
+                          block).astype('int32')
+        acc = acc.astype('float32')
+
+    return acc * (x_scale * w.scale)
+
+
+def is_quantized(fname):
+    with h5py.File(fname, 'r') as f:
+        return bool(f.attrs.get('quantized', False))
+
+
+def quantize_model(model_fname, output_fname, pattern=QUANTIZABLE_WEIGHTS,
+                   min_size=0):
+    """ Writes a copy of the keras model with int8 weights
+
+    The optimizer weights are dropped, so the quantized model can only be used
+    for inference. Each quantized weight `name` has its scale saved in the
+    dataset `name_scale`.
+
+    # Arguments
+        pattern: regex that matches the weights names to be quantized
+        min_size: matrices with less than min_size elements are kept in
+        float32
+
+    # Outputs
+        a dictionary with the original and quantized sizes (in bytes)
+    """
+    pattern = re.compile(pattern)
+    sizes = {'original': 0, 'quantized': 0}
+
+    with h5py.File(model_fname, 'r') as f_in, \
+            h5py.File(output_fname, 'w') as f_out:
+
+        for k, v in f_in.attrs.items():
+            f_out.attrs[k] = v
+        f_out.attrs['quantized'] = True
+
+        if 'meta' in f_in:
+            f_in.copy('meta', f_out)
+
+        in_weights = f_in['model_weights']
+        out_weights = f_out.create_group('model_weights')
+        for k, v in in_weights.attrs.items():
+            out_weights.attrs[k] = v
+
+        for layer_name in in_weights.attrs['layer_names']:
+            in_group = in_weights[layer_name]
+            out_group = out_weights.create_group(layer_name)
+            for k, v in in_group.attrs.items():
+                out_group.attrs[k] = v
+
+            for name in in_group.attrs['weight_names']:
+                w = in_group[name][...]
+                sizes['original'] += w.nbytes
+
+                if (w.ndim == 2 and w.size >= min_size and
+                        pattern.match(name.decode('utf8'))):
+                    q, scale = quantize(w)
+                    out_group.create_dataset(name, data=q)
+                    out_group.create_dataset('%s_scale' % name, data=scale)
+                    sizes['quantized'] += q.nbytes + scale.nbytes
+                else:
+                    out_group.create_dataset(name, data=w)
+                    sizes['quantized'] += w.nbytes
+
+    return sizes
+
+
+def load_weights(h5_group, dequantize_weights=True, with_names=False):
+    """ Reads all weights of a (possibly quantized) `model_weights` group
+
+    # Arguments
+        dequantize_weights: if False, quantized weights are returned as a
+        tuple (q, scale)
+        with_names: if True, each weight is returned as a tuple (name, value)
+
+    # Outputs
+        dictionary that maps the layer name to the list of its weights
+    """
+    weights = {}
+    for layer_name in h5_group.attrs['layer_names']:
+        group = h5_group[layer_name]
+
+        layer_weights = []
+        for name in group.attrs['weight_names']:
+            w = group[name][...]
+
+            scale_name = '%s_scale' % name
+            if scale_name in group:
+                scale = group[scale_name][...]
+                w = dequantize(w, scale) if dequantize_weights else (w, scale)
+
+            if with_names:
+                w = (name.decode('utf8'), w)
+
+            layer_weights.append(w)
+
+        if layer_weights:
+            weights[layer_name.decode('utf8')] = layer_weights
+
+    return weights
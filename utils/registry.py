@@ -0,0 +1,100 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import importlib
+import inspect
+
+from utils.hparams import HParams
+
+
+class Registry(object):
+    """ Maps names to the classes, functions or instances of one kind (e.g.
+    models). Members add themselves with the `register` decorator when their
+    module is imported, so each lookup is a dictionary access
+
+    # Arguments
+        name: what is registered, used in the error messages
+        modules: modules that register the members. They are imported on
+        the first lookup (and only then, so importing the registry is cheap)
+    """
+
+    def __init__(self, name, modules=()):
+        self.name = name
+        self.modules = list(modules)
+        self._members = {}
+        # Lookups are case insensitive
+        self._index = {}
+        self._loaded = False
+
+    def register(self, member=None, name=None):
+        """ Registers member under name (defaults to its __name__). It can be
+        used as a decorator (`@MODELS.register`) or called with instances
+        and aliases (`PARSERS.register(simple_char_parser, 'simple')`)
+        """
+        def decorator(member):
+            key = name or member.__name__
+            self._members[key] = member
+            self._index[key.lower().strip()] = member
+            return member
+
+        if member is None:
+            return decorator
+        return decorator(member)
+
+    def _load(self):
+        if not self._loaded:
+            for module in self.modules:
+                importlib.import_module(module)
+            self._loaded = True
+
+    def get(self, name, params=None):
+        """ Gets a member given its (case insensitive) name. Classes are
+        instantiated with params (a list of `key value`, see HParams) if
+        params is not None. None or 'none' return None
+        """
+        if name is None or name.lower() == 'none':
+            return None
+
+        self._load()
+        try:
+            member = self._index[name.lower().strip()]
+        except KeyError:
+            raise KeyError("%s not found in %s.\n Valid values are: %s" %
+                           (name, self.name, ', '.join(self.names())))
+
+        # is a class and must be instantiate if params is not none
+        if params is not None and inspect.isclass(member):
+            return member(**HParams().parse(params).values())
+
+        return member
+
+    def names(self):
+        self._load()
+        return sorted(self._members)
+
+    def members(self):
+        """ Dictionary of name: member (e.g. the `custom_objects` of
+        keras.models.load_model)
+        """
+        self._load()
+        return dict(self._members)
+
+
+# Model functions of train.py --model
+MODELS = Registry('models', ['core.models'])
+# Keras layers, initializers, losses, metrics and functions of the Lambda
+# layers that are needed to load a saved model
+CUSTOM_OBJECTS = Registry('custom objects', ['core.layers',
+                                             'core.layers_utils',
+                                             'core.metrics',
+                                             'core.ctc_utils',
+                                             'core.initializers'])
+# Callbacks of train.py --lr_schedule
+CALLBACKS = Registry('callbacks', ['core.callbacks'])
+# Features extractors (--input_parser)
+FEATURES = Registry('features', ['preprocessing.audio'])
+# Text parsers (--label_parser)
+PARSERS = Registry('label parsers', ['preprocessing.text'])
+# Dataset parsers of extras/make_dataset.py --parser
+DATASETS = Registry('dataset parsers', ['datasets'])